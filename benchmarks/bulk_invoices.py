@@ -0,0 +1,62 @@
+"""
+create_invoices_bulk against serial create_invoice loop
+
+Local stub with 5 ms per call, 1% of invoices rejected by the server.
+"""
+import asyncio
+import time
+
+from stub import StubServer, MERCHANT, PAYMENT_KEY, report
+
+INVOICES = 1000
+LATENCY = 0.005
+
+
+def invoices():
+    return [{"amount": 10, "currency": "USDT", "order_id": "order-{}".format(i)} for i in range(INVOICES)]
+
+
+def timed(func):
+    started = time.perf_counter()
+    results = func()
+    elapsed = time.perf_counter() - started
+    if results is not None:
+        assert sum(1 for i in results if not i.ok) == INVOICES // 100
+    return INVOICES / elapsed
+
+
+def serial(client):
+    for params in invoices():
+        try:
+            client.create_invoice(**params)
+        except Exception:
+            pass
+
+
+async def bulk_async(stub, max_workers):
+    from pyCryptomusAPI import AsyncCryptomusAPI
+    async with AsyncCryptomusAPI(MERCHANT, payment_api_key = PAYMENT_KEY, api_url = stub.url,
+                                 pool_maxsize = max_workers) as client:
+        return await client.create_invoices_bulk(invoices(), max_workers = max_workers)
+
+
+def main():
+    rejected = ["order-{}".format(i) for i in range(0, INVOICES, 100)]
+    with StubServer(latency = LATENCY, reject_order_ids = rejected) as stub:
+        print("{} invoices, {:.0f} ms per call:".format(INVOICES, LATENCY * 1000))
+        with stub.client() as client:
+            report("serial loop", timed(lambda: serial(client)), "inv/s")
+        for max_workers, pool_maxsize in ((8, 10), (32, 32), (32, 10)):
+            with stub.client(pool_maxsize = pool_maxsize) as client:
+                report("bulk, {} workers, pool_maxsize {}".format(max_workers, pool_maxsize),
+                       timed(lambda: client.create_invoices_bulk(invoices(), max_workers = max_workers)), "inv/s")
+        try:
+            import aiohttp
+        except ImportError:
+            print("  async bulk skipped: aiohttp is not installed")
+        else:
+            report("async bulk, 64 workers", timed(lambda: asyncio.run(bulk_async(stub, 64))), "inv/s")
+
+
+if __name__ == "__main__":
+    main()
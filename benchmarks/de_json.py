@@ -0,0 +1,61 @@
+"""
+Compiled schema constructors against setattr walk over the same slotted models
+
+History pages of 1000 recorded-shape rows, already decoded JSON, best of 5.
+"""
+from stub import SERVICES, history_page, invoice_row, payout_row, best_of
+
+from pyCryptomusAPI.cryto_types import Amount, PaymentsHistory, PayoutHistory, Service, SlottedJsonDeserializable
+
+ROWS = 1000
+
+
+def setattr_walk(cls, data):
+    """
+    Generic de_json: default constructor, then setattr of every key with per-field conversion
+    """
+    instance = cls()
+    aliases = cls._aliases
+    for key, value in data.items():
+        name = aliases.get(key, key)
+        kind = cls._schema.get(name)
+        if value is not None and kind is not None:
+            if isinstance(kind, list):
+                value = [setattr_walk(kind[0], i) for i in value]
+            elif isinstance(kind, type) and issubclass(kind, SlottedJsonDeserializable):
+                value = setattr_walk(kind, value)
+            else:
+                value = float(value) if kind is Amount else kind(value)
+        if name in cls._field_set:
+            setattr(instance, name, value)
+        else:
+            if instance.extra is None:
+                instance.extra = {}
+            instance.extra[key] = value
+    return instance
+
+
+def main():
+    payments = history_page([invoice_row(i) for i in range(ROWS)], ROWS)
+    payouts = history_page([payout_row(i) for i in range(ROWS)], ROWS)
+    cases = (
+        ("PaymentsHistory, {} rows".format(ROWS), PaymentsHistory, payments, 1),
+        ("PayoutHistory, {} rows".format(ROWS), PayoutHistory, payouts, 1),
+        ("4 x Service", Service, None, 1000),
+    )
+    print("de_json, best of 5 (setattr walk -> compiled):")
+    for name, cls, data, number in cases:
+        if data is None:
+            walk = lambda: [setattr_walk(Service, i) for i in SERVICES]
+            compiled = lambda: [Service.de_json(i) for i in SERVICES]
+        else:
+            walk = lambda: setattr_walk(cls, data)
+            compiled = lambda: cls.de_json(data)
+        unit = 1e3 if number == 1 else 1e6
+        print("  {:<30} {:>8.1f} -> {:>8.1f} {}".format(
+            name, best_of(walk, number = number) * unit, best_of(compiled, number = number) * unit,
+            "ms" if number == 1 else "us"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Response decoding and request encoding with every installed JSON codec
+
+Best of 5, recorded-shape answers.
+"""
+import json
+
+from stub import MERCHANT, PAYMENT_KEY, history_page, invoice_row, best_of
+
+from pyCryptomusAPI import pyCryptomusAPI, get_json_codec
+from pyCryptomusAPI.cryto_types import PaymentsHistory
+
+ROWS = 1000
+
+
+def installed_codecs():
+    codecs = []
+    for name in ("json", "orjson", "ujson", "simplejson"):
+        try:
+            codecs.append(get_json_codec(name))
+        except ImportError:
+            print("  {} is not installed".format(name))
+    return codecs
+
+
+def main():
+    page = json.dumps({"state": 0, "result": history_page([invoice_row(i) for i in range(ROWS)], ROWS)}).encode()
+    invoice = json.dumps({"state": 0, "result": invoice_row(1)}).encode()
+    print("Best of 5:")
+    for codec in installed_codecs():
+        client = pyCryptomusAPI(MERCHANT, payment_api_key = PAYMENT_KEY, json_codec = codec)
+        print("  {}:".format(codec.name))
+        print("    {:<36} {:>8.2f} ms".format(
+            "decode {}-item history page".format(ROWS), best_of(lambda: codec.loads(page)) * 1e3))
+        print("    {:<36} {:>8.2f} ms".format(
+            "decode + parse same page", best_of(lambda: PaymentsHistory.de_json(codec.loads(page)["result"])) * 1e3))
+        print("    {:<36} {:>8.2f} us".format(
+            "decode invoice answer", best_of(lambda: codec.loads(invoice), number = 10000) * 1e6))
+        print("    {:<36} {:>8.2f} us".format(
+            "encode + sign request", best_of(
+                lambda: client._prepare_request("payment/info", 1, {"order_id": "order-1"}), number = 10000) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
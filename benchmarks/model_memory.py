@@ -0,0 +1,80 @@
+"""
+Memory per parsed object: __slots__ models against the same fields stored in instance __dict__
+
+Objects are parsed from recorded-shape rows, amounts included (tracemalloc).
+"""
+import tracemalloc
+
+from stub import SERVICES, BALANCE, invoice_row, payout_row
+
+from pyCryptomusAPI.cryto_types import Invoice, Payout, Service, BalanceItem, JsonDeserializable
+
+OBJECTS = 100000
+
+
+def dict_model(amounts):
+    """
+    Returns parser of rows into objects with fields in instance __dict__, as models were stored before __slots__.
+    Every model gets its own class, so instance dicts share keys as they did with separate model classes.
+    """
+
+    class DictModel(JsonDeserializable):
+        pass
+
+    def parse(row):
+        instance = DictModel.de_json(row, process_mode = 2)
+        for name in amounts:
+            if getattr(instance, name, None) is not None:
+                setattr(instance, name, float(getattr(instance, name)))
+        return instance
+
+    return parse
+
+
+def dict_service():
+    parse_service = dict_model(())
+    parse_limit = dict_model(("min_amount", "max_amount"))
+    parse_commission = dict_model(("fee_amount", "percent"))
+
+    def parse(row):
+        instance = parse_service(row)
+        instance.limit = parse_limit(row["limit"])
+        instance.commission = parse_commission(row["commission"])
+        return instance
+
+    return parse
+
+
+def per_object(parse, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [parse(row) for row in rows]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    # List of objects itself is not counted
+    return (size - objects.__sizeof__()) / len(objects)
+
+
+def main():
+    cases = (
+        ("Invoice", Invoice.de_json,
+         dict_model(("amount", "payment_amount", "payer_amount", "discount_percent", "discount", "merchant_amount")),
+         lambda i: invoice_row(i)),
+        ("Payout", Payout.de_json,
+         dict_model(("amount", "balance", "payer_amount")),
+         # create_payout answer has no created_at
+         lambda i: {key: value for key, value in payout_row(i).items() if key != "created_at"}),
+        ("Service", Service.de_json, dict_service(), lambda i: dict(SERVICES[i % len(SERVICES)])),
+        ("BalanceItem", BalanceItem.de_json,
+         dict_model(("balance", "balance_usd")),
+         lambda i: dict(BALANCE["balance"]["merchant"][i % 4])),
+    )
+    print("Bytes per object, {} objects:".format(OBJECTS))
+    for name, parse_slots, parse_dict, row in cases:
+        rows = [row(i) for i in range(OBJECTS)]
+        print("  {:<12} __dict__ {:>6.0f}  ->  __slots__ {:>6.0f}".format(
+            name, per_object(parse_dict, rows), per_object(parse_slots, rows)))
+
+
+if __name__ == "__main__":
+    main()
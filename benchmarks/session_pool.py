@@ -0,0 +1,34 @@
+"""
+Pooled keep-alive session against new connection per call
+
+Sequential payment_information calls against the local stub (plain HTTP, no TLS, so real gain is larger).
+"""
+import time
+
+import requests
+
+from stub import StubServer, report
+
+CALLS = 2000
+
+
+def rate(client):
+    started = time.perf_counter()
+    for _ in range(CALLS):
+        client.payment_information(order_id = "order-1")
+    return CALLS / (time.perf_counter() - started)
+
+
+def main():
+    with StubServer() as stub:
+        print("{} sequential payment_information calls:".format(CALLS))
+        # requests module as session: every call opens a new connection, as requests.post did before pooling
+        report("requests.post per call", rate(stub.client(session = requests)), "req/s")
+        with stub.client(keep_alive = False) as client:
+            report("keep_alive=False", rate(client), "req/s")
+        with stub.client() as client:
+            report("pooled keep-alive", rate(client), "req/s")
+
+
+if __name__ == "__main__":
+    main()
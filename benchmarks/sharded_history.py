@@ -0,0 +1,64 @@
+"""
+Date-window sharded history fetch against serial cursor chain
+
+Local stub: 6000 invoices over 30 days, 100 per page, 20 ms per request, shared RateLimiter of 200 req/s.
+"""
+import asyncio
+import time
+from datetime import timedelta
+
+from stub import StubServer, MERCHANT, PAYMENT_KEY, HISTORY_END, report
+
+from pyCryptomusAPI import RateLimiter
+
+INVOICES = 6000
+DAYS = 30
+LATENCY = 0.02
+DATE_FROM = HISTORY_END - timedelta(days = DAYS)
+
+
+def limiter():
+    return RateLimiter(payment_rate = 200, burst = 16)
+
+
+def serial(client):
+    return list(client.iter_payment_history(date_from = DATE_FROM, date_to = HISTORY_END))
+
+
+async def sharded_async(stub, max_workers):
+    from pyCryptomusAPI import AsyncCryptomusAPI
+    async with AsyncCryptomusAPI(MERCHANT, payment_api_key = PAYMENT_KEY, api_url = stub.url,
+                                 rate_limiter = limiter()) as client:
+        return (await client.payment_history_sharded(DATE_FROM, HISTORY_END, max_workers = max_workers)).items
+
+
+def timed(name, func, expected):
+    started = time.perf_counter()
+    items = func()
+    report(name, time.perf_counter() - started, "s")
+    assert [i.uuid for i in items] == expected, "{}: items differ from serial walk".format(name)
+
+
+def main():
+    step = timedelta(days = DAYS) / INVOICES
+    with StubServer(latency = LATENCY, payments = INVOICES, per_page = 100, history_step = step) as stub:
+        print("{} invoices over {} days, {:.0f} ms per request:".format(INVOICES, DAYS, LATENCY * 1000))
+        with stub.client(rate_limiter = limiter()) as client:
+            started = time.perf_counter()
+            expected = [i.uuid for i in serial(client)]
+            report("serial cursor chain", time.perf_counter() - started, "s")
+        for max_workers in (1, 2, 4, 8, 16):
+            with stub.client(rate_limiter = limiter(), pool_maxsize = max_workers) as client:
+                timed("{} workers".format(max_workers),
+                      lambda: client.payment_history_sharded(DATE_FROM, HISTORY_END, max_workers = max_workers).items,
+                      expected)
+        try:
+            import aiohttp
+        except ImportError:
+            print("  async skipped: aiohttp is not installed")
+        else:
+            timed("async, 8 workers", lambda: asyncio.run(sharded_async(stub, 8)), expected)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Request signing with reusable Signer against validating and encoding credentials on every request
+
+Min of 10 x 3 x 20000 calls.
+"""
+import base64
+import json
+import timeit
+from hashlib import md5
+
+from stub import MERCHANT, PAYMENT_KEY
+
+from pyCryptomusAPI import pyCryptomusAPI, API_URL
+
+NUMBER = 20000
+
+
+def per_call_request(method_url, merchant_uuid, api_key, kwargs):
+    """
+    Request preparation as it was done before Signer: credentials are checked and encoded for every request
+    """
+    data = dict(kwargs) if kwargs else {}
+    if not api_key or not api_key.isascii():
+        raise ValueError("Invalid key")
+    if not merchant_uuid or not merchant_uuid.isascii():
+        raise ValueError("Invalid merchant UUID")
+    json_dumps = json.dumps(data)
+    pre_sign = json_dumps if data else ""
+    if pre_sign and not pre_sign.isascii():
+        raise ValueError("Data dump contains non-ascii characters")
+    sign = md5(base64.b64encode(pre_sign.encode("ascii")) + api_key.encode("ascii")).hexdigest()
+    headers = {"merchant": merchant_uuid, "sign": sign, "Content-Type": "application/json"}
+    return API_URL + method_url, pre_sign, headers
+
+
+def best(func):
+    return min(min(timeit.repeat(func, number = NUMBER, repeat = 3)) for _ in range(10)) / NUMBER
+
+
+def main():
+    client = pyCryptomusAPI(MERCHANT, payment_api_key = PAYMENT_KEY)
+    params = {"order_id": "order-1"}
+    print("Request preparation (per call -> Signer):")
+    for name, method_url, kwargs in (("payment_information", "payment/info", params), ("empty body (balance)", "balance", None)):
+        old = best(lambda: per_call_request(method_url, MERCHANT, PAYMENT_KEY, kwargs))
+        new = best(lambda: client._prepare_request(method_url, 1, kwargs))
+        print("  {:<24} {:>6.2f} us -> {:>6.2f} us".format(name, old * 1e6, new * 1e6))
+
+
+if __name__ == "__main__":
+    main()
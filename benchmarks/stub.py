@@ -0,0 +1,201 @@
+"""
+Local Cryptomus API stub and helpers shared by benchmarks
+
+Run benchmarks from the repository root, e.g.: python benchmarks/session_pool.py
+"""
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyCryptomusAPI import pyCryptomusAPI
+
+MERCHANT = "merchant"
+PAYMENT_KEY = "payment_key"
+PAYOUT_KEY = "payout_key"
+HISTORY_END = datetime(2024, 2, 1)
+
+SERVICES = [
+    {"network": network, "currency": currency, "is_available": True,
+     "limit": {"min_amount": "1.00000000", "max_amount": "1000000.00000000"},
+     "commission": {"fee_amount": fee, "percent": "1.00"}}
+    for network, currency, fee in (("tron", "USDT", "1.00"), ("bsc", "USDT", "0.30"),
+                                   ("eth", "USDT", "5.00"), ("btc", "BTC", "0.0001"))
+]
+BALANCE = {"balance": {
+    "merchant": [{"uuid": "b-{}".format(c), "balance": "1000.00000000", "currency_code": c, "balance_usd": "1000.00"}
+                 for c in ("USDT", "BTC", "ETH", "TRX")],
+    "user": []}}
+
+
+def invoice_row(i, created_at = None):
+    """
+    Recorded-shape payment history item
+    """
+    return {
+        "uuid": "a7c0caec-a594-4aaa-b1c4-{:012d}".format(i), "order_id": "order-{}".format(i),
+        "amount": "{}.50".format(10 + i % 1000), "payment_amount": "0.00000000", "payer_amount": "10.60000000",
+        "discount_percent": 0, "discount": "0.00000000", "payer_currency": "USDT", "currency": "USDT",
+        "merchant_amount": "10.39500000", "network": ("tron", "bsc", "eth")[i % 3],
+        "address": "TXhfYSWt2oKRrHAJVJeYRuit6ZzKuoEKXj", "from": None, "txid": None,
+        "payment_status": "check", "url": "https://pay.cryptomus.com/pay/{}".format(i),
+        "expired_at": 1689099831, "status": ("check", "paid", "cancel")[i % 3], "is_final": i % 3 != 0,
+        "additional_data": None,
+        "created_at": (created_at or HISTORY_END - timedelta(seconds = i)).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+        "updated_at": (created_at or HISTORY_END - timedelta(seconds = i)).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+    }
+
+
+def payout_row(i):
+    """
+    Recorded-shape payout history item
+    """
+    return {
+        "uuid": "a7c0caec-a594-4bbb-b1c4-{:012d}".format(i), "amount": "{}.00000000".format(5 + i % 100),
+        "currency": "USDT", "network": "tron", "address": "TJ4N3rLWq8CJFMLR4dczc4QcFBkaGVzKQt",
+        "txid": None, "status": "process", "is_final": False, "balance": "129.00000000",
+        "payer_currency": "USDT", "payer_amount": "5.00000000",
+        "created_at": (HISTORY_END - timedelta(seconds = i)).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+    }
+
+
+def history_page(rows, per_page = 100, cursor = None):
+    """
+    payment/list or payout/list result: page of rows starting at cursor (row offset)
+    """
+    start = int(cursor) if cursor else 0
+    end = start + per_page
+    return {"items": rows[start:end], "paginate": {
+        "count": len(rows[start:end]), "hasPages": end < len(rows), "perPage": per_page,
+        "nextCursor": str(end) if end < len(rows) else None, "previousCursor": str(start) if start else None}}
+
+
+class StubServer:
+    """
+    In-process HTTP/1.1 server answering Cryptomus API methods with canned results
+
+    Every request waits latency seconds before the answer. History contains payments (and payouts) created one per
+    history_step back from HISTORY_END, filtered by date_from/date_to and paged by per_page.
+    Invoices with order_id in reject_order_ids are answered with HTTP 422.
+    """
+
+    def __init__(self, latency = 0.0, payments = 1000, payouts = 0, per_page = 100,
+                 history_step = timedelta(seconds = 1), reject_order_ids = ()):
+        self.latency = latency
+        self.per_page = per_page
+        self.payments = [invoice_row(i, HISTORY_END - history_step * i) for i in range(payments)]
+        self.payouts = [payout_row(i) for i in range(payouts)]
+        self.reject_order_ids = frozenset(reject_order_ids)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/v1/".format(self._server.server_address[1])
+
+    def __enter__(self):
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def client(self, **kwargs):
+        """
+        :return: (pyCryptomusAPI) Client of the stub, kwargs are passed to the constructor
+        """
+        return pyCryptomusAPI(MERCHANT, payment_api_key = PAYMENT_KEY, payout_api_key = PAYOUT_KEY,
+                              api_url = self.url, **kwargs)
+
+    def answer(self, method_url, data):
+        """
+        :return: (status, result) of the method
+        """
+        if method_url in ("payment", "payment/info"):
+            order_id = data.get("order_id") or "order-1"
+            if order_id in self.reject_order_ids:
+                return 422, {"state": 1, "message": "Order {} is rejected".format(order_id)}
+            row = invoice_row(1)
+            row["order_id"] = order_id
+            if "amount" in data:
+                row["amount"] = data["amount"]
+            return 200, row
+        if method_url in ("payment/list", "payout/list"):
+            rows = self.payments if method_url == "payment/list" else self.payouts
+            date_from = data.get("date_from")
+            date_to = data.get("date_to")
+            if date_from or date_to:
+                rows = [row for row in rows if _in_window(row["created_at"], date_from, date_to)]
+            return 200, history_page(rows, self.per_page, data.get("cursor"))
+        if method_url in ("payment/services", "payout/services"):
+            return 200, SERVICES
+        if method_url == "balance":
+            return 200, [BALANCE]
+        return 404, {"state": 1, "message": "Unknown method"}
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, don't let them wait for delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                with stub._lock:
+                    stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                method_url = self.path.split("/v1/", 1)[-1]
+                status, result = stub.answer(method_url, json.loads(body) if body else {})
+                if status == 200:
+                    result = {"state": 0, "result": result}
+                payload = json.dumps(result).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if self.headers.get("Connection", "").lower() == "close":
+                    self.send_header("Connection", "close")
+                    self.close_connection = True
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def _in_window(created_at, date_from, date_to):
+    created_at = created_at[:19].replace("T", " ")
+    return (not date_from or created_at >= date_from) and (not date_to or created_at <= date_to)
+
+
+def best_of(func, repeat = 5, number = 1):
+    """
+    :return: (Float) Best time of one func call (in seconds) out of repeat runs of number calls
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+def report(name, value, unit):
+    print("  {:<40} {:>10.2f} {}".format(name, value, unit))
+
@@ -0,0 +1,79 @@
+"""
+Webhook receivers throughput: signed payment webhooks through the WSGI and ASGI app callables
+
+One core, no-op handler, for json and (if installed) orjson codecs.
+"""
+import asyncio
+import io
+import json
+import time
+
+from stub import MERCHANT, PAYMENT_KEY, PAYOUT_KEY, invoice_row, report
+
+from pyCryptomusAPI import pyCryptomusAPI, WebhookApp, AsyncWebhookApp, webhook_sign_payload
+
+WEBHOOKS = 20000
+
+
+def webhooks(client):
+    bodies = []
+    for i in range(WEBHOOKS):
+        data = invoice_row(i)
+        data["type"] = "payment"
+        data["sign"] = client.signer(1).sign(webhook_sign_payload(data))
+        bodies.append(json.dumps(data).encode())
+    return bodies
+
+
+def wsgi_rate(client, bodies):
+    app = WebhookApp(client, lambda webhook: None, queue_size = WEBHOOKS)
+    start_response = lambda status, headers: None
+    started = time.perf_counter()
+    for body in bodies:
+        app({"REQUEST_METHOD": "POST", "CONTENT_LENGTH": str(len(body)), "wsgi.input": io.BytesIO(body)},
+            start_response)
+    app.close()
+    elapsed = time.perf_counter() - started
+    assert app.stats["handled"] == WEBHOOKS
+    return WEBHOOKS / elapsed
+
+
+async def asgi_run(client, bodies):
+    app = AsyncWebhookApp(client, lambda webhook: None, queue_size = WEBHOOKS)
+    scope = {"type": "http", "method": "POST"}
+
+    async def send(message):
+        pass
+
+    started = time.perf_counter()
+    for body in bodies:
+        message = {"type": "http.request", "body": body, "more_body": False}
+
+        async def receive():
+            return message
+
+        await app(scope, receive, send)
+    await app.close()
+    elapsed = time.perf_counter() - started
+    assert app.stats["handled"] == WEBHOOKS
+    return WEBHOOKS / elapsed
+
+
+def main():
+    codecs = ["json"]
+    try:
+        import orjson
+        codecs.append("orjson")
+    except ImportError:
+        print("  orjson is not installed")
+    print("{} signed payment webhooks:".format(WEBHOOKS))
+    for codec in codecs:
+        client = pyCryptomusAPI(MERCHANT, payment_api_key = PAYMENT_KEY, payout_api_key = PAYOUT_KEY,
+                                json_codec = codec)
+        bodies = webhooks(client)
+        report("WSGI, {}".format(codec), wsgi_rate(client, bodies), "webhooks/s")
+        report("ASGI, {}".format(codec), asyncio.run(asgi_run(client, bodies)), "webhooks/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,17 @@
 from .api import *
+from .rate_limiter import *
+from .retry import *
+from .bulk import *
+from .cache import *
+from .coalesce import *
+from .validator import *
+from .json_codec import *
+from .payout_batch import *
+from .webhook import *
+from .dedup import *
+from .mirror import *
+from .query import *
+from .columns import *
+from .fees import *
+from .watcher import *
+from .async_api import *
@@ -1,42 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from hashlib import md5
-from time import sleep
+from time import sleep, monotonic
 import base64
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 
 from .cryto_types import *
+from .bulk import run_bulk
+from .cache import CACHE_MISS, CACHE_FRESH, CACHE_STALE
+from .coalesce import SingleFlight, is_coalescable
+from .validator import VALIDATED_KINDS
+from .json_codec import STDLIB_JSON_CODEC, get_json_codec
 
 API_URL = "https://api.cryptomus.com/v1/"
 
 # noinspection PyPep8Naming
 class pyCryptomusAPIException(Exception):
-    def __init__(self, code, message, full_error = ""):
+    def __init__(self, code, message, full_error = "", status_code = None):
         self.code = code
         self.message = message
         self.full_error = full_error
+        self.status_code = status_code
         super().__init__(self.message)
 
 
-# noinspection PyPep8Naming
-class pyCryptomusAPI:
+class Signer:
     """
-    Cryptomus API Client
+    Request signer for one API key
+
+    Credentials are validated and encoded once, so signing a request is just md5 of its body and the key.
+    Same sign is used by Cryptomus for webhooks.
     """
 
-    def __init__(self,
-                 merchant_uuid, payment_api_key = None, payout_api_key = None,
-                 print_errors = False, timeout = None, add_request_params = None,
-                 api_url = API_URL):
+    def __init__(self, merchant_uuid, api_key):
         """
-        Create the pyCryptomusAPI instance.
+        :param merchant_uuid: (String) Merchant UUID
+        :param api_key: (String) PAYMENT or PAYOUT API key
+        """
+        if not api_key:
+            raise pyCryptomusAPIException(-6, "Key is empty")
+        if not(api_key.isascii()):
+            raise pyCryptomusAPIException(-6, "Key contains non-ascii characters")
+        if not merchant_uuid:
+            raise pyCryptomusAPIException(-6, "Merchant UUID is empty")
+        if not(merchant_uuid.isascii()):
+            raise pyCryptomusAPIException(-6, "Merchant UUID contains non-ascii characters")
+        self.merchant_uuid = merchant_uuid
+        self.api_key = api_key
+        self._key = api_key.encode('ascii')
+        self._headers = {
+            "merchant": merchant_uuid,
+            "sign": None,
+            "Content-Type": "application/json",
+        }
 
-        :param merchant_uuid: The merchant's uuid, which you can find in the merchant's personal account in the settings section.
-        :param payment_api_key: API key for processing payments
-        :param payout_api_key: API key for accepting payment and making payouts
-        :param print_errors: (Optional) Print dumps on request errors
-        :param timeout: (Optional) Request timeout
-        :param add_request_params: (List, Optional) Additional request parameters to pass with API calls
-        :param api_url: (Optional) Use custom API endpoint URL
+    def sign(self, body = b""):
         """
+        :param body: (Bytes or String) Request body or webhook data as is (without sign), String is encoded to UTF-8
+        :return: (String) Sign
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        return md5(base64.b64encode(body) + self._key).hexdigest()
+
+    def headers(self, body = b""):
+        """
+        :param body: (Bytes) Request body
+        :return: (Dict) Request headers with sign
+        """
+        headers = self._headers.copy()
+        headers["sign"] = md5(base64.b64encode(body) + self._key).hexdigest()
+        return headers
+
+
+def _parse_services(resp):
+    return [Service.de_json(i) for i in resp]
+
+
+def _parse_balance(resp):
+    return Balance.de_json(resp[0])
+
+
+def _cached_copy(value):
+    # Cached lists are copied, so callers can't change them. Cached Balance is replaced, not changed, on update
+    return list(value) if isinstance(value, list) else value
+
+
+class _CryptomusAPIBase:
+    """
+    Cryptomus API methods and request signing shared by sync and async clients
+    """
+
+    def __init__(self,
+                 merchant_uuid, payment_api_key = None, payout_api_key = None,
+                 print_errors = False, timeout = None, add_request_params = None,
+                 api_url = API_URL, rate_limiter = None, retry_policy = None, cache = None,
+                 amount_type = float, lazy_amounts = False, json_codec = None, validator = None):
+        self._signers = {}
         self.merchant_uuid = merchant_uuid
         self.payment_api_key = payment_api_key
         self.payout_api_key = payout_api_key
@@ -44,84 +106,270 @@ class pyCryptomusAPI:
         self.timeout = timeout
         self.add_request_params = add_request_params
         self.api_url = api_url
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.cache = cache
+        self.validator = validator
+        self.amount_type = amount_type
+        self.lazy_amounts = lazy_amounts
+        if isinstance(json_codec, str):
+            json_codec = get_json_codec(json_codec)
+        self.json_codec = json_codec or STDLIB_JSON_CODEC
+        # Set by clients if coalesce is on
+        self.single_flight = None
         if (not self.payment_api_key) and (not self.payout_api_key):
             raise Exception("You must specify at least one API key.")
 
-    def __request(self, method_url, mode, **kwargs):
+    def _prepare_request(self, method_url, mode, kwargs):
         """
-        Send request to API
+        Build signed request to API
 
         :param method_url: (String) API method url (part)
         :param mode: (Int) Method mode (1: payment, 2: payout)
         :param kwargs: request data
+        :return: (url, body bytes, headers)
         """
-        if kwargs:
-            data = dict(kwargs)
-        else:
-            data = {}
-
         if self.add_request_params:
+            data = dict(kwargs) if kwargs else {}
             data.update(self.add_request_params)
+        else:
+            data = kwargs
 
-        base_resp = None
-        try:
-            key = self.payment_api_key if (mode == 1) else self.payout_api_key
-            if not key:
-                raise pyCryptomusAPIException(-6, "Key is empty")
-            if not(key.isascii()):
-                raise pyCryptomusAPIException(-6, "Key contains non-ascii characters")
-            if not self.merchant_uuid:
-                raise pyCryptomusAPIException(-6, "Merchant UUID is empty")
-            if not(self.merchant_uuid.isascii()):
-                raise pyCryptomusAPIException(-6, "Merchant UUID contains non-ascii characters")
-            json_dumps = json.dumps(data)
+        signer = self._signers.get(mode) or self.signer(mode)
+        if data:
+            try:
+                json_dumps = self.json_codec.dumps(data)
+            except (TypeError, ValueError) as e:
+                raise pyCryptomusAPIException(-6, "Data dump failed: {}".format(e))
             # json_dumps = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
-            pre_sign = json_dumps if data else ""
-            if pre_sign and not(pre_sign.isascii()):
+            try:
+                body = json_dumps.encode('ascii')
+            except UnicodeEncodeError:
                 raise pyCryptomusAPIException(-6, "Data dump contains non-ascii characters")
-            sign = md5(base64.b64encode(pre_sign.encode('ascii')) + key.encode('ascii')).hexdigest()
-            headers = {
-                "merchant": self.merchant_uuid,
-                "sign": sign,
-                "Content-Type": "application/json",
-            }
-            base_resp = requests.post(self.api_url + method_url, data=pre_sign, headers=headers, timeout=self.timeout)
-            resp = base_resp.json()
-        except ValueError as ve:
-            code = base_resp.status_code if base_resp else -2
-            message = "Response decode failed: {}".format(ve)
-            if self.print_errors:
-                print(message)
-            raise pyCryptomusAPIException(code, message)
-        except pyCryptomusAPIException as pe:
-            raise pe
-        except Exception as e:
-            code = base_resp.status_code if base_resp else -3
-            message = "Request unknown exception: {}".format(e)
-            if self.print_errors:
-                print(message)
-            raise pyCryptomusAPIException(code, message)
+        else:
+            body = b""
+        return self.api_url + method_url, body, signer.headers(body)
+
+    def signer(self, mode):
+        """
+        Returns Signer for the key of mode, it's created on first use and after credentials change
+
+        :param mode: (Int) 1: PAYMENT API key, 2: PAYOUT API key
+        :return: (Signer)
+        """
+        signer = self._signers.get(mode)
+        if signer is None:
+            signer = Signer(self.merchant_uuid, self.payment_api_key if (mode == 1) else self.payout_api_key)
+            self._signers[mode] = signer
+        return signer
+
+    @property
+    def merchant_uuid(self):
+        return self._merchant_uuid
+
+    @merchant_uuid.setter
+    def merchant_uuid(self, value):
+        self._merchant_uuid = value
+        self._signers.clear()
+
+    @property
+    def payment_api_key(self):
+        return self._payment_api_key
+
+    @payment_api_key.setter
+    def payment_api_key(self, value):
+        self._payment_api_key = value
+        self._signers.pop(1, None)
+
+    @property
+    def payout_api_key(self):
+        return self._payout_api_key
+
+    @payout_api_key.setter
+    def payout_api_key(self, value):
+        self._payout_api_key = value
+        self._signers.pop(2, None)
+
+    def _raise_error(self, code, message, dump = None, status_code = None):
+        if self.print_errors:
+            print(dump if dump is not None else message)
+        raise pyCryptomusAPIException(code, message, status_code = status_code)
+
+    def _process_response(self, resp, status_code):
+        """
+        Check decoded API response
+
+        :param resp: (Dict) Decoded response
+        :param status_code: (Int) HTTP status code
+        """
+        ok_status = status_code if status_code < 400 else None
         if not resp:
-            code = base_resp.status_code if base_resp else -4
-            message = "None request response"
-            if self.print_errors:
-                print(message)
-            raise pyCryptomusAPIException(code, message)
+            self._raise_error(ok_status or -4, "None request response", status_code = status_code)
         elif not resp.get("result"):
-            code = base_resp.status_code if base_resp else -5
             if resp.get("message"):
                 message = resp["message"]
             elif resp.get("errors"):
                 message = resp["errors"]
             else:
                 message = "No error info provided"
-            if self.print_errors:
-                print("Response: {}".format(resp))
-            raise pyCryptomusAPIException(code, message)
-        # code -6 is used above
+            self._raise_error(ok_status or -5, message, dump = "Response: {}".format(resp), status_code = status_code)
+        # code -6 is used in _prepare_request, -8 in _validate
         else:
             return resp
 
+    def _api_call(self, method_url, mode, parser = None, params = None):
+        """
+        Send request to API and parse its result. Must be overridden by clients.
+
+        :param method_url: (String) API method url (part)
+        :param mode: (Int) Method mode (1: payment, 2: payout)
+        :param parser: (Callable, Optional) Result parser
+        :param params: (Dict, Optional) request data
+        """
+        raise NotImplementedError
+
+    def _flight_key(self, method_url, mode, params):
+        """
+        :return: Key of read-only call for single_flight (same method and request body), None if call is not coalesced
+        """
+        if not (self.single_flight and is_coalescable(method_url)):
+            return None
+        if not params:
+            return method_url, mode, ""
+        try:
+            return method_url, mode, self.json_codec.dumps(params)
+        except (TypeError, ValueError):
+            return None
+
+    def _parser(self, model):
+        """
+        Returns parser of API result into model, according to amount settings
+        """
+        if self.amount_type is float and not self.lazy_amounts:
+            return model.de_json
+        return partial(model.de_json, amount_type = self.amount_type, lazy_amounts = self.lazy_amounts)
+
+    def _cached_api_call(self, key, method_url, mode, parser = None, params = None):
+        """
+        Same as _api_call, but result is taken from cache if key (client method name) is cached.
+        Must be overridden by clients.
+        """
+        raise NotImplementedError
+
+    def _validated_api_call(self, kind, method_url, mode, parser = None, params = None):
+        """
+        Same as _api_call, but request is checked by validator (kind is "payment" or "payout") before it's sent.
+        Must be overridden by clients.
+        """
+        raise NotImplementedError
+
+    def _validate(self, kind, params):
+        reason = self.validator.check(kind, params["amount"], params["currency"], params.get("network"))
+        if reason:
+            self._raise_error(-8, "Rejected by service limits: {}".format(reason))
+
+    def _balance_changing_call(self, method_url, mode, parser = None, params = None):
+        """
+        Same as _api_call for methods which change merchant balance: cached balance is updated or dropped after it.
+        Must be overridden by clients.
+        """
+        raise NotImplementedError
+
+    def _balance_changed(self, result = None):
+        """
+        Applies balance returned by create_payout to cached balance, drops cached balance after other calls
+        (and failed ones)
+        """
+        if not (self.cache and self.cache.is_cached("balance")):
+            return
+        if isinstance(result, Payout) and result.balance is not None:
+            currency = result.payer_currency or result.currency
+            balance = float(result.balance)
+            self.cache.update("balance", lambda cached: cached.with_balance(currency, balance))
+        else:
+            self.cache.invalidate("balance")
+
+    def invalidate_cache(self, method = None):
+        """
+        Drop cached results
+
+        :param method: (String, Optional) Client method name (e.g. "payment_services", "balance"), all results are dropped if not set
+        """
+        if self.cache:
+            self.cache.invalidate(method)
+
+    def _page_delay(self, page_delay):
+        if page_delay is not None:
+            return page_delay
+        # Rate limiter paces requests itself
+        return 0 if self.rate_limiter else 1
+
+    @staticmethod
+    def _history_params(date_from, date_to, cursor):
+        params = {
+        }
+        if date_from:
+            params["date_from"] = date_from.strftime(CryptomusDateFormat)
+        if date_to:
+            params["date_to"] = date_to.strftime(CryptomusDateFormat)
+        if cursor:
+            params["cursor"] = cursor
+        return params
+
+    @staticmethod
+    def _history_windows(date_from, date_to, windows):
+        """
+        Splits [date_from, date_to] into windows of whole seconds, newest first.
+        Neighbour windows share boundary second, so items created at it are returned by both.
+        """
+        date_from = date_from.replace(microsecond = 0)
+        date_to = date_to.replace(microsecond = 0)
+        if date_to <= date_from:
+            raise pyCryptomusAPIException(0, "date_to must be later than date_from")
+        step = (date_to - date_from) / max(windows, 1)
+        bounds = [date_from]
+        for i in range(1, windows):
+            bound = (date_from + step * i).replace(microsecond = 0)
+            if bound > bounds[-1]:
+                bounds.append(bound)
+        bounds.append(date_to)
+        return [(bounds[i], bounds[i + 1]) for i in reversed(range(len(bounds) - 1))]
+
+    @staticmethod
+    def _merge_windows(window_items):
+        """
+        Merges items of history windows: removes duplicates by uuid and orders by creation date, newest first
+        """
+        seen = set()
+        items = []
+        for window in window_items:
+            for item in window:
+                if item.uuid not in seen:
+                    seen.add(item.uuid)
+                    items.append(item)
+        # Windows are newest first already, so sort is almost free
+        items.sort(key = lambda item: getattr(item, "created_at", None) or "", reverse = True)
+        return items
+
+    @staticmethod
+    def _filter_sets(*filters):
+        # Sets make "in" checks O(1), empty filters accept everything
+        return [frozenset(i) if i else None for i in filters]
+
+    @staticmethod
+    def _payment_matches(payment, currencies, networks, addresses, statuses, is_final):
+        if currencies and not(payment.currency in currencies):
+            return False
+        if networks and not(payment.network in networks):
+            return False
+        if addresses and not(payment.address in addresses):
+            return False
+        if statuses and not(payment.status in statuses):
+            return False
+        if (is_final is not None) and payment.is_final != is_final:
+            return False
+        return True
+
     def create_invoice(self,
            amount, currency, order_id, network = None,
            url_return = None, url_success = None, url_callback = None,
@@ -198,8 +446,7 @@ class pyCryptomusAPI:
             params["discount_percent"] = str(discount_percent)
         if is_refresh is not None:
             params["is_refresh"] = is_refresh
-        resp = self.__request(method, 1, **params).get("result")
-        return Invoice.de_json(resp)
+        return self._validated_api_call("payment", method, 1, self._parser(Invoice), params)
 
     def create_wallet(self,
            network, currency, order_id, url_callback = None, from_referral_code = None):
@@ -227,8 +474,7 @@ class pyCryptomusAPI:
             params["url_callback"] = url_callback
         if from_referral_code:
             params["from_referral_code"] = from_referral_code
-        resp = self.__request(method, 1, **params).get("result")
-        return Wallet.de_json(resp)
+        return self._api_call(method, 1, Wallet.de_json, params)
 
     def block_wallet(self,
            wallet_uuid = None, order_id = None, is_force_refund = None):
@@ -255,8 +501,7 @@ class pyCryptomusAPI:
             params["order_id"] = order_id
         if is_force_refund is not None:
             params["is_force_refund"] = is_force_refund
-        resp = self.__request(method, 1, **params).get("result")
-        return resp
+        return self._api_call(method, 1, params = params)
 
     def block_wallet_refund(self,
            address, wallet_uuid = None, order_id = None):
@@ -282,8 +527,7 @@ class pyCryptomusAPI:
             params["uuid"] = wallet_uuid
         if order_id:
             params["order_id"] = order_id
-        resp = self.__request(method, 1, **params).get("result")
-        return resp
+        return self._balance_changing_call(method, 1, params = params)
 
     def payment_information(self,
            invoice_uuid = None, order_id = None):
@@ -307,8 +551,7 @@ class pyCryptomusAPI:
             params["uuid"] = invoice_uuid
         if order_id:
             params["order_id"] = order_id
-        resp = self.__request(method, 1, **params).get("result")
-        return Invoice.de_json(resp)
+        return self._api_call(method, 1, self._parser(Invoice), params)
 
     def refund(self,
            address, is_subtract, invoice_uuid = None, order_id = None):
@@ -336,8 +579,7 @@ class pyCryptomusAPI:
             params["uuid"] = invoice_uuid
         if order_id:
             params["order_id"] = order_id
-        resp = self.__request(method, 1, **params).get("result")
-        return Invoice.de_json(resp)
+        return self._balance_changing_call(method, 1, self._parser(Invoice), params)
 
     def payment_history(self, date_from = None, date_to = None, cursor = None):
         """
@@ -349,89 +591,9 @@ class pyCryptomusAPI:
         date_to: (String, Optional) Filtering by creation date, to
         cursor: (String, Optional) Page cursor (hash)
         """
-        params = {
-        }
-        if date_from:
-            params["date_from"] = date_from.strftime(CryptomusDateFormat)
-        if date_to:
-            params["date_to"] = date_to.strftime(CryptomusDateFormat)
-        if cursor:
-            params["cursor"] = cursor
+        params = self._history_params(date_from, date_to, cursor)
         method = "payment/list"
-        if params:
-            resp = self.__request(method, 1, **params).get("result")
-        else:
-            resp = self.__request(method, 1).get("result")
-        return PaymentsHistory.de_json(resp)
-
-    def payment_history_filtered(
-            self,
-            date_from = None, date_to = None,
-            max_results = 15, max_pages = 10,
-            currencies = None, networks = None, addresses = None,
-            statuses = None, is_final = None, page_delay = 1):
-        """
-        Payment history (advanced mode)
-
-        Based on: payment_history
-        https://doc.cryptomus.com/payments/payment-history
-        Requires PAYMENT API key
-
-        Collects only results under filters.
-        Process as many pages as needed to collect max_results, but not more than max_pages.
-
-        date_from: (String, Optional) Filtering by creation date, from
-        date_to: (String, Optional) Filtering by creation date, to
-        max_results: (Int, Optional, default=15) Max number of results to collect
-        max_pages: (Int, Optional, default=10) Max number of pages to process
-        currencies: (List of Strings, Optional) List of accepted currencies. Codes: https://doc.cryptomus.com/reference
-        networks: (List of Strings, Optional) List of accepted networks. Codes: https://doc.cryptomus.com/reference
-        addresses: (List of Strings, Optional) List of accepted addresses
-        statuses: (List of Strings, Optional) List of accepted statuses. Codes: https://doc.cryptomus.com/payments/payment-statuses
-        is_final: (Bool, Optional) If True, only final payments will be collected, if False - only non-final
-        page_delay: (Int, Optional, default=1) Delay between pages (in seconds)
-        """
-
-        result = PaymentsHistory()
-
-        page_number = 0
-        cursor = None
-        while page_number < max_pages:
-            if page_number > 0: sleep(page_delay)
-            resp = self.payment_history(date_from = date_from, date_to = date_to, cursor = cursor)
-
-            if not resp.items:
-                # No (more) payments
-                break
-
-            for payment in resp.items:
-                if currencies and not(payment.currency in currencies):
-                    continue
-                if networks and not(payment.network in networks):
-                    continue
-                if addresses and not(payment.address in addresses):
-                    continue
-                if statuses and not(payment.status in statuses):
-                    continue
-                if (is_final is not None) and payment.is_final != is_final:
-                    continue
-                result.items.append(payment)
-
-                if len(result.items) >= max_results:
-                    # Enough results collected
-                    break
-
-            if len(result.items) >= max_results:
-                # Enough results collected
-                break
-
-            cursor = resp.paginate.nextCursor
-            if not cursor:
-                # No more pages
-                break
-            page_number += 1
-
-        return result
+        return self._api_call(method, 1, self._parser(PaymentsHistory), params)
 
     def payment_services(self):
         """
@@ -440,8 +602,7 @@ class pyCryptomusAPI:
         Requires PAYMENT API key
         """
         method = "payment/services"
-        resp = self.__request(method, 1).get("result")
-        return [Service.de_json(i) for i in resp]
+        return self._cached_api_call("payment_services", method, 1, _parse_services)
 
     def create_payout(self,
               amount, currency, order_id, address, is_subtract, network,
@@ -486,8 +647,7 @@ class pyCryptomusAPI:
             params["priority"] = priority
         if memo:
             params["memo"] = memo
-        resp = self.__request(method, 2, **params).get("result")
-        return Payout.de_json(resp)
+        return self._validated_api_call("payout", method, 2, self._parser(Payout), params)
 
     def payout_information(self,
            payout_uuid = None, order_id = None):
@@ -511,33 +671,21 @@ class pyCryptomusAPI:
             params["uuid"] = payout_uuid
         if order_id:
             params["order_id"] = order_id
-        resp = self.__request(method, 1, **params).get("result")
-        return Payout.de_json(resp)
+        return self._api_call(method, 2, self._parser(Payout), params)
 
     def payout_history(self, date_from = None, date_to = None, cursor = None):
         """
         Payout history
-        https://doc.cryptomus.com/payments/payment-history
+        https://doc.cryptomus.com/payouts/payout-history
         Requires PAYOUT API key
 
         date_from: (String, Optional) Filtering by creation date, from
         date_to: (String, Optional) Filtering by creation date, to
         cursor: (String, Optional) Page cursor (hash)
         """
-        params = {
-        }
-        if date_from:
-            params["date_from"] = date_from.strftime(CryptomusDateFormat)
-        if date_to:
-            params["date_to"] = date_to.strftime(CryptomusDateFormat)
-        if cursor:
-            params["cursor"] = cursor
-        method = "payment/list"
-        if params:
-            resp = self.__request(method, 1, **params).get("result")
-        else:
-            resp = self.__request(method, 1).get("result")
-        return PayoutHistory.de_json(resp)
+        params = self._history_params(date_from, date_to, cursor)
+        method = "payout/list"
+        return self._api_call(method, 2, self._parser(PayoutHistory), params)
 
     def payout_services(self):
         """
@@ -546,15 +694,386 @@ class pyCryptomusAPI:
         Requires PAYMOUT API key
         """
         method = "payout/services"
-        resp = self.__request(method, 2).get("result")
-        return [Service.de_json(i) for i in resp]
+        return self._cached_api_call("payout_services", method, 2, _parse_services)
 
     def balance(self):
         """
         Get balance of merchant(account) or user(wallet)
         https://doc.cryptomus.com/balance
         Requires PAYMENT API key
+
+        * Result is cached if cache has balance_ttl. Cached balance is updated by create_payout and dropped by refund and block_wallet_refund
         """
         method = "balance"
-        resp = self.__request(method, 1).get("result")
-        return Balance.de_json(resp[0])
+        return self._cached_api_call("balance", method, 1, _parse_balance)
+
+
+# noinspection PyPep8Naming
+class pyCryptomusAPI(_CryptomusAPIBase):
+    """
+    Cryptomus API Client
+    """
+
+    def __init__(self,
+                 merchant_uuid, payment_api_key = None, payout_api_key = None,
+                 print_errors = False, timeout = None, add_request_params = None,
+                 api_url = API_URL, rate_limiter = None, retry_policy = None, cache = None,
+                 amount_type = float, lazy_amounts = False, json_codec = None, coalesce = False, validator = None,
+                 session = None, pool_connections = 10, pool_maxsize = 10, pool_block = False, keep_alive = True):
+        """
+        Create the pyCryptomusAPI instance.
+
+        :param merchant_uuid: The merchant's uuid, which you can find in the merchant's personal account in the settings section.
+        :param payment_api_key: API key for processing payments
+        :param payout_api_key: API key for accepting payment and making payouts
+        :param print_errors: (Optional) Print dumps on request errors
+        :param timeout: (Optional) Request timeout
+        :param add_request_params: (List, Optional) Additional request parameters to pass with API calls
+        :param api_url: (Optional) Use custom API endpoint URL
+        :param rate_limiter: (RateLimiter, Optional) Limit request rate. Can be shared between clients.
+        :param retry_policy: (RetryPolicy, Optional) Retry calls on transient failures
+        :param cache: (ResponseCache, Optional) Cache results of payment_services and payout_services
+        :param amount_type: (Optional, default=float) Type of Invoice and Payout amounts: float or decimal.Decimal
+        :param lazy_amounts: (Optional, default=False) Keep Invoice and Payout amounts as received until first access
+        :param json_codec: (JsonCodec or String, Optional) JSON codec or its name ("json", "orjson", "ujson", "simplejson", "auto"). Default: json
+        :param coalesce: (Optional, default=False) Concurrent identical read-only calls (from different threads) share one request and its result. Counters are in single_flight.stats
+        :param validator: (ServiceValidator, Optional) Reject create_invoice and create_payout locally if service is not available or amount is out of its limits
+        :param session: (Optional) Shared requests.Session to send requests with. It is not closed by close().
+        :param pool_connections: (Optional) Number of per-host connection pools to keep (ignored if session is passed)
+        :param pool_maxsize: (Optional) Max number of connections kept open per host (ignored if session is passed)
+        :param pool_block: (Optional) Wait for a free connection instead of opening an extra one when the pool is full (ignored if session is passed)
+        :param keep_alive: (Optional) Reuse connections between API calls
+        """
+        super().__init__(
+            merchant_uuid, payment_api_key = payment_api_key, payout_api_key = payout_api_key,
+            print_errors = print_errors, timeout = timeout, add_request_params = add_request_params,
+            api_url = api_url, rate_limiter = rate_limiter, retry_policy = retry_policy, cache = cache,
+            amount_type = amount_type, lazy_amounts = lazy_amounts, json_codec = json_codec, validator = validator)
+        if coalesce:
+            self.single_flight = SingleFlight()
+        self.keep_alive = keep_alive
+        if session is not None:
+            self.session = session
+            self.own_session = False
+            self.pool_maxsize = None
+        else:
+            self.pool_maxsize = pool_maxsize
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            self.own_session = True
+
+    def close(self):
+        """
+        Close pooled connections. Shared session passed to the constructor is left open.
+        Client can still be used after close: connections are opened again by the next call.
+        """
+        if self.own_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __request(self, method_url, mode, **kwargs):
+        """
+        Send request to API, retrying it according to retry_policy
+
+        :param method_url: (String) API method url (part)
+        :param mode: (Int) Method mode (1: payment, 2: payout)
+        :param kwargs: request data
+        """
+        started = monotonic()
+        attempt = 1
+        while True:
+            try:
+                return self.__send(method_url, mode, kwargs)
+            except pyCryptomusAPIException as pe:
+                if not self.retry_policy:
+                    raise pe
+                delay = self.retry_policy.next_delay(method_url, kwargs, pe, attempt, monotonic() - started)
+                if delay is None:
+                    raise pe
+            sleep(delay)
+            attempt += 1
+
+    def __send(self, method_url, mode, kwargs):
+        base_resp = None
+        try:
+            url, body, headers = self._prepare_request(method_url, mode, kwargs)
+            if not self.keep_alive:
+                headers["Connection"] = "close"
+            if self.rate_limiter:
+                self.rate_limiter.acquire(mode)
+            base_resp = self.session.post(url, data=body, headers=headers, timeout=self.timeout)
+            if self.rate_limiter:
+                self.rate_limiter.on_response(mode, base_resp.status_code, base_resp.headers.get("Retry-After"))
+            resp = self.json_codec.loads(base_resp.content)
+        except ValueError as ve:
+            code = base_resp.status_code if base_resp else -2
+            status_code = base_resp.status_code if base_resp is not None else None
+            self._raise_error(code, "Response decode failed: {}".format(ve), status_code = status_code)
+        except pyCryptomusAPIException as pe:
+            raise pe
+        except Exception as e:
+            code = base_resp.status_code if base_resp else -3
+            status_code = base_resp.status_code if base_resp is not None else None
+            self._raise_error(code, "Request unknown exception: {}".format(e), status_code = status_code)
+        # noinspection PyUnboundLocalVariable
+        return self._process_response(resp, base_resp.status_code)
+
+    def _api_call(self, method_url, mode, parser = None, params = None):
+        key = self._flight_key(method_url, mode, params)
+        if key is not None:
+            return self.single_flight.run(key, partial(self.__call, method_url, mode, parser, params))
+        return self.__call(method_url, mode, parser, params)
+
+    def __call(self, method_url, mode, parser, params):
+        if params:
+            resp = self.__request(method_url, mode, **params).get("result")
+        else:
+            resp = self.__request(method_url, mode).get("result")
+        return parser(resp) if parser else resp
+
+    def payment_history_filtered(
+            self,
+            date_from = None, date_to = None,
+            max_results = 15, max_pages = 10,
+            currencies = None, networks = None, addresses = None,
+            statuses = None, is_final = None, page_delay = None):
+        """
+        Payment history (advanced mode)
+
+        Based on: payment_history
+        https://doc.cryptomus.com/payments/payment-history
+        Requires PAYMENT API key
+
+        Collects only results under filters.
+        Process as many pages as needed to collect max_results, but not more than max_pages.
+
+        date_from: (String, Optional) Filtering by creation date, from
+        date_to: (String, Optional) Filtering by creation date, to
+        max_results: (Int, Optional, default=15) Max number of results to collect
+        max_pages: (Int, Optional, default=10) Max number of pages to process
+        currencies: (List or Set of Strings, Optional) Accepted currencies. Codes: https://doc.cryptomus.com/reference
+        networks: (List or Set of Strings, Optional) Accepted networks. Codes: https://doc.cryptomus.com/reference
+        addresses: (List or Set of Strings, Optional) Accepted addresses
+        statuses: (List or Set of Strings, Optional) Accepted statuses. Codes: https://doc.cryptomus.com/payments/payment-statuses
+        is_final: (Bool, Optional) If True, only final payments will be collected, if False - only non-final
+        page_delay: (Int, Optional) Delay between pages (in seconds). Default: 1, or 0 if rate_limiter is set
+        """
+
+        result = PaymentsHistory()
+        page_delay = self._page_delay(page_delay)
+        currencies, networks, addresses, statuses = self._filter_sets(currencies, networks, addresses, statuses)
+
+        page_number = 0
+        cursor = None
+        while page_number < max_pages:
+            if page_number > 0 and page_delay: sleep(page_delay)
+            resp = self.payment_history(date_from = date_from, date_to = date_to, cursor = cursor)
+
+            if not resp.items:
+                # No (more) payments
+                break
+
+            for payment in resp.items:
+                if not self._payment_matches(payment, currencies, networks, addresses, statuses, is_final):
+                    continue
+                result.items.append(payment)
+
+                if len(result.items) >= max_results:
+                    # Enough results collected
+                    break
+
+            if len(result.items) >= max_results:
+                # Enough results collected
+                break
+
+            cursor = resp.paginate.nextCursor
+            if not cursor:
+                # No more pages
+                break
+            page_number += 1
+
+        return result
+
+    def _cached_api_call(self, key, method_url, mode, parser = None, params = None):
+        if not (self.cache and self.cache.is_cached(key)):
+            return self._api_call(method_url, mode, parser, params)
+        state, value = self.cache.lookup(key)
+        if state == CACHE_STALE and self.cache.begin_refresh(key):
+            threading.Thread(
+                target = self.__refresh_cache, args = (key, method_url, mode, parser, params), daemon = True).start()
+        if state in (CACHE_FRESH, CACHE_STALE):
+            return _cached_copy(value)
+        version = self.cache.version(key)
+        value = self._api_call(method_url, mode, parser, params)
+        self.cache.store(key, value, version)
+        return _cached_copy(value)
+
+    def __refresh_cache(self, key, method_url, mode, parser, params):
+        version = self.cache.version(key)
+        try:
+            value = self._api_call(method_url, mode, parser, params)
+        except Exception:
+            self.cache.end_refresh(key, failed = True)
+        else:
+            self.cache.end_refresh(key, value, version = version)
+
+    def _validated_api_call(self, kind, method_url, mode, parser = None, params = None):
+        if self.validator:
+            state = self.validator.state(kind)
+            if state == CACHE_MISS:
+                if self.validator.begin_refresh(kind):
+                    self.__load_services(kind)
+                else:
+                    self.validator.wait(kind, self.timeout)
+            elif state == CACHE_STALE and self.validator.begin_refresh(kind):
+                threading.Thread(target = self.__load_services, args = (kind,), daemon = True).start()
+            self._validate(kind, params)
+        if kind == "payout":
+            return self._balance_changing_call(method_url, mode, parser, params)
+        return self._api_call(method_url, mode, parser, params)
+
+    def __load_services(self, kind):
+        try:
+            services = getattr(self, VALIDATED_KINDS[kind])()
+        except Exception:
+            self.validator.end_refresh(kind, failed = True)
+        else:
+            self.validator.end_refresh(kind, services)
+
+    def _balance_changing_call(self, method_url, mode, parser = None, params = None):
+        try:
+            result = self._api_call(method_url, mode, parser, params)
+        except Exception:
+            self._balance_changed()
+            raise
+        self._balance_changed(result)
+        return result
+
+    def create_invoices_bulk(self, invoices, max_workers = 8):
+        """
+        Create many invoices concurrently
+
+        Based on: create_invoice
+        https://doc.cryptomus.com/payments/creating-invoice
+        Requires PAYMENT API key
+
+        Failed items do not stop the batch: check BulkResult.ok / BulkResult.error of every item.
+        max_workers is capped at client pool_maxsize (if session is not passed): threads above it would wait
+        for a pooled connection or open connections that are not reused, and only add contention.
+
+        invoices: (Iterable of Dicts) create_invoice parameters for every invoice, e.g. {"amount": 1, "currency": "USDT", "order_id": "1"}
+        max_workers: (Int, Optional, default=8) Max number of simultaneous requests
+        """
+        if self.pool_maxsize:
+            max_workers = min(max_workers, self.pool_maxsize)
+        return run_bulk(self.create_invoice, invoices, max_workers)
+
+    def payment_history_sharded(self, date_from, date_to, windows = None, max_workers = 4, page_delay = None):
+        """
+        Payment history for a date range, fetched in parallel
+
+        Based on: payment_history
+        https://doc.cryptomus.com/payments/payment-history
+        Requires PAYMENT API key
+
+        Date range is split into windows, cursor chains of windows are walked concurrently (under client rate_limiter,
+        if it's set). Items are merged in creation date order (newest first), duplicates on window boundaries are removed by uuid.
+
+        date_from: (datetime) Filtering by creation date, from
+        date_to: (datetime) Filtering by creation date, to
+        windows: (Int, Optional) Number of windows. Default: max_workers
+        max_workers: (Int, Optional, default=4) Max number of windows fetched simultaneously
+        page_delay: (Int, Optional) Delay between pages of one window (in seconds). Default: 1, or 0 if rate_limiter is set
+        """
+        return self._history_sharded(
+            lambda window_from, window_to, cursor: self.payment_history(
+                date_from = window_from, date_to = window_to, cursor = cursor),
+            PaymentsHistory(), date_from, date_to, windows, max_workers, page_delay)
+
+    def payout_history_sharded(self, date_from, date_to, windows = None, max_workers = 4, page_delay = None):
+        """
+        Payout history for a date range, fetched in parallel
+
+        Same as payment_history_sharded, but for payout_history
+        Requires PAYOUT API key
+        """
+        return self._history_sharded(
+            lambda window_from, window_to, cursor: self.payout_history(
+                date_from = window_from, date_to = window_to, cursor = cursor),
+            PayoutHistory(), date_from, date_to, windows, max_workers, page_delay)
+
+    def _history_sharded(self, fetch_page, result, date_from, date_to, windows, max_workers, page_delay):
+        page_delay = self._page_delay(page_delay)
+
+        def walk(window):
+            items = []
+            cursor = None
+            while True:
+                page = fetch_page(window[0], window[1], cursor)
+                items.extend(page.items)
+                cursor = page.paginate.nextCursor
+                if not (page.items and cursor):
+                    return items
+                if page_delay:
+                    sleep(page_delay)
+
+        bounds = self._history_windows(date_from, date_to, windows or max_workers)
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            result.items = self._merge_windows(list(executor.map(walk, bounds)))
+        return result
+
+    def iter_payment_history(self, date_from = None, date_to = None, cursor = None, max_pages = None, prefetch = False):
+        """
+        Payment history iterator
+
+        Based on: payment_history
+        https://doc.cryptomus.com/payments/payment-history
+        Requires PAYMENT API key
+
+        Yields Invoice objects one by one, walking pages by cursor. Only the current page is kept in memory.
+        Next page is requested only when the current one is processed. With prefetch it's requested in background
+        while the current one is processed, so if iteration is stopped early one extra page may be requested.
+
+        date_from: (String, Optional) Filtering by creation date, from
+        date_to: (String, Optional) Filtering by creation date, to
+        cursor: (String, Optional) Page cursor (hash) to start from
+        max_pages: (Int, Optional) Max number of pages to process
+        prefetch: (Bool, Optional, default=False) Request next page in background
+        """
+        return self._iter_history(
+            lambda page_cursor: self.payment_history(date_from = date_from, date_to = date_to, cursor = page_cursor),
+            cursor, max_pages, prefetch)
+
+    @staticmethod
+    def _iter_history(fetch_page, cursor, max_pages, prefetch):
+        executor = ThreadPoolExecutor(max_workers = 1) if prefetch else None
+        future = None
+        try:
+            page = fetch_page(cursor)
+            page_number = 1
+            while page.items:
+                cursor = page.paginate.nextCursor
+                has_next = cursor and ((max_pages is None) or (page_number < max_pages))
+                if has_next and executor:
+                    future = executor.submit(fetch_page, cursor)
+                items = page.items
+                page = None
+                for item in items:
+                    yield item
+                if not has_next:
+                    break
+                page = future.result() if future else fetch_page(cursor)
+                future = None
+                page_number += 1
+        finally:
+            if future:
+                future.cancel()
+            if executor:
+                executor.shutdown(wait = False)
@@ -0,0 +1,340 @@
+import asyncio
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .api import _CryptomusAPIBase, pyCryptomusAPIException, API_URL, _cached_copy
+from .bulk import run_bulk_async
+from .cache import CACHE_MISS, CACHE_FRESH, CACHE_STALE
+from .coalesce import AsyncSingleFlight
+from .cryto_types import PaymentsHistory, PayoutHistory
+from .validator import VALIDATED_KINDS
+
+
+class AsyncCryptomusAPI(_CryptomusAPIBase):
+    """
+    Cryptomus API asyncio client (requires aiohttp)
+
+    Has the same methods as pyCryptomusAPI, but API calls return awaitables.
+    """
+
+    def __init__(self,
+                 merchant_uuid, payment_api_key = None, payout_api_key = None,
+                 print_errors = False, timeout = None, add_request_params = None,
+                 api_url = API_URL, rate_limiter = None, retry_policy = None, cache = None,
+                 amount_type = float, lazy_amounts = False, json_codec = None, coalesce = False, validator = None,
+                 session = None, pool_maxsize = 100, pool_maxsize_per_host = 0, keep_alive = True):
+        """
+        Create the AsyncCryptomusAPI instance.
+
+        :param merchant_uuid: The merchant's uuid, which you can find in the merchant's personal account in the settings section.
+        :param payment_api_key: API key for processing payments
+        :param payout_api_key: API key for accepting payment and making payouts
+        :param print_errors: (Optional) Print dumps on request errors
+        :param timeout: (Optional) Request timeout
+        :param add_request_params: (List, Optional) Additional request parameters to pass with API calls
+        :param api_url: (Optional) Use custom API endpoint URL
+        :param rate_limiter: (RateLimiter, Optional) Limit request rate. Can be shared between clients.
+        :param retry_policy: (RetryPolicy, Optional) Retry calls on transient failures
+        :param cache: (ResponseCache, Optional) Cache results of payment_services and payout_services
+        :param amount_type: (Optional, default=float) Type of Invoice and Payout amounts: float or decimal.Decimal
+        :param lazy_amounts: (Optional, default=False) Keep Invoice and Payout amounts as received until first access
+        :param json_codec: (JsonCodec or String, Optional) JSON codec or its name ("json", "orjson", "ujson", "simplejson", "auto"). Default: json
+        :param coalesce: (Optional, default=False) Concurrent identical read-only calls (from different tasks) share one request and its result. Counters are in single_flight.stats
+        :param validator: (ServiceValidator, Optional) Reject create_invoice and create_payout locally if service is not available or amount is out of its limits
+        :param session: (Optional) Shared aiohttp.ClientSession to send requests with. It is not closed by close().
+        :param pool_maxsize: (Optional) Max number of simultaneous connections, other calls wait for a free one (ignored if session is passed)
+        :param pool_maxsize_per_host: (Optional) Max number of simultaneous connections per host, 0 - no limit (ignored if session is passed)
+        :param keep_alive: (Optional) Reuse connections between API calls (ignored if session is passed)
+        """
+        if aiohttp is None:
+            raise Exception("AsyncCryptomusAPI requires aiohttp. Install it with: pip install aiohttp")
+        super().__init__(
+            merchant_uuid, payment_api_key = payment_api_key, payout_api_key = payout_api_key,
+            print_errors = print_errors, timeout = timeout, add_request_params = add_request_params,
+            api_url = api_url, rate_limiter = rate_limiter, retry_policy = retry_policy, cache = cache,
+            amount_type = amount_type, lazy_amounts = lazy_amounts, json_codec = json_codec, validator = validator)
+        if coalesce:
+            self.single_flight = AsyncSingleFlight()
+        self.pool_maxsize = pool_maxsize
+        self.pool_maxsize_per_host = pool_maxsize_per_host
+        self.keep_alive = keep_alive
+        self.session = session
+        self.own_session = session is None
+        self._background_tasks = set()
+        self._services_loads = {}
+
+    def _get_session(self):
+        # ClientSession should be created inside the running event loop, so it's created on first call
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit = self.pool_maxsize, limit_per_host = self.pool_maxsize_per_host,
+                force_close = not self.keep_alive)
+            self.session = aiohttp.ClientSession(connector = connector)
+            self.own_session = True
+        return self.session
+
+    async def close(self):
+        """
+        Close pooled connections. Shared session passed to the constructor is left open.
+        """
+        if self.own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def __request(self, method_url, mode, **kwargs):
+        """
+        Send request to API, retrying it according to retry_policy
+
+        :param method_url: (String) API method url (part)
+        :param mode: (Int) Method mode (1: payment, 2: payout)
+        :param kwargs: request data
+        """
+        started = time.monotonic()
+        attempt = 1
+        while True:
+            try:
+                return await self.__send(method_url, mode, kwargs)
+            except pyCryptomusAPIException as pe:
+                if not self.retry_policy:
+                    raise pe
+                delay = self.retry_policy.next_delay(method_url, kwargs, pe, attempt, time.monotonic() - started)
+                if delay is None:
+                    raise pe
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def __send(self, method_url, mode, kwargs):
+        status = None
+        try:
+            url, body, headers = self._prepare_request(method_url, mode, kwargs)
+            timeout = aiohttp.ClientTimeout(total = self.timeout)
+            if self.rate_limiter:
+                delay = self.rate_limiter.reserve(mode)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            async with self._get_session().post(url, data = body, headers = headers, timeout = timeout) as base_resp:
+                status = base_resp.status
+                if self.rate_limiter:
+                    self.rate_limiter.on_response(mode, status, base_resp.headers.get("Retry-After"))
+                resp = self.json_codec.loads(await base_resp.read())
+        except ValueError as ve:
+            code = status if (status is not None and status < 400) else -2
+            self._raise_error(code, "Response decode failed: {}".format(ve), status_code = status)
+        except pyCryptomusAPIException as pe:
+            raise pe
+        except Exception as e:
+            code = status if (status is not None and status < 400) else -3
+            self._raise_error(code, "Request unknown exception: {}".format(e), status_code = status)
+        # noinspection PyUnboundLocalVariable
+        return self._process_response(resp, status)
+
+    async def _api_call(self, method_url, mode, parser = None, params = None):
+        key = self._flight_key(method_url, mode, params)
+        if key is not None:
+            return await self.single_flight.run(key, lambda: self.__call(method_url, mode, parser, params))
+        return await self.__call(method_url, mode, parser, params)
+
+    async def __call(self, method_url, mode, parser, params):
+        if params:
+            resp = (await self.__request(method_url, mode, **params)).get("result")
+        else:
+            resp = (await self.__request(method_url, mode)).get("result")
+        return parser(resp) if parser else resp
+
+    async def _cached_api_call(self, key, method_url, mode, parser = None, params = None):
+        if not (self.cache and self.cache.is_cached(key)):
+            return await self._api_call(method_url, mode, parser, params)
+        state, value = self.cache.lookup(key)
+        if state == CACHE_STALE and self.cache.begin_refresh(key):
+            task = asyncio.ensure_future(self.__refresh_cache(key, method_url, mode, parser, params))
+            # Keep reference until done, event loop holds only weak ones
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+        if state in (CACHE_FRESH, CACHE_STALE):
+            return _cached_copy(value)
+        version = self.cache.version(key)
+        value = await self._api_call(method_url, mode, parser, params)
+        self.cache.store(key, value, version)
+        return _cached_copy(value)
+
+    async def __refresh_cache(self, key, method_url, mode, parser, params):
+        version = self.cache.version(key)
+        try:
+            value = await self._api_call(method_url, mode, parser, params)
+        except Exception:
+            self.cache.end_refresh(key, failed = True)
+        else:
+            self.cache.end_refresh(key, value, version = version)
+
+    async def _validated_api_call(self, kind, method_url, mode, parser = None, params = None):
+        if self.validator:
+            state = self.validator.state(kind)
+            task = self._services_loads.get(kind)
+            if state != CACHE_FRESH and task is None and self.validator.begin_refresh(kind):
+                task = self._services_loads[kind] = asyncio.ensure_future(self.__load_services(kind))
+                task.add_done_callback(lambda _: self._services_loads.pop(kind, None))
+            if state == CACHE_MISS and task is not None:
+                # Calls made while services are loaded wait for them
+                await asyncio.shield(task)
+            self._validate(kind, params)
+        if kind == "payout":
+            return await self._balance_changing_call(method_url, mode, parser, params)
+        return await self._api_call(method_url, mode, parser, params)
+
+    async def __load_services(self, kind):
+        try:
+            services = await getattr(self, VALIDATED_KINDS[kind])()
+        except Exception:
+            self.validator.end_refresh(kind, failed = True)
+        else:
+            self.validator.end_refresh(kind, services)
+
+    async def _balance_changing_call(self, method_url, mode, parser = None, params = None):
+        try:
+            result = await self._api_call(method_url, mode, parser, params)
+        except Exception:
+            self._balance_changed()
+            raise
+        self._balance_changed(result)
+        return result
+
+    async def payment_history_filtered(
+            self,
+            date_from = None, date_to = None,
+            max_results = 15, max_pages = 10,
+            currencies = None, networks = None, addresses = None,
+            statuses = None, is_final = None, page_delay = None):
+        """
+        Payment history (advanced mode)
+
+        Same as pyCryptomusAPI.payment_history_filtered
+        """
+
+        result = PaymentsHistory()
+        page_delay = self._page_delay(page_delay)
+        currencies, networks, addresses, statuses = self._filter_sets(currencies, networks, addresses, statuses)
+
+        page_number = 0
+        cursor = None
+        while page_number < max_pages:
+            if page_number > 0 and page_delay: await asyncio.sleep(page_delay)
+            resp = await self.payment_history(date_from = date_from, date_to = date_to, cursor = cursor)
+
+            if not resp.items:
+                # No (more) payments
+                break
+
+            for payment in resp.items:
+                if not self._payment_matches(payment, currencies, networks, addresses, statuses, is_final):
+                    continue
+                result.items.append(payment)
+
+                if len(result.items) >= max_results:
+                    # Enough results collected
+                    break
+
+            if len(result.items) >= max_results:
+                # Enough results collected
+                break
+
+            cursor = resp.paginate.nextCursor
+            if not cursor:
+                # No more pages
+                break
+            page_number += 1
+
+        return result
+
+    async def create_invoices_bulk(self, invoices, max_workers = 100):
+        """
+        Create many invoices concurrently
+
+        Same as pyCryptomusAPI.create_invoices_bulk, but calls are run as coroutines.
+        Calls above pool_maxsize wait for a free connection.
+        """
+        return await run_bulk_async(self.create_invoice, invoices, max_workers)
+
+    async def payment_history_sharded(self, date_from, date_to, windows = None, max_workers = 4, page_delay = None):
+        """
+        Payment history for a date range, fetched in parallel
+
+        Same as pyCryptomusAPI.payment_history_sharded, but windows are walked as coroutines
+        """
+        return await self._history_sharded(
+            lambda window_from, window_to, cursor: self.payment_history(
+                date_from = window_from, date_to = window_to, cursor = cursor),
+            PaymentsHistory(), date_from, date_to, windows, max_workers, page_delay)
+
+    async def payout_history_sharded(self, date_from, date_to, windows = None, max_workers = 4, page_delay = None):
+        """
+        Payout history for a date range, fetched in parallel
+
+        Same as pyCryptomusAPI.payout_history_sharded, but windows are walked as coroutines
+        """
+        return await self._history_sharded(
+            lambda window_from, window_to, cursor: self.payout_history(
+                date_from = window_from, date_to = window_to, cursor = cursor),
+            PayoutHistory(), date_from, date_to, windows, max_workers, page_delay)
+
+    async def _history_sharded(self, fetch_page, result, date_from, date_to, windows, max_workers, page_delay):
+        page_delay = self._page_delay(page_delay)
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def walk(window):
+            async with semaphore:
+                items = []
+                cursor = None
+                while True:
+                    page = await fetch_page(window[0], window[1], cursor)
+                    items.extend(page.items)
+                    cursor = page.paginate.nextCursor
+                    if not (page.items and cursor):
+                        return items
+                    if page_delay:
+                        await asyncio.sleep(page_delay)
+
+        bounds = self._history_windows(date_from, date_to, windows or max_workers)
+        result.items = self._merge_windows(await asyncio.gather(*[walk(window) for window in bounds]))
+        return result
+
+    async def iter_payment_history(self, date_from = None, date_to = None, cursor = None, max_pages = None, prefetch = False):
+        """
+        Payment history iterator (async generator)
+
+        Same as pyCryptomusAPI.iter_payment_history. Use aclose() if iteration is stopped early.
+        """
+        task = None
+        try:
+            page = await self.payment_history(date_from = date_from, date_to = date_to, cursor = cursor)
+            page_number = 1
+            while page.items:
+                cursor = page.paginate.nextCursor
+                has_next = cursor and ((max_pages is None) or (page_number < max_pages))
+                if has_next and prefetch:
+                    task = asyncio.ensure_future(
+                        self.payment_history(date_from = date_from, date_to = date_to, cursor = cursor))
+                items = page.items
+                page = None
+                for item in items:
+                    yield item
+                if not has_next:
+                    break
+                if task:
+                    page = await task
+                else:
+                    page = await self.payment_history(date_from = date_from, date_to = date_to, cursor = cursor)
+                task = None
+                page_number += 1
+        finally:
+            if task:
+                task.cancel()
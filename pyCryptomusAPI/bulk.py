@@ -0,0 +1,81 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BulkResult:
+    """
+    Result of one item of a bulk call
+    """
+
+    def __init__(self, index, params, result = None, error = None):
+        """
+        :param index: (Int) Item position in the input
+        :param params: (Dict) Method parameters of the item
+        :param result: Method result, if call succeeded
+        :param error: (Exception) Call error, if call failed
+        """
+        self.index = index
+        self.params = params
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        return str({"index": self.index, "params": self.params, "result": str(self.result), "error": repr(self.error)})
+
+
+def _call_item(func, index, params):
+    try:
+        return BulkResult(index, params, result = func(**params))
+    except Exception as e:
+        return BulkResult(index, params, error = e)
+
+
+def run_bulk(func, params_iterable, max_workers):
+    """
+    Call func for every item of params_iterable in a thread pool
+
+    Input is consumed lazily: no more than 2 * max_workers items are queued at once.
+
+    :param func: (Callable) Function to call with item parameters as keyword arguments
+    :param params_iterable: (Iterable of Dicts) Parameters of items
+    :param max_workers: (Int) Max number of simultaneous calls
+    :return: (List of BulkResult) Results in input order
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        pending = deque()
+        for index, params in enumerate(params_iterable):
+            pending.append(executor.submit(_call_item, func, index, params))
+            if len(pending) >= 2 * max_workers:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
+
+async def run_bulk_async(coro_func, params_iterable, max_workers):
+    """
+    Await coro_func for every item of params_iterable with limited concurrency
+
+    :param coro_func: (Coroutine function) Function to call with item parameters as keyword arguments
+    :param params_iterable: (Iterable of Dicts) Parameters of items
+    :param max_workers: (Int) Max number of simultaneous calls
+    :return: (List of BulkResult) Results in input order
+    """
+    results = {}
+    items = enumerate(params_iterable)
+
+    async def worker():
+        for index, params in items:
+            try:
+                results[index] = BulkResult(index, params, result = await coro_func(**params))
+            except Exception as e:
+                results[index] = BulkResult(index, params, error = e)
+
+    await asyncio.gather(*[worker() for _ in range(max_workers)])
+    return [results[i] for i in range(len(results))]
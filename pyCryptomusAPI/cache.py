@@ -0,0 +1,137 @@
+import threading
+import time
+
+CACHE_MISS = 0
+CACHE_FRESH = 1
+CACHE_STALE = 2
+
+CACHEABLE_METHODS = ("payment_services", "payout_services")
+
+
+class ResponseCache:
+    """
+    TTL cache of parsed API results with stale-while-revalidate (thread-safe)
+
+    Fresh results are returned without API call. Results older than ttl but not older than ttl + stale_ttl
+    are returned as well, while one background call refreshes them.
+    """
+
+    def __init__(self, ttl = 300, stale_ttl = 0, balance_ttl = None):
+        """
+        :param ttl: (Float or Dict, Optional, default=300) Time to live (in seconds) for payment_services and payout_services, or dict {method name: ttl}
+        :param stale_ttl: (Float, Optional, default=0) Time (in seconds) after ttl when stale result is still returned while it's refreshed in background
+        :param balance_ttl: (Float, Optional) Time to live (in seconds) for balance. Balance is not cached if not set
+        """
+        if isinstance(ttl, dict):
+            self.ttl = dict(ttl)
+        else:
+            self.ttl = {method: ttl for method in CACHEABLE_METHODS}
+        if balance_ttl:
+            self.ttl["balance"] = balance_ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refresh_errors = 0
+        self.updates = 0
+        self._entries = {}
+        self._versions = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def is_cached(self, key):
+        """
+        :param key: (String) Client method name
+        """
+        return bool(self.ttl.get(key))
+
+    def lookup(self, key):
+        """
+        :param key: (String) Client method name
+        :return: (state, value), state is CACHE_MISS, CACHE_FRESH or CACHE_STALE
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = time.monotonic() - entry[1]
+                if age <= self.ttl[key]:
+                    self.hits += 1
+                    return CACHE_FRESH, entry[0]
+                if age <= self.ttl[key] + self.stale_ttl:
+                    self.stale_hits += 1
+                    return CACHE_STALE, entry[0]
+            self.misses += 1
+            return CACHE_MISS, None
+
+    def version(self, key):
+        """
+        :return: (Int) Version of the key, changed by invalidate and update. Pass it to store together with result
+            of API call started after this call, so result requested before invalidation is not stored
+        """
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def store(self, key, value, version = None):
+        with self._lock:
+            if version is None or version == self._versions.get(key, 0):
+                self._entries[key] = (value, time.monotonic())
+
+    def begin_refresh(self, key):
+        """
+        :return: (Bool) True if caller should refresh the key, False if it's already being refreshed
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key, value = None, failed = False, version = None):
+        with self._lock:
+            self._refreshing.discard(key)
+            if failed:
+                self.refresh_errors += 1
+            elif version is None or version == self._versions.get(key, 0):
+                self._entries[key] = (value, time.monotonic())
+
+    def update(self, key, func):
+        """
+        Replace cached result with func(result), keeping its age. Result is dropped if func returns None.
+
+        :param key: (String) Client method name
+        :param func: (Callable) Function of cached result
+        """
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            value = func(entry[0])
+            if value is None:
+                del self._entries[key]
+            else:
+                self._entries[key] = (value, entry[1])
+                self.updates += 1
+
+    def invalidate(self, key = None):
+        """
+        Drop cached result
+
+        :param key: (String, Optional) Client method name, all results are dropped if not set
+        """
+        with self._lock:
+            if key is None:
+                for cached in set(self._entries) | set(self.ttl):
+                    self._versions[cached] = self._versions.get(cached, 0) + 1
+                self._entries.clear()
+            else:
+                self._versions[key] = self._versions.get(key, 0) + 1
+                self._entries.pop(key, None)
+
+    @property
+    def stats(self):
+        """
+        Cache counters: fresh hits, stale hits, misses, failed background refreshes and local updates of cached results
+        """
+        return {"hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses,
+                "refresh_errors": self.refresh_errors, "updates": self.updates}
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+
+from .retry import RETRY_SAFETY, RETRY_SAFE
+
+
+def is_coalescable(method_url):
+    """
+    :param method_url: (String) API method url (part)
+    :return: (Bool) Method is read-only, so concurrent identical calls can share one request
+    """
+    return RETRY_SAFETY.get(method_url) == RETRY_SAFE
+
+
+class _FlightCounters:
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self.coalesced_by_method = {}
+
+    def _count_coalesced(self, key):
+        self.coalesced += 1
+        self.coalesced_by_method[key[0]] = self.coalesced_by_method.get(key[0], 0) + 1
+
+    @property
+    def stats(self):
+        """
+        Counters: requests sent, calls which waited for another identical call instead of sending a request,
+        and waited calls by API method
+        """
+        return {"calls": self.calls, "coalesced": self.coalesced,
+                "coalesced_by_method": dict(self.coalesced_by_method)}
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(_FlightCounters):
+    """
+    Coalescing of concurrent identical calls (thread-safe)
+
+    The first call with a key runs the function, calls with the same key started before it finishes
+    wait for it and get the same result (the same object) or the same exception.
+    Nothing is cached: call started after the first one finished runs the function again.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, func):
+        """
+        :param key: Hashable call key
+        :param func: (Callable) Function without arguments
+        :return: Result of func
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self._count_coalesced(key)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+
+class AsyncSingleFlight(_FlightCounters):
+    """
+    Coalescing of concurrent identical calls in the event loop
+
+    Same as SingleFlight for coroutines. Shared call runs as a task, so cancellation of one waiting caller
+    doesn't cancel it for the others.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._flights = {}
+
+    async def run(self, key, coro_func):
+        """
+        :param key: Hashable call key
+        :param coro_func: (Coroutine function) Function without arguments
+        :return: Result of coro_func
+        """
+        task = self._flights.get(key)
+        if task is None:
+            task = self._flights[key] = asyncio.ensure_future(coro_func())
+            task.add_done_callback(lambda done: self._landed(key, done))
+            self.calls += 1
+        else:
+            self._count_coalesced(key)
+        return await asyncio.shield(task)
+
+    def _landed(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
@@ -0,0 +1,163 @@
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_NAN = float("nan")
+
+
+class HistoryColumns:
+    """
+    Column-oriented history: one typed column per field
+
+    Amount and other numeric fields are float columns (None is NaN), is_final is bool column,
+    other fields are object columns. Columns are NumPy arrays if NumPy is installed,
+    else array.array("d") for float columns and lists for others.
+    pandas.DataFrame(columns.to_dict()) builds a frame without per-object conversion.
+    """
+
+    def __init__(self, columns, use_numpy):
+        """
+        :param columns: (Dict) {field: column}
+        :param use_numpy: (Bool) Columns are NumPy arrays
+        """
+        self.columns = columns
+        self.use_numpy = use_numpy
+        self._codes = {}
+
+    @classmethod
+    def build(cls, rows, spec, from_objects, use_numpy = None):
+        """
+        :param rows: (Iterable) Model objects or raw JSON dicts
+        :param spec: (Dict) {field: (JSON key, column type: float, bool or None)}
+        :param from_objects: (Bool) rows are model objects (else raw dicts)
+        :param use_numpy: (Bool, Optional) Build NumPy arrays. Default: if NumPy is installed
+        """
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ImportError("NumPy is not installed")
+        rows = rows if isinstance(rows, list) else list(rows)
+        columns = {}
+        for field, (key, kind) in spec.items():
+            if from_objects:
+                values = [getattr(row, field, None) for row in rows]
+            else:
+                values = [row.get(key) for row in rows]
+            columns[field] = _make_column(values, kind, use_numpy)
+        return cls(columns, use_numpy)
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __contains__(self, field):
+        return field in self.columns
+
+    @property
+    def fields(self):
+        return list(self.columns)
+
+    def to_dict(self):
+        """
+        :return: (Dict) {field: column}
+        """
+        return dict(self.columns)
+
+    def group_sum(self, value = "merchant_amount", by = "currency"):
+        """
+        Sum of numeric column grouped by one or several columns. NaN (None) values are skipped.
+
+        :param value: (String, Optional, default="merchant_amount") Numeric field to sum
+        :param by: (String or Tuple of Strings, Optional, default="currency") Field(s) to group by
+        :return: (Dict) {group value (tuple if several fields): sum}
+        """
+        groups, codes = self._group_codes(by)
+        column = self.columns[value]
+        if self.use_numpy:
+            weights = numpy.where(numpy.isnan(column), 0.0, column)
+            sums = numpy.bincount(codes, weights = weights, minlength = len(groups))
+            return {group: float(sums[i]) for i, group in enumerate(groups)}
+        sums = [0.0] * len(groups)
+        for code, amount in zip(codes, column):
+            if amount == amount:
+                sums[code] += amount
+        return dict(zip(groups, sums))
+
+    def group_count(self, by = "status"):
+        """
+        Number of rows grouped by one or several columns
+
+        :param by: (String or Tuple of Strings, Optional, default="status") Field(s) to group by
+        :return: (Dict) {group value (tuple if several fields): count}
+        """
+        groups, codes = self._group_codes(by)
+        if self.use_numpy:
+            counts = numpy.bincount(codes, minlength = len(groups))
+            return {group: int(counts[i]) for i, group in enumerate(groups)}
+        counts = [0] * len(groups)
+        for code in codes:
+            counts[code] += 1
+        return dict(zip(groups, counts))
+
+    def _group_codes(self, by):
+        """
+        :return: (groups, codes) Distinct group values and group number of every row
+        """
+        if isinstance(by, str):
+            return self._factorize(by)
+        groups, codes = self._factorize(by[0])
+        groups = [(group,) for group in groups]
+        for field in by[1:]:
+            field_groups, field_codes = self._factorize(field)
+            if self.use_numpy:
+                combined = codes * len(field_groups) + field_codes
+                present, codes = numpy.unique(combined, return_inverse = True)
+                codes = codes.reshape(-1)
+                groups = [groups[i // len(field_groups)] + (field_groups[i % len(field_groups)],) for i in present.tolist()]
+            else:
+                mapping = {}
+                combined = []
+                new_groups = []
+                for code, field_code in zip(codes, field_codes):
+                    key = (code, field_code)
+                    number = mapping.get(key)
+                    if number is None:
+                        number = mapping[key] = len(new_groups)
+                        new_groups.append(groups[code] + (field_groups[field_code],))
+                    combined.append(number)
+                groups, codes = new_groups, combined
+        return groups, codes
+
+    def _factorize(self, field):
+        result = self._codes.get(field)
+        if result is None:
+            mapping = {}
+            setdefault = mapping.setdefault
+            column = self.columns[field]
+            values = column.tolist() if self.use_numpy else column
+            codes = [setdefault(v, len(mapping)) for v in values]
+            if self.use_numpy:
+                codes = numpy.array(codes, dtype = numpy.intp)
+            result = self._codes[field] = (list(mapping), codes)
+        return result
+
+
+def _make_column(values, kind, use_numpy):
+    if kind is float:
+        values = [_NAN if v is None else float(v) for v in values]
+        return numpy.array(values, dtype = numpy.float64) if use_numpy else array("d", values)
+    if kind is bool:
+        values = [bool(v) for v in values]
+        return numpy.array(values, dtype = numpy.bool_) if use_numpy else values
+    if use_numpy:
+        column = numpy.empty(len(values), dtype = object)
+        column[:] = values
+        return column
+    return values
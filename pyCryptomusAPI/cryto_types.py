@@ -1,14 +1,38 @@
 import json
 from abc import ABC
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from .columns import HistoryColumns
+from .query import HistoryIndex
 
 CryptomusDateFormat = "%Y-%m-%d %H:%M:%S"
 
+
+def _parse_datetime(value):
+    """
+    Parses date returned by API ("2023-06-27T19:54:24+03:00" or "2023-06-27 19:54:24") into aware UTC datetime,
+    None if it's absent or not parsed. Dates without UTC offset are taken as UTC, so all parsed dates can be compared.
+    """
+    if not value:
+        return None
+    if isinstance(value, str) and value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        value = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo = timezone.utc)
+    return value.astimezone(timezone.utc)
+
 class Dictionaryable(ABC):
     """
     (c) Based on pyTelegramBotAPI (https://github.com/eternnoir/pyTelegramBotAPI) Dictionaryable
     Subclasses of this class are guaranteed to be able to be converted to dictionary.
     All subclasses of this class must override to_dict.
     """
+    __slots__ = ()
 
     def to_dict(self):
         """
@@ -26,6 +50,7 @@ class JsonSerializable(ABC):
     Subclasses of this class are guaranteed to be able to be converted to JSON format.
     All subclasses of this class must override to_json.
     """
+    __slots__ = ()
 
     def to_json(self):
         """
@@ -43,6 +68,7 @@ class JsonDeserializable(ABC):
     Subclasses of this class are guaranteed to be able to be created from a json-style dict or json formatted string.
     All subclasses of this class must override de_json.
     """
+    __slots__ = ()
 
     @classmethod
     def de_json(cls, json_dict, process_mode = 0):
@@ -67,7 +93,8 @@ class JsonDeserializable(ABC):
     def check_json(input_json, dict_copy=False):
         """
         Checks whether input_json is a dict or a string. If it is already a dict, it is returned as-is.
-        If it is not, it is converted to a dict by means of json.loads(json_type)
+        If it is not, it is converted to a dict by means of json.loads. Clients decode answers with their json_codec
+        before parsing, so this is used only for JSON passed to de_json directly.
 
         :param input_json: input json or parsed dict
         :param dict_copy: if dict is passed and it is changed outside
@@ -75,22 +102,30 @@ class JsonDeserializable(ABC):
         """
         if isinstance(input_json, dict):
             return input_json.copy() if dict_copy else input_json
-        elif isinstance(input_json, str):
+        elif isinstance(input_json, (str, bytes)):
             return json.loads(input_json)
         else:
             raise ValueError("input_json should be a json dict or string.")
 
+    def _fields_dict(self):
+        """
+        Returns a DICT with instance field values
+        """
+        return self.__dict__
+
     def __str__(self):
         # d = {
         #     x: y.__dict__ if hasattr(y, '__dict__') else y
         #     for x, y in self.__dict__.items()
         # }
         d = {}
-        for x, y in self.__dict__.items():
+        for x, y in self._fields_dict().items():
             if isinstance(y, list):
                 d[x] = [str(i) for i in y]
             elif isinstance(y, dict):
                 d[x] = {k:str(v) for k, v in y.items()}
+            elif isinstance(y, JsonDeserializable):
+                d[x] = y._fields_dict()
             elif hasattr(y, '__dict__'):
                 d[x] = y.__dict__
             else:
@@ -98,93 +133,326 @@ class JsonDeserializable(ABC):
         return str(d)
 
 
+class Amount:
+    """
+    Schema type of money amount fields. Amounts are converted to float or decimal.Decimal (amount_type),
+    either when parsed or, with lazy_amounts, on first access (raw string is kept until then).
+    """
+
+
+def _to_decimal(value):
+    return Decimal(repr(value)) if isinstance(value, float) else Decimal(value)
+
+
+def _amount_converter(amount_type):
+    return _to_decimal if amount_type is Decimal else amount_type
+
+
+class _DecimalText(str):
+    """
+    Raw amount kept by lazy_amounts with amount_type=Decimal: marks that it's converted to Decimal, not float
+    """
+    __slots__ = ()
+
+
+def _decimal_text(value):
+    return _DecimalText(repr(value) if isinstance(value, float) else value)
+
+
+class _LazyAmount:
+    """
+    Descriptor of Amount field: converts raw value stored in the slot on first access and caches the result.
+    Raw values are str or int from JSON (converted to float) or _DecimalText (converted to Decimal),
+    so amount type is not stored per instance.
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __get__(self, instance, owner = None):
+        if instance is None:
+            return self
+        value = self.slot.__get__(instance, owner)
+        kind = type(value)
+        if kind is _DecimalText:
+            value = Decimal(value)
+        elif kind is str or kind is int:
+            value = float(value)
+        else:
+            return value
+        self.slot.__set__(instance, value)
+        return value
+
+    def __set__(self, instance, value):
+        self.slot.__set__(instance, value)
+
+
 # noinspection PyMethodOverriding
-class BalanceItem(JsonDeserializable):
+class SlottedJsonDeserializable(JsonDeserializable):
+    """
+    JsonDeserializable with fields stored in __slots__ instead of instance __dict__.
+    Subclasses must list their fields in __slots__.
+    Fields returned by server but not listed in __slots__ are stored in "extra" dict and are still accessible as attributes.
+    The dict is created only if there are such fields, otherwise extra is None.
+
+    Field conversion is declared in _schema: {field name: type or Amount or model class or [model class]}.
+    Fields not in _schema are stored as is. Schema is compiled once per class and parsing mode into constructor.
+    """
+    __slots__ = ("extra",)
+    # Server field names stored under other names, e.g. reserved words: {"from": "from_"}
+    _aliases = {}
+    _schema = {}
+    # Column types of fields not in _schema for HistoryColumns: {field name: float or bool}
+    _column_types = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_names = tuple(
+            name
+            for klass in reversed(cls.__mro__)
+            for name in klass.__dict__.get("__slots__", ())
+            if not (name == "extra" or name.startswith("_")))
+        cls._field_set = frozenset(cls._field_names)
+        cls._amount_slots = {}
+        for name, kind in cls._schema.items():
+            if kind is Amount:
+                slot = cls.__dict__.get(name)
+                if slot is None:
+                    # Inherited field, already wrapped by base class
+                    slot = cls.__mro__[1]._amount_slots[name]
+                cls._amount_slots[name] = slot
+                setattr(cls, name, _LazyAmount(slot))
+        cls._constructors = {}
+        cls._from_dict = classmethod(cls._constructor())
+
     def __init__(self):
+        self.extra = None
+
+    @classmethod
+    def _constructor(cls, amount_type = float, lazy_amounts = False):
+        """
+        Returns constructor function(cls, json_dict) for the parsing mode
+        """
+        key = (amount_type, lazy_amounts)
+        constructor = cls._constructors.get(key)
+        if constructor is None:
+            constructor = cls._constructors[key] = _compile_schema(cls, amount_type, lazy_amounts)
+        return constructor
+
+    @classmethod
+    def de_json(cls, json_dict, amount_type = float, lazy_amounts = False):
+        """
+        Returns an instance of this class from the given json dict or string.
+
+        :param json_dict: The json dict from which to create the object.
+        :param amount_type: float or decimal.Decimal, type of Amount fields
+        :param lazy_amounts: Keep Amount fields raw until first access
+        """
+        return cls._constructor(amount_type, lazy_amounts)(cls, cls.check_json(json_dict))
+
+    @classmethod
+    def _column_spec(cls, fields = None):
+        """
+        Returns {field: (JSON key, column type)} for HistoryColumns
+        """
+        keys = {field: key for key, field in cls._aliases.items()}
+        spec = {}
+        for field in fields or cls._field_names:
+            kind = cls._schema.get(field)
+            if kind is Amount or kind is float or kind is int:
+                kind = float
+            else:
+                kind = cls._column_types.get(field)
+            spec[field] = (keys.get(field, field), kind)
+        return spec
+
+    def __getattr__(self, name):
+        # Called only for attributes not found in slots
+        if name in self._aliases:
+            return getattr(self, self._aliases[name])
+        if name != "extra":
+            extra = self.extra
+            if extra and name in extra:
+                return extra[name]
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+    def _fields_dict(self):
+        d = {name: getattr(self, name) for name in self._field_names}
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+
+def _compile_schema(cls, amount_type, lazy_amounts):
+    """
+    Generates constructor which fills all fields of cls from json dict according to cls._schema
+    """
+    keys = {field: field for field in cls._field_names}
+    for key, field in cls._aliases.items():
+        keys[field] = key
+    namespace = {"_new": object.__new__, "_known": frozenset(keys.values())}
+    lines = [
+        "def _from_dict(cls, data):",
+        "    self = _new(cls)",
+        "    get = data.get",
+    ]
+    for field in cls._field_names:
+        kind = cls._schema.get(field)
+        get = "get({!r})".format(keys[field])
+        name = "_t_" + field
+        if kind is None:
+            lines.append("    self.{} = {}".format(field, get))
+        elif kind is Amount:
+            # Write slot directly, bypassing _LazyAmount
+            namespace["_s_" + field] = cls._amount_slots[field].__set__
+            if lazy_amounts and amount_type is float:
+                lines.append("    _s_{}(self, {})".format(field, get))
+            elif lazy_amounts:
+                namespace[name] = _decimal_text
+                lines.append("    value = {}".format(get))
+                lines.append("    _s_{}(self, None if value is None else {}(value))".format(field, name))
+            else:
+                namespace[name] = _amount_converter(amount_type)
+                lines.append("    value = {}".format(get))
+                lines.append("    _s_{}(self, None if value is None else {}(value))".format(field, name))
+        elif isinstance(kind, list):
+            namespace[name] = kind[0]._constructor(amount_type, lazy_amounts)
+            lines.append("    value = {}".format(get))
+            lines.append("    self.{} = [] if value is None else [{}(_cls_{}, i) for i in value]".format(field, name, field))
+            namespace["_cls_" + field] = kind[0]
+        else:
+            if isinstance(kind, type) and issubclass(kind, SlottedJsonDeserializable):
+                namespace[name] = kind._constructor(amount_type, lazy_amounts)
+                namespace["_cls_" + field] = kind
+                convert = "{}(_cls_{}, value)".format(name, field)
+            else:
+                namespace[name] = kind
+                convert = "{}(value)".format(name)
+            lines.append("    value = {}".format(get))
+            lines.append("    self.{} = None if value is None else {}".format(field, convert))
+    lines += [
+        "    unknown = data.keys() - _known",
+        "    self.extra = {key: data[key] for key in unknown} if unknown else None",
+        "    return self",
+    ]
+    exec("\n".join(lines), namespace)
+    return namespace["_from_dict"]
+
+
+class BalanceItem(SlottedJsonDeserializable):
+    __slots__ = ("uuid", "balance", "currency_code", "balance_usd")
+    _schema = {"balance": float, "balance_usd": float}
+
+    def __init__(self):
+        super().__init__()
         self.uuid = None
         self.balance = None
         self.currency_code = None
+        self.balance_usd = None
 
-    @classmethod
-    def de_json(cls, json_dict):
-        data = cls.check_json(json_dict)
-        instance = super(BalanceItem, cls).de_json(data, process_mode=2)
-        instance.balance = float(instance.balance)
-        instance.balance_usd = float(instance.balance_usd)
-        return instance
 
+class Balance(SlottedJsonDeserializable):
+    __slots__ = ("merchant", "user", "_by_currency")
+    _schema = {"merchant": [BalanceItem], "user": [BalanceItem]}
+    _accounts = ("merchant", "user")
 
-# noinspection PyMethodOverriding
-class Balance(JsonDeserializable):
     def __init__(self):
+        super().__init__()
         self.merchant = []
         self.user = []
 
     @classmethod
-    def de_json(cls, json_dict):
+    def de_json(cls, json_dict, amount_type = float, lazy_amounts = False):
         data = cls.check_json(json_dict)
-        instance = super(Balance, cls).de_json(data, process_mode=1)
         data = data.get("balance")
         if not data:
             raise ValueError("Not a balance")
-        if "merchant" in data:
-            for item in data["merchant"]:
-                # noinspection PyUnresolvedReferences
-                instance.merchant.append(BalanceItem.de_json(item))
-        if "user" in data:
-            for item in data["user"]:
-                # noinspection PyUnresolvedReferences
-                instance.user.append(BalanceItem.de_json(item))
-        return instance
+        return cls._constructor(amount_type, lazy_amounts)(cls, data)
 
+    def by_currency(self, account = "merchant"):
+        """
+        Returns {currency code: BalanceItem} of merchant or user balances.
+        Dict is built on first call: merchant and user lists must not be changed after it.
+
+        :param account: (String, Optional, default="merchant") "merchant" or "user"
+        """
+        if account not in self._accounts:
+            raise ValueError("Unknown account: {}".format(account))
+        indexes = getattr(self, "_by_currency", None)
+        if indexes is None:
+            indexes = self._by_currency = {}
+        index = indexes.get(account)
+        if index is None:
+            index = indexes[account] = {item.currency_code: item for item in getattr(self, account)}
+        return index
+
+    def get(self, currency, account = "merchant"):
+        """
+        :param currency: (String) Currency code
+        :param account: (String, Optional, default="merchant") "merchant" or "user"
+        :return: (BalanceItem) Balance of the currency, None if there is no such one
+        """
+        return self.by_currency(account).get(currency)
+
+    def with_balance(self, currency, balance, account = "merchant"):
+        """
+        Returns copy of balance with new amount of the currency (balance_usd is scaled with it)
+
+        :param currency: (String) Currency code
+        :param balance: (Float) New amount
+        :param account: (String, Optional, default="merchant") "merchant" or "user"
+        :return: (Balance) New Balance, None if there is no such currency
+        """
+        old = self.get(currency, account)
+        if old is None:
+            return None
+        item = BalanceItem()
+        item.uuid = old.uuid
+        item.currency_code = old.currency_code
+        item.extra = old.extra
+        item.balance = balance
+        if old.balance and old.balance_usd is not None:
+            item.balance_usd = old.balance_usd * balance / old.balance
+        result = Balance()
+        result.extra = self.extra
+        result.merchant = self.merchant
+        result.user = self.user
+        setattr(result, account, [item if i is old else i for i in getattr(self, account)])
+        return result
+
+
+class ServiceLimit(SlottedJsonDeserializable):
+    __slots__ = ("min_amount", "max_amount")
+    _schema = {"min_amount": float, "max_amount": float}
 
-# noinspection PyMethodOverriding
-class ServiceLimit(JsonDeserializable):
     def __init__(self):
+        super().__init__()
         self.min_amount = None
         self.max_amount = None
 
-    @classmethod
-    def de_json(cls, json_dict):
-        data = cls.check_json(json_dict)
-        instance = super(ServiceLimit, cls).de_json(data, process_mode=2)
-        instance.min_amount = float(instance.min_amount)
-        instance.max_amount = float(instance.max_amount)
-        return instance
 
+class ServiceCommission(SlottedJsonDeserializable):
+    __slots__ = ("fee_amount", "percent")
+    _schema = {"fee_amount": float, "percent": float}
 
-# noinspection PyMethodOverriding
-class ServiceCommission(JsonDeserializable):
     def __init__(self):
+        super().__init__()
         self.fee_amount = None
         self.percent = None
 
-    @classmethod
-    def de_json(cls, json_dict):
-        data = cls.check_json(json_dict)
-        instance = super(ServiceCommission, cls).de_json(data, process_mode=2)
-        instance.fee_amount = float(instance.fee_amount)
-        instance.percent = float(instance.percent)
-        return instance
 
+class Service(SlottedJsonDeserializable):
+    __slots__ = ("network", "currency", "is_available", "limit", "commission")
+    _schema = {"limit": ServiceLimit, "commission": ServiceCommission}
 
-# noinspection PyMethodOverriding
-class Service(JsonDeserializable):
     def __init__(self):
+        super().__init__()
         self.network = None
         self.currency = None
         self.is_available = None
         self.limit = None
         self.commission = None
 
-    @classmethod
-    def de_json(cls, json_dict):
-        data = cls.check_json(json_dict)
-        instance = super(Service, cls).de_json(data, process_mode=2)
-        instance.limit = ServiceLimit.de_json(instance.limit)
-        instance.commission = ServiceCommission.de_json(instance.commission)
-        return instance
-
 
 # noinspection PyMethodOverriding
 class Currency(Dictionaryable, JsonDeserializable):
@@ -213,9 +481,21 @@ class Currency(Dictionaryable, JsonDeserializable):
         }
         return data
 
-# noinspection PyMethodOverriding
-class Invoice(JsonDeserializable):
+class Invoice(SlottedJsonDeserializable):
+    __slots__ = (
+        "uuid", "order_id", "amount", "payment_amount", "payer_amount", "discount_percent", "discount",
+        "payer_currency", "currency", "merchant_amount", "network", "address", "from_", "txid",
+        "payment_status", "url", "expired_at", "status", "is_final", "additional_data", "comments",
+        "created_at", "updated_at")
+    _aliases = {"from": "from_"}
+    _schema = {
+        "amount": Amount, "payment_amount": Amount, "payer_amount": Amount, "discount_percent": float,
+        "discount": Amount, "merchant_amount": Amount,
+    }
+    _column_types = {"is_final": bool}
+
     def __init__(self):
+        super().__init__()
         self.uuid = None
         self.order_id = None
         self.amount = None
@@ -233,33 +513,13 @@ class Invoice(JsonDeserializable):
         self.payment_status = None
         self.url = None
         self.expired_at = None
+        self.status = None
         self.is_final = None
         self.additional_data = None
+        self.comments = None
         self.created_at = None
         self.updated_at = None
 
-    @classmethod
-    def de_json(cls, json_dict):
-        data = cls.check_json(json_dict)
-        instance = super(Invoice, cls).de_json(data, process_mode=2)
-        if instance.amount is not None:
-            instance.amount = float(instance.amount)
-        if instance.payment_amount is not None:
-            instance.payment_amount = float(instance.payment_amount)
-        if instance.payer_amount is not None:
-            instance.payer_amount = float(instance.payer_amount)
-        if instance.discount_percent is not None:
-            instance.discount_percent = float(instance.discount_percent)
-        if instance.discount is not None:
-            instance.discount = float(instance.discount)
-        if instance.merchant_amount is not None:
-            instance.merchant_amount = float(instance.merchant_amount)
-        # if instance.created_at is not None:
-        #     instance.created_at = datetime.datetime.strptime(instance.created_at, CryptomusDateFormat)
-        # if instance.updated_at is not None:
-        #     instance.updated_at = datetime.datetime.strptime(instance.updated_at, CryptomusDateFormat)
-        return instance
-
 # noinspection PyMethodOverriding
 class Wallet(JsonDeserializable):
     def __init__(self):
@@ -275,40 +535,75 @@ class Wallet(JsonDeserializable):
         instance = super(Wallet, cls).de_json(data, process_mode=2)
         return instance
 
-# noinspection PyMethodOverriding
-class PaymentPaginate(JsonDeserializable):
+class PaymentPaginate(SlottedJsonDeserializable):
+    __slots__ = ("count", "hasPages", "nextCursor", "previousCursor", "perPage")
+    _schema = {"count": int, "perPage": int}
+
     def __init__(self):
+        super().__init__()
         self.count = None
         self.hasPages = None
         self.nextCursor = None
         self.previousCursor = None
         self.perPage = None
 
+class _HistoryMixin:
+    __slots__ = ()
+
+    def index(self, rebuild = False):
+        """
+        Returns HistoryIndex over items for fast repeated filtering, group-by and sums.
+        Index is built once and rebuilt if items were added, removed or replaced (or items list was replaced).
+        Index is a snapshot of item fields: pass rebuild=True after changing fields of items.
+
+        :param rebuild: (Bool, Optional, default=False) Build new index anyway
+        """
+        index = getattr(self, "_index", None)
+        if rebuild or index is None or not index.same_items(self.items):
+            index = self._index = HistoryIndex(self.items)
+        return index
+
+    def to_columns(self, fields = None, use_numpy = None):
+        """
+        Returns HistoryColumns of items
+
+        :param fields: (List of Strings, Optional) Fields to export. Default: all model fields
+        :param use_numpy: (Bool, Optional) Build NumPy arrays. Default: if NumPy is installed
+        """
+        model = self._schema["items"][0]
+        return HistoryColumns.build(self.items, model._column_spec(fields), True, use_numpy)
+
     @classmethod
-    def de_json(cls, json_dict):
-        data = cls.check_json(json_dict)
-        instance = super(PaymentPaginate, cls).de_json(data, process_mode=2)
-        instance.count = int(instance.count)
-        instance.perPage = int(instance.perPage)
-        return instance
+    def columns_from_pages(cls, pages, fields = None, use_numpy = None):
+        """
+        Returns HistoryColumns built from raw history pages, without creating Invoice or Payout objects
+
+        :param pages: (Iterable) Raw pages ("result" of payment/list or payout/list): dicts or JSON strings
+        :param fields: (List of Strings, Optional) Fields to export. Default: all model fields
+        :param use_numpy: (Bool, Optional) Build NumPy arrays. Default: if NumPy is installed
+        """
+        model = cls._schema["items"][0]
+        rows = [item for page in pages for item in (cls.check_json(page).get("items") or [])]
+        return HistoryColumns.build(rows, model._column_spec(fields), False, use_numpy)
+
+class PaymentsHistory(_HistoryMixin, SlottedJsonDeserializable):
+    __slots__ = ("items", "paginate", "_index")
+    _schema = {"items": [Invoice], "paginate": PaymentPaginate}
 
-# noinspection PyMethodOverriding
-class PaymentsHistory(JsonDeserializable):
     def __init__(self):
+        super().__init__()
         self.items = []
         self.paginate = PaymentPaginate()
 
-    @classmethod
-    def de_json(cls, json_dict):
-        data = cls.check_json(json_dict)
-        instance = super(PaymentsHistory, cls).de_json(data, process_mode=2)
-        instance.items = [Invoice.de_json(i) for i in instance.items]
-        instance.paginate = PaymentPaginate.de_json(instance.paginate)
-        return instance
+class Payout(SlottedJsonDeserializable):
+    __slots__ = (
+        "uuid", "amount", "currency", "network", "address", "txid", "status", "is_final", "balance",
+        "payer_currency", "payer_amount")
+    _schema = {"amount": Amount, "balance": Amount, "payer_amount": Amount}
+    _column_types = {"is_final": bool}
 
-# noinspection PyMethodOverriding
-class Payout(JsonDeserializable):
     def __init__(self):
+        super().__init__()
         self.uuid = None
         self.amount = None
         self.currency = None
@@ -321,28 +616,11 @@ class Payout(JsonDeserializable):
         self.payer_currency = None
         self.payer_amount = None
 
-    @classmethod
-    def de_json(cls, json_dict):
-        data = cls.check_json(json_dict)
-        instance = super(Payout, cls).de_json(data, process_mode=2)
-        if instance.amount is not None:
-            instance.amount = float(instance.amount)
-        if instance.payer_amount is not None:
-            instance.payer_amount = float(instance.payer_amount)
-        if instance.balance is not None:
-            instance.balance = float(instance.balance)
-        return instance
+class PayoutHistory(_HistoryMixin, SlottedJsonDeserializable):
+    __slots__ = ("items", "paginate", "_index")
+    _schema = {"items": [Payout], "paginate": PaymentPaginate}
 
-# noinspection PyMethodOverriding
-class PayoutHistory(JsonDeserializable):
     def __init__(self):
+        super().__init__()
         self.items = []
         self.paginate = PaymentPaginate()
-
-    @classmethod
-    def de_json(cls, json_dict):
-        data = cls.check_json(json_dict)
-        instance = super(PayoutHistory, cls).de_json(data, process_mode=2)
-        instance.items = [Payout.de_json(i) for i in instance.items]
-        instance.paginate = PaymentPaginate.de_json(instance.paginate)
-        return instance
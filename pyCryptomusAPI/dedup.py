@@ -0,0 +1,136 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from .cryto_types import _parse_datetime
+
+
+def _timestamp(value):
+    """
+    Converts updated_at ("2023-06-27T19:54:24+03:00") to POSIX timestamp, None if it's absent or not parsed
+    """
+    value = _parse_datetime(value)
+    return value.timestamp() if value else None
+
+
+def _is_stale(state, is_final, updated_at):
+    """
+    :param state: (Tuple) Last accepted (status, is_final, updated_at) of the object
+    :return: (Bool) True if webhook is older than last accepted one
+    """
+    _, last_final, last_updated_at = state
+    if updated_at is not None and last_updated_at is not None and updated_at != last_updated_at:
+        return updated_at < last_updated_at
+    # Without timestamps: nothing comes after final status
+    return bool(last_final) and not is_final
+
+
+class WebhookDeduplicator:
+    """
+    Drops repeated and out-of-order webhooks (thread-safe)
+
+    Webhook is a duplicate if webhook with the same uuid and status was already accepted.
+    It's stale if it's older (by updated_at) than last accepted webhook of the same uuid, or if that webhook
+    had final status and this one has not (e.g. "check" after "paid").
+    Last max_size objects are kept in memory (LRU). With db_path all accepted webhooks are also stored
+    in SQLite, so duplicates are detected after restart and beyond the memory window.
+    """
+
+    def __init__(self, max_size = 100000, db_path = None):
+        """
+        :param max_size: (Int, Optional, default=100000) Max number of (uuid, status) pairs and uuids kept in memory
+        :param db_path: (String, Optional) Path of SQLite database file
+        """
+        self.max_size = max_size
+        self.db_path = db_path
+        self.accepted = 0
+        self.duplicates = 0
+        self.stale = 0
+        self._seen = OrderedDict()
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread = False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_seen (uuid TEXT NOT NULL, status TEXT NOT NULL, "
+                "PRIMARY KEY (uuid, status)) WITHOUT ROWID")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_state (uuid TEXT PRIMARY KEY, status TEXT, "
+                "is_final INTEGER, updated_at REAL)")
+            self._db.commit()
+
+    def accept(self, webhook):
+        """
+        Check webhook and remember it if it's new
+
+        :param webhook: (Invoice or Payout) Parsed webhook
+        :return: (Bool) True if webhook should be processed, False if it's a duplicate or stale
+        """
+        uuid = webhook.uuid
+        key = (uuid, webhook.status)
+        is_final = bool(webhook.is_final)
+        updated_at = _timestamp(getattr(webhook, "updated_at", None))
+        with self._lock:
+            if self._is_seen(key):
+                self.duplicates += 1
+                return False
+            state = self._state(uuid)
+            if state is not None and _is_stale(state, is_final, updated_at):
+                self.stale += 1
+                return False
+            self._remember(key, (webhook.status, is_final, updated_at))
+            self.accepted += 1
+            return True
+
+    def _is_seen(self, key):
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return True
+        if self._db is not None and self._db.execute(
+                "SELECT 1 FROM webhook_seen WHERE uuid = ? AND status = ?", key).fetchone():
+            self._put(self._seen, key, None)
+            return True
+        return False
+
+    def _state(self, uuid):
+        state = self._states.get(uuid)
+        if state is not None:
+            self._states.move_to_end(uuid)
+        elif self._db is not None:
+            row = self._db.execute(
+                "SELECT status, is_final, updated_at FROM webhook_state WHERE uuid = ?", (uuid,)).fetchone()
+            if row:
+                state = (row[0], bool(row[1]), row[2])
+                self._put(self._states, uuid, state)
+        return state
+
+    def _remember(self, key, state):
+        self._put(self._seen, key, None)
+        self._put(self._states, key[0], state)
+        if self._db is not None:
+            with self._db:
+                self._db.execute("INSERT OR IGNORE INTO webhook_seen (uuid, status) VALUES (?, ?)", key)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO webhook_state (uuid, status, is_final, updated_at) VALUES (?, ?, ?, ?)",
+                    (key[0], state[0], int(state[1]), state[2]))
+
+    def _put(self, lru, key, value):
+        lru[key] = value
+        lru.move_to_end(key)
+        if len(lru) > self.max_size:
+            lru.popitem(last = False)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @property
+    def stats(self):
+        """
+        Deduplicator counters: accepted, duplicate and stale webhooks
+        """
+        return {"accepted": self.accepted, "duplicates": self.duplicates, "stale": self.stale}
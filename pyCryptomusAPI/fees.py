@@ -0,0 +1,193 @@
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_INF = float("inf")
+_NAN = float("nan")
+
+
+class FeeEstimates:
+    """
+    Cheapest network and its fee for every row of estimate(). Rows without eligible network have
+    network None and fee NaN. fees is NumPy array if NumPy was used, else array.array("d").
+    """
+
+    def __init__(self, networks, fees, use_numpy):
+        """
+        :param networks: (List) Network code of every row
+        :param fees: (Array) Fee of every row
+        :param use_numpy: (Bool) fees is NumPy array
+        """
+        self.networks = networks
+        self.fees = fees
+        self.use_numpy = use_numpy
+
+    def __len__(self):
+        return len(self.networks)
+
+    def __getitem__(self, i):
+        return self.networks[i], float(self.fees[i])
+
+    def __iter__(self):
+        for i in range(len(self.networks)):
+            yield self[i]
+
+    def to_dict(self):
+        """
+        :return: (Dict) {"network": networks, "fee": fees}
+        """
+        return {"network": self.networks, "fee": self.fees}
+
+
+class PayoutFeeEstimator:
+    """
+    Payout fee estimation from payout_services() commissions
+
+    Fee of a network is commission.fee_amount + amount * commission.percent / 100. Network is eligible if it's available
+    and amount is within its limits. Rows of every currency are estimated for all its networks at once
+    (with NumPy, if it's installed).
+    """
+
+    def __init__(self, services):
+        """
+        :param services: (List of Service) Result of payout_services()
+        """
+        # currency: (networks, fee amounts, percents, min amounts, max amounts) of available networks
+        self._tables = {}
+        by_currency = {}
+        for service in services:
+            if service.is_available is False:
+                continue
+            by_currency.setdefault(service.currency, []).append(service)
+        for currency, currency_services in by_currency.items():
+            table = ([], [], [], [], [])
+            for service in currency_services:
+                commission = service.commission
+                limit = service.limit
+                table[0].append(service.network)
+                table[1].append(_number(commission.fee_amount if commission else None, 0.0))
+                table[2].append(_number(commission.percent if commission else None, 0.0))
+                table[3].append(_number(limit.min_amount if limit else None, -_INF))
+                table[4].append(_number(limit.max_amount if limit else None, _INF))
+            self._tables[currency] = table
+        self._arrays = {}
+
+    @classmethod
+    def from_client(cls, client):
+        """
+        :param client: (pyCryptomusAPI) Client with PAYOUT API key. Use client cache to avoid services request on every call.
+            For AsyncCryptomusAPI use PayoutFeeEstimator(await client.payout_services())
+        """
+        return cls(client.payout_services())
+
+    @property
+    def currencies(self):
+        return list(self._tables)
+
+    def network_fees(self, amount, currency, networks = None):
+        """
+        Fees of all eligible networks
+
+        :param amount: (Float or String) Payout amount
+        :param currency: (String) Currency code
+        :param networks: (Iterable of Strings, Optional) Allowed networks. Default: all
+        :return: (Dict) {network: fee}
+        """
+        table = self._tables.get(currency)
+        if table is None:
+            return {}
+        amount = float(amount)
+        allowed = set(networks) if networks is not None else None
+        return {
+            network: fee_amount + amount * percent / 100
+            for network, fee_amount, percent, min_amount, max_amount in zip(*table)
+            if min_amount <= amount <= max_amount and (allowed is None or network in allowed)}
+
+    def estimate(self, amounts, currencies, networks = None, use_numpy = None):
+        """
+        Cheapest eligible network for every payout
+
+        :param amounts: (Iterable of Floats or Strings) Payout amounts
+        :param currencies: (Iterable of Strings or String) Currency of every payout, or one currency for all
+        :param networks: (Iterable of Strings, Optional) Allowed networks. Default: all
+        :param use_numpy: (Bool, Optional) Use NumPy. Default: if NumPy is installed
+        :return: (FeeEstimates) Network and fee of every payout
+        """
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ImportError("NumPy is not installed")
+        amounts = [float(amount) for amount in amounts]
+        if isinstance(currencies, str):
+            rows = {currencies: range(len(amounts))}
+        else:
+            rows = {}
+            for i, currency in enumerate(currencies):
+                rows.setdefault(currency, []).append(i)
+        allowed = frozenset(networks) if networks is not None else None
+
+        result_networks = [None] * len(amounts)
+        if use_numpy:
+            result_fees = numpy.full(len(amounts), _NAN)
+            all_amounts = numpy.array(amounts, dtype = numpy.float64)
+        else:
+            result_fees = array("d", [_NAN]) * len(amounts)
+        for currency, positions in rows.items():
+            table = self._tables.get(currency)
+            if table is None:
+                continue
+            if use_numpy:
+                self._estimate_numpy(currency, table, all_amounts, positions, allowed, result_networks, result_fees)
+            else:
+                self._estimate_python(table, amounts, positions, allowed, result_networks, result_fees)
+        return FeeEstimates(result_networks, result_fees, use_numpy)
+
+    def _estimate_numpy(self, currency, table, all_amounts, positions, allowed, result_networks, result_fees):
+        key = (currency, allowed)
+        arrays = self._arrays.get(key)
+        if arrays is None:
+            keep = [allowed is None or network in allowed for network in table[0]]
+            names = numpy.array([n for n, k in zip(table[0], keep) if k] + [None], dtype = object)
+            arrays = self._arrays[key] = (names,) + tuple(
+                numpy.array([v for v, k in zip(column, keep) if k], dtype = numpy.float64) for column in table[1:])
+        names, fee_amounts, percents, min_amounts, max_amounts = arrays
+        if not len(fee_amounts):
+            return
+        positions = numpy.asarray(positions, dtype = numpy.intp)
+        amounts = all_amounts[positions][:, None]
+        # rows x networks
+        fees = fee_amounts + amounts * percents / 100
+        fees[~((amounts >= min_amounts) & (amounts <= max_amounts))] = _INF
+        best = fees.argmin(axis = 1)
+        best_fees = fees[numpy.arange(len(positions)), best]
+        eligible = best_fees != _INF
+        # Rows without eligible network get None (last name)
+        best[~eligible] = len(fee_amounts)
+        result_fees[positions[eligible]] = best_fees[eligible]
+        for position, network in zip(positions.tolist(), names[best].tolist()):
+            result_networks[position] = network
+
+    @staticmethod
+    def _estimate_python(table, amounts, positions, allowed, result_networks, result_fees):
+        candidates = [
+            row for row in zip(*table) if allowed is None or row[0] in allowed]
+        for i in positions:
+            amount = amounts[i]
+            best_network = None
+            best_fee = _INF
+            for network, fee_amount, percent, min_amount, max_amount in candidates:
+                if min_amount <= amount <= max_amount:
+                    fee = fee_amount + amount * percent / 100
+                    if fee < best_fee:
+                        best_network = network
+                        best_fee = fee
+            if best_network is not None:
+                result_networks[i] = best_network
+                result_fees[i] = best_fee
+
+
+def _number(value, default):
+    return default if value is None else float(value)
@@ -0,0 +1,71 @@
+import json
+
+
+class JsonCodec:
+    """
+    JSON encoder and decoder used by the client
+
+    Encoded request body is signed, so dumps must produce exactly the same output as json.dumps with
+    default settings (", " and ": " separators, non-ascii characters escaped).
+    Third-party codecs that format JSON differently are used only for decoding.
+    """
+
+    def __init__(self, name, loads, dumps = None):
+        """
+        :param name: (String) Codec name
+        :param loads: (Callable) Decoder of str or bytes. Must raise ValueError on invalid input.
+        :param dumps: (Callable, Optional) Encoder to str, same output as json.dumps. Default: json.dumps
+        """
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps or json.dumps
+
+    def __repr__(self):
+        return "JsonCodec({!r})".format(self.name)
+
+
+STDLIB_JSON_CODEC = JsonCodec("json", json.loads)
+
+
+def _orjson_codec():
+    import orjson
+    return JsonCodec("orjson", orjson.loads)
+
+
+def _ujson_codec():
+    import ujson
+    return JsonCodec("ujson", ujson.loads)
+
+
+def _simplejson_codec():
+    import simplejson
+    # simplejson.dumps defaults match json.dumps
+    return JsonCodec("simplejson", simplejson.loads, simplejson.dumps)
+
+
+_CODEC_FACTORIES = {
+    "orjson": _orjson_codec,
+    "ujson": _ujson_codec,
+    "simplejson": _simplejson_codec,
+}
+
+
+def get_json_codec(name = "json"):
+    """
+    Get JSON codec by name
+
+    :param name: (String) "json" (stdlib), "orjson", "ujson", "simplejson", or "auto" for the fastest installed one
+    :return: (JsonCodec)
+    """
+    if name == "json":
+        return STDLIB_JSON_CODEC
+    if name == "auto":
+        for factory in _CODEC_FACTORIES.values():
+            try:
+                return factory()
+            except ImportError:
+                continue
+        return STDLIB_JSON_CODEC
+    if name not in _CODEC_FACTORIES:
+        raise ValueError("Unknown JSON codec: {}".format(name))
+    return _CODEC_FACTORIES[name]()
@@ -0,0 +1,179 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from time import sleep
+
+from .cryto_types import CryptomusDateFormat, Invoice, Payout, _parse_datetime
+
+# kind: (table, API method, mode, model)
+MIRROR_KINDS = {
+    "payments": ("payments", "payment/list", 1, Invoice),
+    "payouts": ("payouts", "payout/list", 2, Payout),
+}
+MIRROR_INDEXED_COLUMNS = ("order_id", "status", "currency", "network", "address", "created_at", "updated_at")
+
+
+class HistoryMirror:
+    """
+    Local SQLite copy of payment and payout history
+
+    First sync copies all history (or history since given date). Next syncs request only items created after
+    the newest stored one (minus overlap) and items that were not final yet, so their new status is stored too:
+    history is filtered by creation date only, so the refetch window starts at the oldest stored non-final item,
+    but not earlier than max_lookback before the newest one. Progress is checkpointed after every page,
+    interrupted sync continues from the last stored cursor.
+    Items are stored by uuid with indexed columns and full item JSON.
+    """
+
+    def __init__(self, client, db_path, overlap = timedelta(minutes = 10), max_lookback = timedelta(days = 7),
+                 page_delay = None):
+        """
+        :param client: (pyCryptomusAPI) Client with PAYMENT API key (payments) and/or PAYOUT API key (payouts)
+        :param db_path: (String) Path of SQLite database file
+        :param overlap: (timedelta, Optional, default=10 minutes) Items created this time before the newest stored one are requested again
+        :param max_lookback: (timedelta, Optional, default=7 days) Non-final items older than this (from the newest stored one) are not refreshed anymore
+        :param page_delay: (Float, Optional) Delay between page requests in seconds. Default: 1, or 0 if client has rate_limiter
+        """
+        self.client = client
+        self.db_path = db_path
+        self.overlap = overlap
+        self.max_lookback = max_lookback
+        self.page_delay = page_delay
+        self.db = sqlite3.connect(db_path, check_same_thread = False)
+        # _lock guards the connection, it's held only for DB access, not while pages are requested.
+        # _sync_lock makes concurrent syncs wait for each other.
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            for table, _, _, _ in MIRROR_KINDS.values():
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS {} (uuid TEXT PRIMARY KEY, order_id TEXT, status TEXT, "
+                    "is_final INTEGER, currency TEXT, network TEXT, address TEXT, amount TEXT, "
+                    "created_at TEXT, updated_at TEXT, data TEXT NOT NULL)".format(table))
+                for column in MIRROR_INDEXED_COLUMNS:
+                    self.db.execute("CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})".format(table, column))
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS mirror_state (kind TEXT PRIMARY KEY, date_from TEXT, cursor TEXT, "
+                "synced_at TEXT)")
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def sync(self, payments = True, payouts = True, since = None):
+        """
+        Fetch new and changed items
+
+        :param payments: (Bool, Optional, default=True) Sync payments (requires PAYMENT API key)
+        :param payouts: (Bool, Optional, default=True) Sync payouts (requires PAYOUT API key)
+        :param since: (datetime, Optional) Start date of the first sync. Default: all history
+        :return: (Dict) Number of fetched items by kind
+        """
+        result = {}
+        with self._sync_lock:
+            if payments:
+                result["payments"] = self._sync("payments", since)
+            if payouts:
+                result["payouts"] = self._sync("payouts", since)
+        return result
+
+    def _sync(self, kind, since):
+        table, method_url, mode, _ = MIRROR_KINDS[kind]
+        with self._lock:
+            state = self.db.execute("SELECT date_from, cursor FROM mirror_state WHERE kind = ?", (kind,)).fetchone()
+            if state and state[1]:
+                # Continue interrupted sync
+                date_from = datetime.strptime(state[0], CryptomusDateFormat) if state[0] else None
+                cursor = state[1]
+            else:
+                date_from = self._window_start(table) or since
+                cursor = None
+        stored_from = date_from.strftime(CryptomusDateFormat) if date_from else None
+
+        count = 0
+        while True:
+            page = self.client._api_call(method_url, mode, params = self.client._history_params(date_from, None, cursor))
+            items = page.get("items") or []
+            cursor = (page.get("paginate") or {}).get("nextCursor") if items else None
+            with self._lock, self.db:
+                self._store(table, items)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO mirror_state (kind, date_from, cursor, synced_at) VALUES (?, ?, ?, ?)",
+                    (kind, stored_from, cursor, datetime.now().strftime(CryptomusDateFormat)))
+            count += len(items)
+            if not cursor:
+                return count
+            delay = self.client._page_delay(self.page_delay)
+            if delay:
+                sleep(delay)
+
+    def _window_start(self, table):
+        """
+        :return: (datetime) Creation date to request items from, None if nothing is stored yet
+        """
+        row = self.db.execute("SELECT created_at FROM {} ORDER BY created_at DESC LIMIT 1".format(table)).fetchone()
+        newest = _parse_datetime(row[0]) if row else None
+        if newest is None:
+            return None
+        start = newest - self.overlap
+        oldest_allowed = newest - self.max_lookback
+        for (created_at,) in self.db.execute("SELECT created_at FROM {} WHERE is_final = 0".format(table)):
+            created_at = _parse_datetime(created_at)
+            if created_at is not None and oldest_allowed <= created_at < start:
+                start = created_at
+        return start
+
+    def _store(self, table, items):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO {} (uuid, order_id, status, is_final, currency, network, address, amount, "
+            "created_at, updated_at, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(table),
+            [(i.get("uuid"), i.get("order_id"), i.get("status"), int(bool(i.get("is_final"))), i.get("currency"),
+              i.get("network"), i.get("address"), None if i.get("amount") is None else str(i["amount"]),
+              i.get("created_at"), i.get("updated_at"), json.dumps(i)) for i in items])
+
+    def query(self, kind = "payments", limit = None, **filters):
+        """
+        Stored items
+
+        :param kind: (String, Optional, default="payments") "payments" or "payouts"
+        :param limit: (Int, Optional) Max number of items
+        :param filters: Column filters: uuid, order_id, status, is_final, currency, network, address (value or list of values),
+            created_from, created_to (creation date range, same format as API returns)
+        :return: (List of Invoice or Payout) Items, newest first
+        """
+        table, _, _, model = MIRROR_KINDS[kind]
+        where = []
+        args = []
+        created_from = filters.pop("created_from", None)
+        created_to = filters.pop("created_to", None)
+        if created_from:
+            where.append("created_at >= ?")
+            args.append(created_from)
+        if created_to:
+            where.append("created_at <= ?")
+            args.append(created_to)
+        for column, value in filters.items():
+            if column not in MIRROR_INDEXED_COLUMNS + ("uuid", "is_final"):
+                raise ValueError("Unknown filter: {}".format(column))
+            if column == "is_final":
+                value = int(bool(value))
+            if isinstance(value, (list, tuple, set, frozenset)):
+                value = list(value)
+                where.append("{} IN ({})".format(column, ", ".join("?" * len(value))))
+                args.extend(value)
+            else:
+                where.append("{} = ?".format(column))
+                args.append(value)
+        sql = "SELECT data FROM {}".format(table)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at DESC"
+        if limit:
+            sql += " LIMIT {:d}".format(limit)
+        parser = self.client._parser(model)
+        with self._lock:
+            rows = self.db.execute(sql, args).fetchall()
+        loads = self.client.json_codec.loads
+        return [parser(loads(data)) for (data,) in rows]
@@ -0,0 +1,165 @@
+import inspect
+import json
+import os
+import re
+import threading
+
+from .api import pyCryptomusAPI, pyCryptomusAPIException
+from .bulk import run_bulk
+from .rate_limiter import TokenBucket
+
+PAYOUT_REQUIRED_PARAMS = ("amount", "currency", "order_id", "address", "is_subtract", "network")
+PAYOUT_PARAMS = tuple(inspect.signature(pyCryptomusAPI.create_payout).parameters)[1:]
+ORDER_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,100}$")
+
+
+class PayoutBatchSummary:
+    """
+    Result of PayoutBatch run
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+        self.skipped = []
+
+    @property
+    def total(self):
+        return len(self.succeeded) + len(self.failed) + len(self.skipped)
+
+    def __str__(self):
+        return str({
+            "total": self.total,
+            "succeeded": len(self.succeeded),
+            "failed": {i.params["order_id"]: str(i.error) for i in self.failed},
+            "skipped": len(self.skipped),
+        })
+
+
+class PayoutBatch:
+    """
+    Bulk payout execution
+
+    Payout specs are validated before any payout is sent, then executed concurrently.
+    Completed order_ids are appended to the checkpoint file, so a repeated run with the same file
+    skips them and only sends the rest. Failed payouts are not checkpointed and are sent again on the next run:
+    server does not create a duplicate payout for the same order_id.
+    """
+
+    def __init__(self, client, payouts, max_workers = 4, rate = None, checkpoint_path = None):
+        """
+        :param client: (pyCryptomusAPI) Client with PAYOUT API key
+        :param payouts: (Iterable of Dicts) create_payout parameters for every payout
+        :param max_workers: (Int, Optional, default=4) Max number of simultaneous requests
+        :param rate: (Float, Optional) Max number of payouts per second
+        :param checkpoint_path: (String, Optional) Path of checkpoint file (JSON lines)
+        """
+        self.client = client
+        self.payouts = list(payouts)
+        self.max_workers = max_workers
+        self.rate = rate
+        self.checkpoint_path = checkpoint_path
+        self._bucket = TokenBucket(rate) if rate else None
+        self._checkpoint_lock = threading.Lock()
+
+    def validate(self):
+        """
+        Check payout specs: required and unknown parameters, amount, order_id format and uniqueness
+
+        :return: (List of Strings) Errors, empty if all specs are valid
+        """
+        errors = []
+        order_ids = set()
+        for index, spec in enumerate(self.payouts):
+            prefix = "Payout #{}".format(index)
+            missing = [i for i in PAYOUT_REQUIRED_PARAMS if spec.get(i) is None]
+            if missing:
+                errors.append("{}: missing {}".format(prefix, ", ".join(missing)))
+            unknown = [i for i in spec if i not in PAYOUT_PARAMS]
+            if unknown:
+                errors.append("{}: unknown {}".format(prefix, ", ".join(unknown)))
+            if spec.get("amount") is not None:
+                try:
+                    if float(spec["amount"]) <= 0:
+                        errors.append("{}: amount should be positive".format(prefix))
+                except (TypeError, ValueError):
+                    errors.append("{}: amount is not a number".format(prefix))
+            order_id = spec.get("order_id")
+            if order_id is not None:
+                order_id = str(order_id)
+                if not ORDER_ID_RE.match(order_id):
+                    errors.append("{}: order_id should be 1..100 letters, digits, underscores or dashes".format(prefix))
+                elif order_id in order_ids:
+                    errors.append("{}: duplicate order_id {}".format(prefix, order_id))
+                order_ids.add(order_id)
+        return errors
+
+    def load_checkpoint(self):
+        """
+        :return: (Set of Strings) order_ids completed in previous runs
+        """
+        done = set()
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding = "utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        done.add(json.loads(line)["order_id"])
+                    except (ValueError, KeyError):
+                        # Last line may be cut if previous run crashed while writing it
+                        continue
+        return done
+
+    def _open_checkpoint(self):
+        cut_line = False
+        if os.path.exists(self.checkpoint_path) and os.path.getsize(self.checkpoint_path) > 0:
+            with open(self.checkpoint_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                cut_line = f.read(1) != b"\n"
+        checkpoint = open(self.checkpoint_path, "a", encoding = "utf-8")
+        if cut_line:
+            # Terminate line cut by crash
+            checkpoint.write("\n")
+        return checkpoint
+
+    def _send(self, checkpoint, **spec):
+        if self._bucket:
+            self._bucket.acquire()
+        payout = self.client.create_payout(**spec)
+        if checkpoint:
+            line = json.dumps({"order_id": str(spec["order_id"]), "uuid": payout.uuid, "status": payout.status})
+            with self._checkpoint_lock:
+                checkpoint.write(line + "\n")
+                checkpoint.flush()
+        return payout
+
+    def run(self):
+        """
+        Validate and execute payouts
+
+        :return: (PayoutBatchSummary) Succeeded and failed items (BulkResult with Payout as result) and skipped order_ids
+        """
+        errors = self.validate()
+        if errors:
+            raise pyCryptomusAPIException(0, "Invalid payouts: {}".format("; ".join(errors)))
+
+        summary = PayoutBatchSummary()
+        done = self.load_checkpoint()
+        pending = []
+        for spec in self.payouts:
+            if str(spec["order_id"]) in done:
+                summary.skipped.append(str(spec["order_id"]))
+            else:
+                pending.append(spec)
+
+        checkpoint = self._open_checkpoint() if self.checkpoint_path else None
+        try:
+            results = run_bulk(lambda **spec: self._send(checkpoint, **spec), pending, self.max_workers)
+        finally:
+            if checkpoint:
+                checkpoint.close()
+        for item in results:
+            (summary.succeeded if item.ok else summary.failed).append(item)
+        return summary
@@ -0,0 +1,159 @@
+import operator
+
+INDEXED_FIELDS = ("currency", "network", "address", "status", "is_final", "order_id")
+
+
+class HistoryIndex:
+    """
+    Hash indexes over history items (Invoice or Payout) for repeated filtering and aggregation
+
+    Every indexed field maps value to positions of items with it, so filter selects matching items
+    without scanning all of them. Filter values can be a single value or a set (list, tuple) of accepted values.
+    Index is a snapshot of item fields and aggregation results are cached: items must not be changed after index is built.
+    """
+
+    def __init__(self, items):
+        """
+        :param items: (List of Invoice or Payout) History items
+        """
+        self.items = list(items)
+        self._indexes = {field: {} for field in INDEXED_FIELDS}
+        for field, index in self._indexes.items():
+            for position, item in enumerate(self.items):
+                value = getattr(item, field, None)
+                positions = index.get(value)
+                if positions is None:
+                    index[value] = [position]
+                else:
+                    positions.append(position)
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def same_items(self, items):
+        """
+        :param items: (List of Invoice or Payout) History items
+        :return: (Bool) True if index was built over the same item objects in the same order
+        """
+        return len(items) == len(self.items) and all(map(operator.is_, items, self.items))
+
+    def values(self, field):
+        """
+        :param field: (String) Indexed field
+        :return: (List) Distinct values of the field
+        """
+        return list(self._index(field))
+
+    def filter(self, **filters):
+        """
+        Items matching all filters
+
+        :param filters: Indexed field filters: currency, network, address, status, is_final, order_id (value or set of values)
+        :return: (List of Invoice or Payout) Items in original order
+        """
+        return [self.items[i] for i in self._positions(filters)]
+
+    def count(self, **filters):
+        """
+        :return: (Int) Number of items matching all filters
+        """
+        return len(self._positions(filters))
+
+    def group_by(self, field, **filters):
+        """
+        Number of items by field value
+
+        :param field: (String) Indexed field to group by
+        :param filters: Indexed field filters
+        :return: (Dict) {field value: number of items}
+        """
+        key = ("group_by", field, self._filters_key(filters))
+        result = self._cache.get(key)
+        if result is None:
+            index = self._index(field)
+            if not filters:
+                result = {value: len(positions) for value, positions in index.items()}
+            else:
+                result = {}
+                for i in self._positions(filters):
+                    value = getattr(self.items[i], field, None)
+                    result[value] = result.get(value, 0) + 1
+            self._cache[key] = result
+        return dict(result)
+
+    def sum(self, field = "amount", by = None, **filters):
+        """
+        Sum of item field
+
+        :param field: (String, Optional, default="amount") Field to sum (any numeric field, e.g. merchant_amount)
+        :param by: (String, Optional) Indexed field to group sums by
+        :param filters: Indexed field filters
+        :return: Sum (float or Decimal, depends on amount_type), or {by value: sum} if by is set. None values are skipped.
+        """
+        key = ("sum", field, by, self._filters_key(filters))
+        result = self._cache.get(key)
+        if result is None:
+            if by is None:
+                result = self._sum(field, self._positions(filters))
+            elif not filters:
+                result = {value: self._sum(field, positions) for value, positions in self._index(by).items()}
+            else:
+                self._index(by)
+                groups = {}
+                for i in self._positions(filters):
+                    groups.setdefault(getattr(self.items[i], by, None), []).append(i)
+                result = {value: self._sum(field, positions) for value, positions in groups.items()}
+            self._cache[key] = result
+        return dict(result) if isinstance(result, dict) else result
+
+    def _sum(self, field, positions):
+        total = 0
+        items = self.items
+        for i in positions:
+            value = getattr(items[i], field)
+            if value is not None:
+                total = total + value
+        return total
+
+    def _index(self, field):
+        index = self._indexes.get(field)
+        if index is None:
+            raise ValueError("Field is not indexed: {}".format(field))
+        return index
+
+    @staticmethod
+    def _filters_key(filters):
+        return tuple(sorted(
+            (field, frozenset(value) if isinstance(value, (set, frozenset, list, tuple)) else value)
+            for field, value in filters.items()))
+
+    def _positions(self, filters):
+        """
+        :return: Sorted positions of matching items
+        """
+        if not filters:
+            return range(len(self.items))
+        if len(filters) == 1:
+            (field, value), = filters.items()
+            if not isinstance(value, (set, frozenset, list, tuple)):
+                return self._index(field).get(value, [])
+        # Intersect position sets starting from the smallest one
+        matching = None
+        for positions in sorted((self._position_set(field, value) for field, value in filters.items()), key = len):
+            matching = positions if matching is None else matching & positions
+            if not matching:
+                return []
+        return sorted(matching)
+
+    def _position_set(self, field, value):
+        key = ("positions", field, frozenset(value) if isinstance(value, (set, frozenset, list, tuple)) else value)
+        positions = self._cache.get(key)
+        if positions is None:
+            index = self._index(field)
+            if isinstance(value, (set, frozenset, list, tuple)):
+                positions = frozenset(i for v in set(value) for i in index.get(v, ()))
+            else:
+                positions = frozenset(index.get(value, ()))
+            self._cache[key] = positions
+        return positions
@@ -0,0 +1,148 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket with adaptive rate (thread-safe)
+
+    Rate is decreased multiplicatively when the server answers with 429/5xx
+    and restored additively after successful responses.
+    """
+
+    def __init__(self, rate, burst = 1, min_rate = None, decrease_factor = 0.5, increase_step = None):
+        """
+        :param rate: (Float) Max (and initial) number of requests per second
+        :param burst: (Int, Optional, default=1) Number of requests that can be sent at once after idle time
+        :param min_rate: (Float, Optional) Rate is never decreased below this value. Default: 5% of rate
+        :param decrease_factor: (Float, Optional, default=0.5) Rate multiplier on 429/5xx answer
+        :param increase_step: (Float, Optional) Rate increment on successful answer. Default: 5% of rate
+        """
+        if rate <= 0:
+            raise ValueError("rate should be positive")
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+        self.min_rate = float(min_rate) if min_rate else self.max_rate * 0.05
+        self.decrease_factor = decrease_factor
+        self.increase_step = float(increase_step) if increase_step else self.max_rate * 0.05
+        self.throttled = 0
+        self.waited = 0.0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """
+        Take a token from the bucket
+
+        :return: (Float) Delay (in seconds) the caller should wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            delay = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            if self._blocked_until > now + delay:
+                delay = self._blocked_until - now
+            self.waited += delay
+            return delay
+
+    def acquire(self):
+        """
+        Take a token from the bucket, sleeping if needed
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_response(self, status_code, retry_after = None):
+        """
+        Adapt rate to the server answer
+
+        :param status_code: (Int) HTTP status code
+        :param retry_after: (Float, Optional) Seconds to pause sending, if server provided it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if status_code == 429 or status_code >= 500:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self.throttled += 1
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, now + retry_after)
+            elif self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+
+class RateLimiter:
+    """
+    Client-wide rate limiter with separate token buckets for payment and payout API keys
+
+    Can be shared by several clients (sync and async) to keep their total rate under the limit.
+    """
+
+    groups = {1: "payment", 2: "payout"}
+
+    def __init__(self, payment_rate = 5, payout_rate = 5, burst = 1, min_rate = None,
+                 decrease_factor = 0.5, increase_step = None):
+        """
+        :param payment_rate: (Float, Optional, default=5) Max requests per second with PAYMENT API key
+        :param payout_rate: (Float, Optional, default=5) Max requests per second with PAYOUT API key
+        :param burst: (Int, Optional, default=1) Number of requests that can be sent at once after idle time
+        :param min_rate: (Float, Optional) Rate is never decreased below this value. Default: 5% of rate
+        :param decrease_factor: (Float, Optional, default=0.5) Rate multiplier on 429/5xx answer
+        :param increase_step: (Float, Optional) Rate increment on successful answer. Default: 5% of rate
+        """
+        self.buckets = {
+            1: TokenBucket(payment_rate, burst, min_rate, decrease_factor, increase_step),
+            2: TokenBucket(payout_rate, burst, min_rate, decrease_factor, increase_step),
+        }
+
+    def reserve(self, mode):
+        """
+        :param mode: (Int) Method mode (1: payment, 2: payout)
+        :return: (Float) Delay (in seconds) the caller should wait before sending the request
+        """
+        return self.buckets[mode].reserve()
+
+    def acquire(self, mode):
+        """
+        :param mode: (Int) Method mode (1: payment, 2: payout)
+        """
+        self.buckets[mode].acquire()
+
+    def on_response(self, mode, status_code, retry_after = None):
+        """
+        :param mode: (Int) Method mode (1: payment, 2: payout)
+        :param status_code: (Int) HTTP status code
+        :param retry_after: (String or Float, Optional) Retry-After header value
+        """
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            # HTTP-date form is not supported
+            retry_after = None
+        self.buckets[mode].on_response(status_code, retry_after)
+
+    @property
+    def current_rates(self):
+        """
+        Current allowed rate (requests per second) by group: {"payment": ..., "payout": ...}
+        """
+        return {self.groups[mode]: bucket.rate for mode, bucket in self.buckets.items()}
+
+    @property
+    def stats(self):
+        """
+        Rate limiter state by group: current rate, number of throttled answers and total wait time
+        """
+        return {
+            self.groups[mode]: {"rate": bucket.rate, "throttled": bucket.throttled, "waited": bucket.waited}
+            for mode, bucket in self.buckets.items()
+        }
@@ -0,0 +1,169 @@
+"""
+Offline replay of captured webhooks
+
+Reads JSON lines file with raw webhook bodies (one per line), verifies and parses them in a process pool
+and writes them to valid.jsonl, invalid.jsonl, duplicate.jsonl and stale.jsonl in the output directory.
+
+    python -m pyCryptomusAPI.replay webhooks.jsonl --out-dir replayed
+
+API keys are taken from --payment-api-key / --payout-api-key or CRYPTOMUS_PAYMENT_API_KEY / CRYPTOMUS_PAYOUT_API_KEY.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .api import pyCryptomusAPI, pyCryptomusAPIException
+from .dedup import WebhookDeduplicator
+from .webhook import WebhookVerifier
+
+# Fields of parsed webhook needed for deduplication
+WebhookKey = namedtuple("WebhookKey", ("uuid", "status", "is_final", "updated_at"))
+
+_verifier = None
+
+
+def _init_worker(merchant_uuid, payment_api_key, payout_api_key, json_codec):
+    global _verifier
+    client = pyCryptomusAPI(
+        merchant_uuid, payment_api_key = payment_api_key, payout_api_key = payout_api_key, json_codec = json_codec)
+    _verifier = WebhookVerifier(client)
+
+
+def _verify_chunk(chunk):
+    """
+    :param chunk: (List) (line number, raw body) pairs
+    :return: (List) (line number, WebhookKey or None, error or None) for every line
+    """
+    results = []
+    for line_no, body in chunk:
+        try:
+            webhook = _verifier.parse(body)
+            key = WebhookKey(webhook.uuid, webhook.status, webhook.is_final, getattr(webhook, "updated_at", None))
+            results.append((line_no, key, None))
+        except pyCryptomusAPIException as pe:
+            results.append((line_no, None, pe.message))
+        except Exception as e:
+            results.append((line_no, None, "Parse failed: {}".format(e)))
+    return results
+
+
+def _read_chunks(f, chunk_size):
+    chunk = []
+    for line_no, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        chunk.append((line_no, line))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def replay(f, out_dir, merchant_uuid, payment_api_key = None, payout_api_key = None,
+           workers = None, chunk_size = 1000, json_codec = "json", dedup = None):
+    """
+    Verify, parse and sort captured webhooks
+
+    :param f: (Binary file) JSON lines with raw webhook bodies
+    :param out_dir: (String) Output directory
+    :param merchant_uuid: (String) Merchant UUID
+    :param payment_api_key: (String, Optional) PAYMENT API key (payment and wallet webhooks)
+    :param payout_api_key: (String, Optional) PAYOUT API key (payout webhooks)
+    :param workers: (Int, Optional) Number of processes, 0 to verify in current process. Default: number of CPUs
+    :param chunk_size: (Int, Optional, default=1000) Number of lines sent to process at once
+    :param json_codec: (String, Optional, default="json") JSON codec name
+    :param dedup: (WebhookDeduplicator, Optional) Deduplicator, new in-memory one if not set
+    :return: (Dict) Number of lines of every output
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if dedup is None:
+        dedup = WebhookDeduplicator()
+    init_args = (merchant_uuid, payment_api_key, payout_api_key, json_codec)
+    counts = {"valid": 0, "invalid": 0, "duplicate": 0, "stale": 0}
+    os.makedirs(out_dir, exist_ok = True)
+    outputs = {name: open(os.path.join(out_dir, name + ".jsonl"), "wb") for name in counts}
+    try:
+        def write(chunk, results):
+            for (line_no, body), (_, key, error) in zip(chunk, results):
+                if key is None:
+                    name = "invalid"
+                    body = json.dumps({"line": line_no, "error": error,
+                                       "body": body.decode("utf-8", "replace")}).encode("utf-8")
+                else:
+                    duplicates = dedup.duplicates
+                    if dedup.accept(key):
+                        name = "valid"
+                    else:
+                        name = "duplicate" if dedup.duplicates > duplicates else "stale"
+                counts[name] += 1
+                outputs[name].write(body + b"\n")
+
+        chunks = _read_chunks(f, chunk_size)
+        if workers <= 0:
+            _init_worker(*init_args)
+            for chunk in chunks:
+                write(chunk, _verify_chunk(chunk))
+        else:
+            with ProcessPoolExecutor(workers, initializer = _init_worker, initargs = init_args) as executor:
+                # Results are written in input order, so no more than 2 * workers chunks are kept in memory
+                pending = deque()
+                for chunk in chunks:
+                    pending.append((chunk, executor.submit(_verify_chunk, chunk)))
+                    if len(pending) >= 2 * workers:
+                        chunk, future = pending.popleft()
+                        write(chunk, future.result())
+                while pending:
+                    chunk, future = pending.popleft()
+                    write(chunk, future.result())
+    finally:
+        for output in outputs.values():
+            output.close()
+    return counts
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog = "python -m pyCryptomusAPI.replay", description = "Verify and sort captured Cryptomus webhooks")
+    parser.add_argument("input", help = "JSON lines file with raw webhook bodies, - for stdin")
+    parser.add_argument("--out-dir", default = "replay", help = "Output directory (default: replay)")
+    parser.add_argument("--merchant-uuid", default = os.environ.get("CRYPTOMUS_MERCHANT_UUID", "-"),
+                        help = "Merchant UUID (not used in webhook sign)")
+    parser.add_argument("--payment-api-key", default = os.environ.get("CRYPTOMUS_PAYMENT_API_KEY"))
+    parser.add_argument("--payout-api-key", default = os.environ.get("CRYPTOMUS_PAYOUT_API_KEY"))
+    parser.add_argument("--workers", type = int, default = None, help = "Number of processes (default: number of CPUs)")
+    parser.add_argument("--chunk-size", type = int, default = 1000, help = "Lines per task (default: 1000)")
+    parser.add_argument("--json-codec", default = "json", help = "json, orjson, ujson, simplejson or auto")
+    parser.add_argument("--dedup-db", default = None, help = "SQLite file to keep deduplication state between runs")
+    args = parser.parse_args(argv)
+    if not (args.payment_api_key or args.payout_api_key):
+        parser.error("payment or payout API key is required")
+
+    dedup = WebhookDeduplicator(db_path = args.dedup_db)
+    started = time.monotonic()
+    try:
+        if args.input == "-":
+            counts = replay(sys.stdin.buffer, args.out_dir, args.merchant_uuid, args.payment_api_key,
+                            args.payout_api_key, args.workers, args.chunk_size, args.json_codec, dedup)
+        else:
+            with open(args.input, "rb") as f:
+                counts = replay(f, args.out_dir, args.merchant_uuid, args.payment_api_key,
+                                args.payout_api_key, args.workers, args.chunk_size, args.json_codec, dedup)
+    finally:
+        dedup.close()
+    elapsed = time.monotonic() - started
+    total = sum(counts.values())
+    print("{} webhooks in {:.1f}s ({:.0f}/s): {}".format(
+        total, elapsed, total / elapsed if elapsed else 0, ", ".join("{} {}".format(v, k) for k, v in counts.items())),
+        file = sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import random
+import threading
+
+# Method is read-only and can always be repeated
+RETRY_SAFE = "safe"
+# Method can be repeated because server deduplicates it by order_id
+RETRY_IDEMPOTENT = "idempotent"
+# Repeating the method may change state twice
+RETRY_UNSAFE = "unsafe"
+
+RETRY_SAFETY = {
+    "payment": RETRY_IDEMPOTENT,
+    "wallet": RETRY_IDEMPOTENT,
+    "payout": RETRY_IDEMPOTENT,
+    "wallet/block-address": RETRY_UNSAFE,
+    "wallet/blocked-address-refund": RETRY_UNSAFE,
+    "payment/refund": RETRY_UNSAFE,
+    "payment/info": RETRY_SAFE,
+    "payment/list": RETRY_SAFE,
+    "payment/services": RETRY_SAFE,
+    "payout/info": RETRY_SAFE,
+    "payout/list": RETRY_SAFE,
+    "payout/services": RETRY_SAFE,
+    "balance": RETRY_SAFE,
+}
+
+
+class RetryPolicy:
+    """
+    Retry policy for transient API failures: exponential backoff with full jitter and total deadline
+
+    Only network errors and answers with retry_statuses are retried. Methods are retried according to
+    RETRY_SAFETY: read-only methods always, create_invoice/create_wallet/create_payout only when
+    order_id is passed (server returns existing object for known order_id), others never.
+    """
+
+    def __init__(self, max_attempts = 3, backoff = 0.5, max_backoff = 8, deadline = None,
+                 retry_statuses = (429, 500, 502, 503, 504)):
+        """
+        :param max_attempts: (Int, Optional, default=3) Max number of attempts per call, including the first one
+        :param backoff: (Float, Optional, default=0.5) Base delay (in seconds), doubled on every retry
+        :param max_backoff: (Float, Optional, default=8) Max delay between attempts (in seconds)
+        :param deadline: (Float, Optional) Max total time of the call including retries (in seconds)
+        :param retry_statuses: (Tuple of Ints, Optional) HTTP statuses to retry
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.retry_statuses = retry_statuses
+        self.retries = 0
+        self.gave_up = 0
+        self.retries_by_method = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_retry_safe(method_url, params):
+        """
+        :param method_url: (String) API method url (part)
+        :param params: (Dict) request data
+        """
+        safety = RETRY_SAFETY.get(method_url, RETRY_UNSAFE)
+        if safety == RETRY_IDEMPOTENT:
+            return bool(params and params.get("order_id"))
+        return safety == RETRY_SAFE
+
+    def is_transient(self, error):
+        """
+        :param error: (pyCryptomusAPIException) Failed call error
+        """
+        if error.status_code is None:
+            # No response: connection error or timeout
+            return error.code == -3
+        return error.status_code in self.retry_statuses
+
+    def next_delay(self, method_url, params, error, attempt, elapsed):
+        """
+        Check if failed call should be retried
+
+        :param method_url: (String) API method url (part)
+        :param params: (Dict) request data
+        :param error: (pyCryptomusAPIException) Failed call error
+        :param attempt: (Int) Number of attempts made
+        :param elapsed: (Float) Time spent on the call (in seconds)
+        :return: Delay before next attempt (in seconds) or None if error should be raised
+        """
+        if not (self.is_transient(error) and self.is_retry_safe(method_url, params)):
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** (attempt - 1))))
+        with self._lock:
+            if attempt >= self.max_attempts or (self.deadline is not None and elapsed + delay > self.deadline):
+                self.gave_up += 1
+                return None
+            self.retries += 1
+            self.retries_by_method[method_url] = self.retries_by_method.get(method_url, 0) + 1
+        return delay
+
+    @property
+    def stats(self):
+        """
+        Retry counters: total retries, calls failed after retries and retries by method
+        """
+        with self._lock:
+            return {"retries": self.retries, "gave_up": self.gave_up, "by_method": dict(self.retries_by_method)}
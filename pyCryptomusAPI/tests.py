@@ -1,10 +1,37 @@
+import asyncio
 import inspect
+import json
 import uuid
-from time import sleep
+from datetime import datetime, timedelta, timezone
+from time import sleep, monotonic
+
+import pytest
+
 try:
-    from pyCryptomusAPI import pyCryptomusAPI, pyCryptomusAPIException
+    from pyCryptomusAPI import pyCryptomusAPI, AsyncCryptomusAPI, pyCryptomusAPIException, Signer, API_URL
+    from pyCryptomusAPI import WebhookApp, AsyncWebhookApp, WebhookVerifier, webhook_sign_payload, WebhookDeduplicator, Invoice
+    from pyCryptomusAPI import HistoryMirror, TokenBucket, RateLimiter, RetryPolicy, PayoutBatch, run_bulk, run_bulk_async
+    from pyCryptomusAPI import ResponseCache, CACHE_MISS, JsonCodec, get_json_codec
+    from pyCryptomusAPI import InvoiceWatcher, AsyncInvoiceWatcher, ServiceValidator, PayoutFeeEstimator
+    from pyCryptomusAPI.cryto_types import Balance, PaymentsHistory, Service
+    from pyCryptomusAPI.replay import replay, main as replay_main
 except:
-    from api import pyCryptomusAPI, pyCryptomusAPIException
+    from api import pyCryptomusAPI, pyCryptomusAPIException, Signer, API_URL
+    from async_api import AsyncCryptomusAPI
+    from webhook import WebhookApp, AsyncWebhookApp, WebhookVerifier, webhook_sign_payload
+    from dedup import WebhookDeduplicator
+    from cryto_types import Invoice, Balance, PaymentsHistory, Service
+    from mirror import HistoryMirror
+    from rate_limiter import TokenBucket, RateLimiter
+    from retry import RetryPolicy
+    from payout_batch import PayoutBatch
+    from bulk import run_bulk, run_bulk_async
+    from cache import ResponseCache, CACHE_MISS
+    from json_codec import JsonCodec, get_json_codec
+    from watcher import InvoiceWatcher, AsyncInvoiceWatcher
+    from validator import ServiceValidator
+    from fees import PayoutFeeEstimator
+    from replay import replay, main as replay_main
 
 try:
     from private_keys import *
@@ -31,6 +58,82 @@ def run_and_print(f):
         raise e
     return None
 
+class _StubResponse:
+    def __init__(self, status_code, answer, headers = None):
+        self.status_code = status_code
+        self.content = answer if isinstance(answer, bytes) else json.dumps(answer).encode()
+        self.headers = headers or {}
+
+    def __bool__(self):
+        # Same as requests.Response
+        return self.status_code < 400
+
+
+class _StubSession:
+    """
+    Offline session: answer(method_url, data) returns (status, JSON object or bytes) or raises connection error
+    """
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = []
+        self.signs = []
+
+    def post(self, url, data = None, headers = None, timeout = None):
+        method_url = url[len(API_URL):]
+        self.calls.append(method_url)
+        self.signs.append(headers["sign"])
+        return _StubResponse(*self.answer(method_url, json.loads(data) if data else {}))
+
+
+def _ok(result):
+    return 200, {"state": 0, "result": result}
+
+
+def _offline_client(answer, **kwargs):
+    return pyCryptomusAPI("merchant", payment_api_key = "payment_key", payout_api_key = "payout_key",
+                          session = _StubSession(answer), **kwargs)
+
+
+def _wait_for(condition, timeout = 2):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline
+        sleep(0.01)
+
+
+def _services_answer(services):
+    def answer(method_url, data):
+        return _ok([dict(service) for service in services])
+    return answer
+
+
+_PAYOUT_SERVICES = [
+    {"network": "tron", "currency": "USDT", "is_available": True, "limit": {"min_amount": "10", "max_amount": "100"},
+     "commission": {"fee_amount": "1", "percent": "1"}},
+    {"network": "bsc", "currency": "USDT", "is_available": True, "limit": {"min_amount": "1", "max_amount": "1000"},
+     "commission": {"fee_amount": "0.3", "percent": "0.5"}},
+    {"network": "eth", "currency": "USDT", "is_available": False, "limit": {"min_amount": "1", "max_amount": "100000"},
+     "commission": {"fee_amount": "5", "percent": "0"}},
+    {"network": "btc", "currency": "BTC", "is_available": True, "limit": {"min_amount": "0.001", "max_amount": "10"},
+     "commission": {"fee_amount": "0.0001", "percent": "0"}},
+]
+
+
+def _history_page(cursor, pages = 3, per_page = 2):
+    page = int(cursor or 0)
+    return {"items": [{"uuid": "u-{}-{}".format(page, i), "amount": "1", "status": "paid", "is_final": True,
+                       "created_at": "2024-01-{:02d}T00:00:{:02d}+00:00".format(pages - page, i)}
+                      for i in range(per_page)],
+            "paginate": {"nextCursor": str(page + 1) if page + 1 < pages else None}}
+
+
+def _signed_webhook(client, data):
+    data = dict(data)
+    data["sign"] = client.signer(2 if data.get("type") == "payout" else 1).sign(webhook_sign_payload(data))
+    return json.dumps(data).encode()
+
+
 def test_api_functions():
     client = pyCryptomusAPI(
         test_merchant_uuid,
@@ -49,8 +152,911 @@ def test_api_functions():
     run_and_print(lambda: client.payment_services())
     run_and_print(lambda: client.payment_history())
     run_and_print(lambda: client.payment_history_filtered(is_final=True))
+    run_and_print(lambda: list(client.iter_payment_history(max_pages=2)))
+    run_and_print(lambda: client.payment_history_sharded(datetime.now() - timedelta(days=7), datetime.now(), max_workers=2))
     run_and_print(lambda: client.payout_services())
     run_and_print(lambda: client.payout_history())
+    run_and_print(lambda: HistoryMirror(client, ":memory:").sync())
     run_and_print(lambda: client.balance())
 
+def test_session_pool():
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    connections = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            body = json.dumps({"state": 0, "result": {"uuid": "u-1", "status": "paid"}}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    api_url = "http://127.0.0.1:{}/v1/".format(server.server_address[1])
+    try:
+        with pyCryptomusAPI("merchant", payment_api_key = "payment_key", api_url = api_url, pool_maxsize = 3) as client:
+            session = client.session
+            assert client.own_session and session.get_adapter(api_url)._pool_maxsize == 3
+            for _ in range(3):
+                assert client.payment_information(order_id = "order-1").uuid == "u-1"
+            # Same session and one kept-alive connection for all calls
+            assert client.session is session and len(connections) == 1
+            pools = session.get_adapter(api_url).poolmanager.pools
+            assert len(pools) == 1
+        # Exit closes pooled connections, next call opens a new one
+        assert len(pools) == 0
+        assert client.payment_information(order_id = "order-1").uuid == "u-1" and len(connections) == 2
+        client.close()
+        client.close()
+        assert len(pools) == 0
+
+        # Shared session is not closed by the client
+        import requests
+        shared = requests.Session()
+        with pyCryptomusAPI("merchant", payment_api_key = "payment_key", api_url = api_url, session = shared) as client:
+            client.payment_information(order_id = "order-1")
+        assert not client.own_session and len(shared.get_adapter(api_url).poolmanager.pools) == 1
+        shared.close()
+        # Without keep-alive every call opens a connection
+        with pyCryptomusAPI("merchant", payment_api_key = "payment_key", api_url = api_url, keep_alive = False) as client:
+            client.payment_information(order_id = "order-1")
+            client.payment_information(order_id = "order-1")
+        assert len(connections) == 5
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_async_api_offline():
+    pytest.importorskip("aiohttp")
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    signers = {1: Signer("merchant", "payment_key"), 2: Signer("merchant", "payout_key")}
+    requests_seen = []
+
+    async def handle(request):
+        body = await request.read()
+        method_url = request.match_info["method"]
+        requests_seen.append(method_url)
+        mode = 2 if method_url.startswith("payout") else 1
+        if request.headers.get("merchant") != "merchant" or request.headers.get("sign") != signers[mode].sign(body):
+            return web.json_response({"state": 1, "message": "Invalid sign"}, status = 401)
+        data = json.loads(body) if body else {}
+        if method_url == "payment":
+            return web.json_response({"state": 0, "result": {
+                "uuid": "u-1", "order_id": data["order_id"], "amount": data["amount"], "currency": data["currency"],
+                "status": "check", "is_final": False}})
+        if method_url == "payment/info":
+            return web.json_response({"state": 1, "message": "Not found"}, status = 422)
+        if method_url == "balance":
+            return web.json_response({"state": 0, "result": [{"balance": {
+                "merchant": [{"uuid": "b-1", "balance": "12.5", "currency_code": "USDT", "balance_usd": "12.5"}],
+                "user": []}}]})
+        return web.Response(status = 502, text = "Bad gateway")
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/v1/{method:.+}", handle)
+        async with TestServer(app) as server:
+            async with AsyncCryptomusAPI(
+                    "merchant", payment_api_key = "payment_key", payout_api_key = "payout_key",
+                    api_url = str(server.make_url("/v1/"))) as client:
+                invoice = await client.create_invoice(10, "USDT", "order-1")
+                assert (invoice.uuid, invoice.order_id, invoice.amount) == ("u-1", "order-1", 10.0)
+                assert (await client.balance()).get("USDT").balance == 12.5
+                try:
+                    await client.payment_information(order_id = "order-2")
+                    assert False
+                except pyCryptomusAPIException as pe:
+                    assert (pe.code, pe.message, pe.status_code) == (-5, "Not found", 422)
+                try:
+                    await client.payout_services()
+                    assert False
+                except pyCryptomusAPIException as pe:
+                    assert (pe.code, pe.status_code) == (-2, 502)
+                client.payment_api_key = "wrong_key"
+                try:
+                    await client.balance()
+                    assert False
+                except pyCryptomusAPIException as pe:
+                    assert (pe.code, pe.message, pe.status_code) == (-5, "Invalid sign", 401)
+        assert requests_seen == ["payment", "balance", "payment/info", "payout/services", "balance"]
+
+    asyncio.run(run())
+
+def test_iter_payment_history():
+    client = _offline_client(lambda method_url, data: _ok(_history_page(data.get("cursor"))))
+    for _ in client.iter_payment_history():
+        break
+    assert client.session.calls == ["payment/list"]
+    assert len(list(client.iter_payment_history(max_pages = 2))) == 4
+    assert len(list(client.iter_payment_history(prefetch = True))) == 6
+    assert len(client.session.calls) == 6
+
+def test_rate_limiter():
+    bucket = TokenBucket(10, burst = 3)
+    delays = [bucket.reserve() for _ in range(5)]
+    # Burst is sent at once, then requests are paced at rate
+    assert delays[:3] == [0, 0, 0]
+    assert delays[3] == pytest.approx(0.1, abs = 0.01) and delays[4] == pytest.approx(0.2, abs = 0.01)
+
+    limiter = RateLimiter(payment_rate = 10, payout_rate = 10, burst = 1)
+    assert limiter.reserve(1) == 0 and limiter.reserve(2) == 0
+    limiter.on_response(1, 429, "2")
+    assert limiter.current_rates == {"payment": 5, "payout": 10}
+    # Retry-After blocks the group, other group is not affected
+    assert limiter.reserve(1) == pytest.approx(2, abs = 0.01)
+    assert limiter.reserve(2) == pytest.approx(0.1, abs = 0.01)
+    limiter.on_response(1, 503, "Wed, 21 Oct 2015 07:28:00 GMT")
+    limiter.on_response(1, 503)
+    assert limiter.current_rates["payment"] == 1.25
+    for _ in range(100):
+        limiter.on_response(1, 200)
+    assert limiter.current_rates["payment"] == 10
+    assert limiter.stats["payment"]["throttled"] == 3
+
+def test_retry_policy():
+    import requests
+
+    def attempts(call, status = 503):
+        def answer(method_url, data):
+            if status is None:
+                raise requests.ConnectionError("Connection refused")
+            return status, {"state": 1, "message": "Service unavailable"}
+        client = _offline_client(answer, retry_policy = RetryPolicy(max_attempts = 3, backoff = 0.001))
+        try:
+            call(client)
+            assert False
+        except pyCryptomusAPIException:
+            pass
+        return len(client.session.calls)
+
+    # Read-only methods
+    assert attempts(lambda client: client.payment_information(order_id = "1")) == 3
+    assert attempts(lambda client: client.balance(), status = None) == 3
+    assert attempts(lambda client: client.payout_services(), status = 429) == 3
+    # Methods deduplicated by order_id
+    assert attempts(lambda client: client.create_invoice(1, "USDT", "order-1")) == 3
+    assert attempts(lambda client: client.create_payout(1, "USDT", "order-1", "Txxx", True, "tron")) == 3
+    # Methods which may change state twice
+    assert attempts(lambda client: client.refund("Txxx", True, order_id = "order-1")) == 1
+    assert attempts(lambda client: client.block_wallet_refund("Txxx", order_id = "order-1"), status = None) == 1
+    assert attempts(lambda client: client.block_wallet(order_id = "order-1")) == 1
+    # Not transient errors
+    assert attempts(lambda client: client.payment_information(order_id = "1"), status = 422) == 1
+
+    policy = RetryPolicy(max_attempts = 10, backoff = 0.5, max_backoff = 2, deadline = 5)
+    error = pyCryptomusAPIException(-5, "Service unavailable", status_code = 503)
+    for attempt, limit in ((1, 0.5), (2, 1), (3, 2), (6, 2)):
+        for _ in range(20):
+            assert 0 <= policy.next_delay("payment/info", {}, error, attempt, 0) <= limit
+    assert policy.next_delay("payment/info", {}, error, 10, 0) is None
+    assert policy.next_delay("payment/info", {}, error, 1, 5) is None
+    assert policy.next_delay("payment", {"amount": "1"}, error, 1, 0) is None
+    stats = policy.stats
+    assert stats["retries"] == 80 and stats["gave_up"] == 2 and stats["by_method"] == {"payment/info": 80}
+
+def test_create_invoices_bulk():
+    import threading
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def answer(method_url, data):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        # Later items are answered first
+        sleep(0.02 / (1 + int(data["order_id"].split("-")[1])))
+        with lock:
+            running[0] -= 1
+        if data["order_id"] == "order-3":
+            return 422, {"state": 1, "message": "Order already exists"}
+        return _ok({"uuid": "u-" + data["order_id"], "order_id": data["order_id"], "amount": data["amount"]})
+
+    client = _offline_client(answer)
+    invoices = [{"amount": 1, "currency": "USDT", "order_id": "order-{}".format(i)} for i in range(10)]
+    results = client.create_invoices_bulk(iter(invoices), max_workers = 4)
+    assert [i.index for i in results] == list(range(10)) and [i.params for i in results] == invoices
+    assert [i.result.order_id for i in results if i.ok] == ["order-{}".format(i) for i in range(10) if i != 3]
+    assert not results[3].ok and results[3].result is None
+    assert (results[3].error.status_code, results[3].error.message) == (422, "Order already exists")
+    assert running[1] == 4
+
+    # Workers are capped at pool size
+    running[1] = 0
+    client.pool_maxsize = 2
+    assert len(client.create_invoices_bulk(invoices, max_workers = 8)) == 10 and running[1] == 2
+
+    async def create(order_id):
+        running[0] += 1
+        running[1] = max(running)
+        await asyncio.sleep(0.01 / (1 + int(order_id)))
+        running[0] -= 1
+        if order_id == "3":
+            raise pyCryptomusAPIException(-5, "Order already exists", status_code = 422)
+        return "u-" + order_id
+
+    running[1] = 0
+    results = asyncio.run(run_bulk_async(create, ({"order_id": str(i)} for i in range(10)), 3))
+    assert [i.index for i in results] == list(range(10)) and running[1] == 3
+    assert [i.result for i in results] == ["u-{}".format(i) if i != 3 else None for i in range(10)]
+    assert results[3].error.message == "Order already exists"
+    assert run_bulk(lambda order_id: order_id, [], 2) == [] and asyncio.run(run_bulk_async(create, [], 2)) == []
+
+def test_payout_batch_resume(tmp_path):
+    failing = {"p-2"}
+    sent = []
+
+    def answer(method_url, data):
+        sent.append(data["order_id"])
+        if data["order_id"] in failing:
+            return 422, {"state": 1, "message": "Insufficient funds"}
+        return _ok({"uuid": "u-" + data["order_id"], "amount": data["amount"], "status": "process"})
+
+    client = _offline_client(answer)
+    payouts = [{"amount": 1, "currency": "USDT", "order_id": "p-{}".format(i), "address": "Txxx",
+                "is_subtract": True, "network": "tron"} for i in range(5)]
+    checkpoint = str(tmp_path / "payouts.jsonl")
+    summary = PayoutBatch(client, payouts, max_workers = 2, checkpoint_path = checkpoint).run()
+    assert (len(summary.succeeded), len(summary.failed), summary.skipped) == (4, 1, [])
+    assert summary.failed[0].params["order_id"] == "p-2"
+
+    # Crash while writing the last line
+    with open(checkpoint, "a", encoding = "utf-8") as f:
+        f.write('{"order_id": "p-')
+    failing.clear()
+    sent.clear()
+    summary = PayoutBatch(client, payouts, checkpoint_path = checkpoint).run()
+    assert sent == ["p-2"]
+    assert [i.result.uuid for i in summary.succeeded] == ["u-p-2"]
+    assert sorted(summary.skipped) == ["p-0", "p-1", "p-3", "p-4"]
+
+    sent.clear()
+    summary = PayoutBatch(client, payouts, checkpoint_path = checkpoint).run()
+    assert sent == [] and summary.total == 5 and len(summary.skipped) == 5
+
+    try:
+        PayoutBatch(client, payouts + [dict(payouts[0], amount = -1)]).run()
+        assert False
+    except pyCryptomusAPIException as pe:
+        assert "duplicate order_id p-0" in pe.message and "amount should be positive" in pe.message
+    assert sent == []
+
+def test_response_cache():
+    services = [{"network": "tron", "currency": "USDT", "is_available": True}]
+    client = _offline_client(_services_answer(services), cache = ResponseCache(ttl = 0.2, stale_ttl = 0.5))
+    calls = client.session.calls
+    first = client.payment_services()
+    first.clear()
+    assert len(client.payment_services()) == 1 and calls == ["payment/services"]
+
+    # Stale result is returned at once and refreshed in background
+    sleep(0.25)
+    services[0]["is_available"] = False
+    assert client.payment_services()[0].is_available is True
+    _wait_for(lambda: len(calls) == 2)
+    _wait_for(lambda: client.payment_services()[0].is_available is False)
+    assert len(calls) == 2
+
+    # Expired result is requested again
+    sleep(0.75)
+    client.payment_services()
+    assert len(calls) == 3
+    client.invalidate_cache("payment_services")
+    client.payment_services()
+    client.payout_services()
+    assert calls[3:] == ["payment/services", "payout/services"]
+    stats = client.cache.stats
+    assert (stats["stale_hits"], stats["misses"], stats["refresh_errors"]) == (1, 4, 0) and stats["hits"] >= 2
+
+    # Result requested before invalidation is not stored
+    cache = ResponseCache(ttl = 10)
+    version = cache.version("payout_services")
+    cache.invalidate()
+    cache.store("payout_services", ["old"], version)
+    assert cache.lookup("payout_services") == (CACHE_MISS, None)
+    cache.store("payout_services", ["new"], cache.version("payout_services"))
+    assert cache.lookup("payout_services")[1] == ["new"]
+    assert not cache.is_cached("balance")
+
+def test_slotted_models():
+    import pickle
+    data = {"uuid": "u-1", "amount": "10.50", "from": "Tabc", "status": "paid", "is_final": True, "new_field": 5}
+    invoice = Invoice.de_json(json.dumps(data))
+    assert (invoice.uuid, invoice.amount, invoice.status, invoice.is_final) == ("u-1", 10.5, "paid", True)
+    # Aliased, missing and unknown fields
+    assert invoice.from_ == "Tabc" and getattr(invoice, "from") == "Tabc"
+    assert invoice.txid is None and invoice.discount is None
+    assert invoice.extra == {"new_field": 5} and invoice.new_field == 5
+    assert not hasattr(invoice, "__dict__") and not hasattr(invoice, "missing_field")
+    assert Invoice.de_json({"uuid": "u-2"}).extra is None and Invoice().uuid is None
+    copy = pickle.loads(pickle.dumps(invoice))
+    assert copy._fields_dict() == invoice._fields_dict() and copy.new_field == 5
+
+    history = PaymentsHistory.de_json(
+        {"items": [data, {"uuid": "u-2", "amount": 3}], "paginate": {"count": "2", "nextCursor": "c"}})
+    assert [i.amount for i in history.items] == [10.5, 3.0]
+    assert (history.paginate.count, history.paginate.nextCursor) == (2, "c")
+    empty = PaymentsHistory.de_json({})
+    assert empty.items == [] and empty.paginate is None
+    assert pickle.loads(pickle.dumps(history)).items[0].uuid == "u-1"
+
+    service = Service.de_json({"network": "tron", "currency": "USDT", "limit": {"min_amount": "1", "max_amount": "10"}})
+    assert (service.limit.min_amount, service.limit.max_amount, service.commission) == (1.0, 10.0, None)
+    balance = Balance.de_json({"balance": {"merchant": [{"currency_code": "USDT", "balance": "2.5"}]}})
+    assert balance.get("USDT").balance == 2.5 and balance.user == [] and balance.get("BTC") is None
+    try:
+        Balance.de_json({})
+        assert False
+    except ValueError:
+        pass
+
+def test_lazy_amounts():
+    from decimal import Decimal
+    for amount_type in (float, Decimal):
+        for raw in ("10.10", 10, 10.1, None):
+            data = {"uuid": "u-1", "amount": raw, "payer_amount": raw}
+            eager = Invoice.de_json(data, amount_type = amount_type)
+            lazy = Invoice.de_json(data, amount_type = amount_type, lazy_amounts = True)
+            assert lazy.amount == eager.amount and type(lazy.amount) is type(eager.amount)
+            assert raw is None or type(eager.amount) is amount_type
+    assert Invoice.de_json({"amount": 10.1}, amount_type = Decimal, lazy_amounts = True).amount == Decimal("10.1")
+    # Amount type is kept by raw value, not per instance
+    import pickle
+    lazy = pickle.loads(pickle.dumps(Invoice.de_json({"amount": "1.10"}, amount_type = Decimal, lazy_amounts = True)))
+    assert lazy.amount == Decimal("1.10") and type(lazy.amount) is Decimal and lazy.extra is None
+
+def test_json_codec(tmp_path):
+    # Request bodies and signs don't depend on codec
+    params = [{"order_id": "order-1"}, {"amount": "10.50", "currency": "USDT", "order_id": "1", "is_refresh": True,
+               "lifetime": 3600, "additional_data": "a/b \\ \"c\"", "url_callback": None,
+               "currencies": [{"currency": "USDT", "network": "tron"}], "discount": 1.5, "subtract": -0.25}]
+    codecs = ["auto"]
+    for name in ("orjson", "ujson", "simplejson"):
+        try:
+            get_json_codec(name)
+            codecs.append(name)
+        except ImportError:
+            pass
+    stdlib = pyCryptomusAPI("merchant", payment_api_key = "payment_key")
+    for name in codecs:
+        client = pyCryptomusAPI("merchant", payment_api_key = "payment_key", json_codec = name)
+        for data in params:
+            url, body, headers = client._prepare_request("payment", 1, data)
+            assert body == json.dumps(data).encode() and (url, body, headers) == stdlib._prepare_request("payment", 1, data)
+
+    # Codec is per client: answers and stored history are decoded by codec of the client that requested them
+    decoded = []
+
+    def loads(data):
+        decoded.append(data)
+        return json.loads(data)
+
+    answer = lambda method_url, data: _ok(_history_page(data.get("cursor"), pages = 1))
+    counting = _offline_client(answer, json_codec = JsonCodec("counting", loads))
+    plain = _offline_client(answer)
+    assert len(plain.payment_history().items) == 2 and decoded == []
+    assert len(counting.payment_history().items) == 2 and len(decoded) == 1
+    mirror = HistoryMirror(counting, str(tmp_path / "mirror.db"), page_delay = 0)
+    mirror.sync()
+    del decoded[:]
+    assert len(mirror.query()) == 2 and len(decoded) == 2
+    mirror.close()
+    # de_json of JSON text always uses json.loads
+    assert Invoice.de_json(b'{"uuid": "u-1"}').uuid == "u-1" and len(decoded) == 2
+
+def test_history_index():
+    rows = [("u-1", "USDT", "tron", "paid", True, "10"), ("u-2", "USDT", "bsc", "check", False, "5"),
+            ("u-3", "BTC", "btc", "paid", True, "0.5"), ("u-4", "USDC", "tron", "paid_over", True, "2"),
+            ("u-5", "USDT", "tron", "cancel", True, None)]
+    history = PaymentsHistory.de_json({"items": [
+        {"uuid": u, "currency": c, "network": n, "status": s, "is_final": f, "amount": a} for u, c, n, s, f, a in rows]})
+    index = history.index()
+    uuids = lambda items: [i.uuid for i in items]
+    assert uuids(index.filter(currency = {"USDT", "USDC"}, status = ["paid", "paid_over"])) == ["u-1", "u-4"]
+    assert uuids(index.filter(currency = "USDT", network = "tron")) == ["u-1", "u-5"]
+    assert uuids(index.filter(is_final = False)) == ["u-2"] and index.count(is_final = True) == 4
+    assert index.filter(currency = "ETH") == [] and index.filter(currency = set()) == []
+    assert index.group_by("currency") == {"USDT": 3, "BTC": 1, "USDC": 1}
+    assert index.group_by("network", is_final = True) == {"tron": 3, "btc": 1}
+    assert index.sum(currency = "USDT") == 15 and index.sum(by = "currency") == {"USDT": 15, "BTC": 0.5, "USDC": 2}
+    assert index.sum(by = "network", currency = {"USDT", "USDC"}, is_final = True) == {"tron": 12}
+    assert sorted(index.values("status")) == ["cancel", "check", "paid", "paid_over"]
+    try:
+        index.filter(uuid = "u-1")
+        assert False
+    except ValueError:
+        pass
+    assert history.index() is index
+
+    # Replaced, added and removed items are noticed
+    replaced = Invoice.de_json({"uuid": "u-6", "currency": "USDT", "status": "paid", "is_final": True, "amount": "7"})
+    history.items[1] = replaced
+    index = history.index()
+    assert uuids(index.filter(status = "paid")) == ["u-1", "u-6", "u-3"] and index.sum(currency = "USDT") == 17
+    history.items.pop()
+    assert history.index().group_by("currency") == {"USDT": 2, "BTC": 1, "USDC": 1}
+    history.items = history.items[:2]
+    assert len(history.index()) == 2
+    # Changed fields are seen only after rebuild
+    history.items[0].status = "refund"
+    assert history.index().group_by("status") == {"paid": 2}
+    assert history.index(rebuild = True).group_by("status") == {"refund": 1, "paid": 1}
+
+def test_history_columns():
+    import math
+    import random
+    rnd = random.Random(1)
+    pages = []
+    for page in range(3):
+        items = []
+        for i in range(50):
+            currency = rnd.choice(("USDT", "USDT", "BTC", "USDC"))
+            items.append({
+                "uuid": "u-{}-{}".format(page, i), "currency": currency, "network": rnd.choice(("tron", "bsc")),
+                "status": rnd.choice(("paid", "check", "cancel")), "is_final": rnd.choice((True, False, None)),
+                "amount": "{:.2f}".format(rnd.uniform(1, 100)), "from": rnd.choice((None, "Tabc")),
+                "merchant_amount": rnd.choice((None, "{:.8f}".format(rnd.uniform(0, 100)), rnd.uniform(0, 100)))})
+        pages.append({"items": items, "paginate": {"nextCursor": str(page + 1)}})
+    history = PaymentsHistory.de_json({"items": [i for page in pages for i in page["items"]]})
+
+    sums = {}
+    counts = {}
+    for item in history.items:
+        key = (item.currency, item.network)
+        sums[key] = sums.get(key, 0.0) + (item.merchant_amount or 0.0)
+        counts[(item.status, bool(item.is_final))] = counts.get((item.status, bool(item.is_final)), 0) + 1
+
+    def values(column):
+        column = column.tolist() if hasattr(column, "tolist") else list(column)
+        return [None if isinstance(v, float) and math.isnan(v) else v for v in column]
+
+    use_numpy_modes = [False]
+    try:
+        import numpy
+        use_numpy_modes.append(True)
+    except ImportError:
+        pass
+    for use_numpy in use_numpy_modes:
+        columns = history.to_columns(use_numpy = use_numpy)
+        assert len(columns) == 150 and columns.use_numpy == use_numpy and "from_" in columns
+        assert columns.group_sum(by = ("currency", "network")) == pytest.approx(sums)
+        by_currency = columns.group_sum("merchant_amount", "currency")
+        assert by_currency == pytest.approx({c: sum(v for (i, _), v in sums.items() if i == c) for c in by_currency})
+        assert columns.group_count(("status", "is_final")) == counts
+        assert sum(columns.group_count().values()) == 150
+        # Raw pages (dicts or JSON) give the same columns as parsed history
+        for raw in (pages, [json.dumps(page) for page in pages]):
+            from_pages = PaymentsHistory.columns_from_pages(raw, use_numpy = use_numpy)
+            assert from_pages.fields == columns.fields
+            for field in columns.fields:
+                assert values(from_pages[field]) == values(columns[field]), field
+        selected = history.to_columns(["currency", "amount"], use_numpy = use_numpy)
+        assert selected.fields == ["currency", "amount"] and values(selected["amount"]) == [i.amount for i in history.items]
+    if len(use_numpy_modes) == 2:
+        python = history.to_columns(use_numpy = False)
+        vectorized = history.to_columns(use_numpy = True)
+        for by in ("currency", ("currency", "network"), ("status", "is_final", "network")):
+            assert vectorized.group_sum(by = by) == pytest.approx(python.group_sum(by = by))
+            assert vectorized.group_count(by) == python.group_count(by)
+
+def test_history_mirror_query_during_sync(tmp_path):
+    import threading
+    page_requested = threading.Event()
+    release = threading.Event()
+
+    def answer(method_url, data):
+        if data.get("cursor") == "1":
+            page_requested.set()
+            release.wait(5)
+        return _ok(_history_page(data.get("cursor"), pages = 2))
+
+    mirror = HistoryMirror(_offline_client(answer), str(tmp_path / "history.sqlite"), page_delay = 0)
+    result = []
+    thread = threading.Thread(target = lambda: result.append(mirror.sync(payouts = False)))
+    thread.start()
+    assert page_requested.wait(5)
+    # Stored pages can be queried while the next one is requested
+    started = monotonic()
+    assert [i.uuid for i in mirror.query(status = "paid")] == ["u-0-1", "u-0-0"]
+    assert monotonic() - started < 1
+    release.set()
+    thread.join()
+    assert result == [{"payments": 4}] and len(mirror.query(limit = 3)) == 3
+    mirror.close()
+
+def test_history_mirror_mixed_offsets(tmp_path):
+    requests_from = []
+    items = [{"uuid": "u-1", "status": "check", "is_final": False, "created_at": "2024-01-02T02:00:00+03:00"},
+             {"uuid": "u-2", "status": "process", "is_final": False, "created_at": "2024-01-01 22:00:00"},
+             {"uuid": "u-3", "status": "check", "is_final": False, "created_at": "2024-01-01T20:00:00Z"}]
+
+    def answer(method_url, data):
+        requests_from.append(data.get("date_from"))
+        return _ok({"items": items, "paginate": {"nextCursor": None}})
+
+    mirror = HistoryMirror(_offline_client(answer), ":memory:", overlap = timedelta(minutes = 30), page_delay = 0)
+    assert mirror.sync(payouts = False) == {"payments": 3}
+    # Newest is 23:00 UTC, its overlap starts at 22:30, oldest non-final item is at 20:00 UTC
+    assert mirror.sync(payouts = False) == {"payments": 3}
+    assert requests_from == [None, "2024-01-01 20:00:00"]
+    mirror.close()
+
+def test_payout_methods_use_payout_key():
+    client = _offline_client(lambda method_url, data: _ok(
+        _history_page(data.get("cursor")) if method_url.endswith("list") else {"uuid": "u-1", "status": "paid"}))
+    client.payout_history()
+    client.payout_information(order_id = "order-1")
+    payout_signer = Signer("merchant", "payout_key")
+    assert client.session.calls == ["payout/list", "payout/info"]
+    assert client.session.signs == [payout_signer.sign(b""), payout_signer.sign(b'{"order_id": "order-1"}')]
+    history = client.payout_history_sharded(datetime(2024, 1, 1), datetime(2024, 1, 3), max_workers = 2, page_delay = 0)
+    # Both windows get the same stub pages, duplicates are merged by uuid
+    assert len(history.items) == 6 and client.session.calls[2:] == ["payout/list"] * 6
+
+def test_invoice_watcher_callback_errors():
+    polls = {}
+
+    def answer(method_url, data):
+        uuid = data["uuid"]
+        polls[uuid] = polls.get(uuid, 0) + 1
+        final = polls[uuid] > 1
+        return _ok({"uuid": uuid, "status": "paid" if final else "check", "is_final": final})
+
+    changes = []
+
+    def on_change(invoice, previous):
+        changes.append((invoice.uuid, invoice.status))
+        if invoice.uuid == "u-1":
+            raise ValueError("Handler failed")
+
+    watcher = InvoiceWatcher(_offline_client(answer), on_change, min_interval = 0.01, rate = 1000)
+    watcher.add("u-1")
+    watcher.add("u-2")
+    watcher.run(until_done = True)
+    assert sorted(changes) == [("u-1", "check"), ("u-1", "paid"), ("u-2", "check"), ("u-2", "paid")]
+    assert watcher.stats["callback_errors"] == 2 and watcher.stats["finished"] == 2
+
+    class AsyncClient:
+        print_errors = False
+
+        async def payment_information(self, invoice_uuid):
+            return Invoice.de_json(answer("payment/info", {"uuid": invoice_uuid})[1]["result"])
+
+    async def async_on_change(invoice, previous):
+        on_change(invoice, previous)
+
+    changes.clear()
+    polls.clear()
+    watcher = AsyncInvoiceWatcher(AsyncClient(), async_on_change, min_interval = 0.01, rate = 1000)
+    watcher.add("u-1")
+    watcher.add("u-2")
+    asyncio.run(watcher.run(until_done = True))
+    assert len(changes) == 4 and watcher.stats["callback_errors"] == 2 and watcher.stats["finished"] == 2
+
+def test_single_flight():
+    from concurrent.futures import ThreadPoolExecutor
+    callers = 8
+    status = [200]
+    waiting = [callers - 1]
+
+    def answer(method_url, data):
+        # Hold the request until the other callers wait for it
+        _wait_for(lambda: client.single_flight.coalesced >= waiting[0])
+        if status[0] != 200:
+            return status[0], {"state": 1, "message": "Not found"}
+        return _ok({"uuid": "u-1", "order_id": data["order_id"], "status": "paid"})
+
+    def call(_):
+        try:
+            return client.payment_information(order_id = "order-1")
+        except pyCryptomusAPIException as pe:
+            return pe
+
+    client = _offline_client(answer, coalesce = True)
+    with ThreadPoolExecutor(max_workers = callers) as executor:
+        results = list(executor.map(call, range(callers)))
+        assert client.session.calls == ["payment/info"]
+        assert all(i is results[0] for i in results) and results[0].order_id == "order-1"
+
+        status[0] = 422
+        waiting[0] += callers - 1
+        results = list(executor.map(call, range(callers)))
+        assert len(client.session.calls) == 2
+        assert all(i is results[0] for i in results) and results[0].message == "Not found"
+    assert client.single_flight.stats == {
+        "calls": 2, "coalesced": 2 * (callers - 1), "coalesced_by_method": {"payment/info": 2 * (callers - 1)}}
+    # Calls which change state are never coalesced
+    assert client._flight_key("payment", 1, {"order_id": "order-1"}) is None
+
+def test_balance_write_through():
+    payout_fails = [False]
+
+    def answer(method_url, data):
+        if method_url == "balance":
+            return _ok([{"balance": {"merchant": [
+                {"uuid": "b-1", "balance": "100", "currency_code": "USDT", "balance_usd": "100"},
+                {"uuid": "b-2", "balance": "1", "currency_code": "BTC", "balance_usd": "60000"}], "user": []}}])
+        if method_url == "payout":
+            if payout_fails[0]:
+                return 422, {"state": 1, "message": "Insufficient funds"}
+            return _ok({"uuid": "p-1", "amount": data["amount"], "currency": "USDT", "status": "process",
+                        "balance": "90", "payer_currency": "USDT"})
+        return _ok({"uuid": "u-1", "status": "refund_process"})
+
+    client = _offline_client(answer, cache = ResponseCache(balance_ttl = 60))
+    calls = client.session.calls
+    assert client.balance().get("USDT").balance == 100 and client.balance().get("USDT").balance == 100
+    assert calls == ["balance"]
+
+    # Payout balance is applied to cached balance without request
+    client.create_payout(10, "USDT", "order-1", "Txxx", True, "tron")
+    balance = client.balance()
+    assert (balance.get("USDT").balance, balance.get("USDT").balance_usd) == (90, 90)
+    assert balance.get("BTC").balance == 1 and calls == ["balance", "payout"]
+
+    # Refunds and failed payouts drop cached balance
+    client.refund("Txxx", True, order_id = "order-1")
+    assert client.balance().get("USDT").balance == 100 and calls[-2:] == ["payment/refund", "balance"]
+    client.block_wallet_refund("Txxx", order_id = "order-1")
+    client.balance()
+    payout_fails[0] = True
+    try:
+        client.create_payout(10, "USDT", "order-2", "Txxx", True, "tron")
+        assert False
+    except pyCryptomusAPIException:
+        pass
+    client.balance()
+    assert calls[2:] == ["payment/refund", "balance", "wallet/blocked-address-refund", "balance", "payout", "balance"]
+
+def test_service_validator():
+    validator = ServiceValidator()
+    assert validator.check("payout", 5, "USDT") is None
+    validator.end_refresh("payout", [Service.de_json(i) for i in _PAYOUT_SERVICES])
+    assert validator.check("payout", 50, "USDT", "tron") is None
+    assert validator.check("payout", "500", "USDT") is None
+    assert validator.check("payout", 5, "USDT", "tron") == "5 USDT on tron network: below min amount"
+    assert validator.check("payout", 500, "USDT", "tron") == "500 USDT on tron network: above max amount"
+    assert validator.check("payout", 50, "USDT", "eth") == "50 USDT on eth network: not available"
+    # No network accepts amount: limit of available network is reported, not "not available" of the last one
+    assert validator.check("payout", 5000, "USDT") == "5000 USDT on any network: above max amount"
+    assert validator.check("payout", 0.5, "USDT") == "0.5 USDT on any network: below min amount"
+    # Unknown networks and currencies are left to the server
+    assert validator.check("payout", 5, "USDT", "polygon") is None
+    assert validator.check("payout", 5, "USD") is None
+    assert validator.stats["rejected_by_reason"] == {"below min amount": 2, "above max amount": 2, "not available": 1}
+    assert (validator.stats["checked"], validator.stats["unchecked"]) == (7, 3)
+
+    client = _offline_client(_services_answer(_PAYOUT_SERVICES), validator = ServiceValidator())
+    try:
+        client.create_payout(5000, "USDT", "order-1", "Txxx", True, "bsc")
+        assert False
+    except pyCryptomusAPIException as pe:
+        assert pe.code == -8 and pe.message == "Rejected by service limits: 5000 USDT on bsc network: above max amount"
+    assert client.session.calls == ["payout/services"]
+
+def test_payout_fee_estimator():
+    import math
+    import random
+    estimator = PayoutFeeEstimator([Service.de_json(i) for i in _PAYOUT_SERVICES])
+    rnd = random.Random(1)
+    amounts = [round(rnd.uniform(0, 1200), 2) for _ in range(500)] + [0.5, 10, 100, 1000, 5000]
+    currencies = [rnd.choice(("USDT", "USDT", "BTC", "USD")) for _ in amounts]
+    for networks in (None, {"tron", "eth"}, {"polygon"}):
+        python = estimator.estimate(amounts, currencies, networks, use_numpy = False)
+        for (network, fee), amount, currency in zip(python, amounts, currencies):
+            fees = estimator.network_fees(amount, currency, networks)
+            if fees:
+                assert fees[network] == min(fees.values()) and fee == pytest.approx(fees[network])
+            else:
+                assert network is None and math.isnan(fee)
+        try:
+            import numpy
+        except ImportError:
+            continue
+        vectorized = estimator.estimate(amounts, currencies, networks, use_numpy = True)
+        assert vectorized.networks == python.networks
+        assert numpy.allclose(vectorized.fees, list(python.fees), equal_nan = True)
+    assert estimator.estimate([50, 5000], "USDT")[0] == ("bsc", pytest.approx(0.55))
+    assert estimator.estimate([50, 5000], "USDT", use_numpy = False)[1][0] is None
+
+def test_webhook():
+    import io
+    client = pyCryptomusAPI("merchant", payment_api_key="payment_key", payout_api_key="payout_key")
+    data = {"type": "payment", "uuid": str(uuid.uuid4()), "order_id": "1", "amount": "10.00",
+            "status": "paid", "is_final": True, "additional_data": "https://x/ü"}
+    data["sign"] = client.signer(1).sign(webhook_sign_payload(data))
+    invoice = WebhookVerifier(client).parse(json.dumps(data))
+    assert invoice.uuid == data["uuid"] and invoice.amount == 10 and invoice.type == "payment"
+    data["amount"] = "100.00"
+    try:
+        WebhookVerifier(client).parse(json.dumps(data))
+        assert False
+    except pyCryptomusAPIException as pe:
+        assert pe.code == -7
+
+    received = []
+    app = WebhookApp(client, received.append)
+    data = {"type": "payout", "uuid": str(uuid.uuid4()), "amount": "5", "status": "paid"}
+    data["sign"] = client.signer(2).sign(webhook_sign_payload(data))
+    body = json.dumps(data).encode()
+    statuses = []
+    app({"REQUEST_METHOD": "POST", "CONTENT_LENGTH": str(len(body)), "wsgi.input": io.BytesIO(body)},
+        lambda status, headers: statuses.append(status))
+    app.close()
+    assert statuses == ["200 OK"] and received[0].uuid == data["uuid"]
+
+    # Counters stay exact under concurrent WSGI requests
+    from concurrent.futures import ThreadPoolExecutor
+    app = WebhookApp(client, lambda webhook: None, workers = 4)
+    bad = json.dumps({"type": "payment", "uuid": "u-1", "sign": "0" * 32}).encode()
+
+    def post(i):
+        payload = body if i % 2 else bad
+        app({"REQUEST_METHOD": "POST", "CONTENT_LENGTH": str(len(payload)), "wsgi.input": io.BytesIO(payload)},
+            lambda status, headers: None)
+
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        list(executor.map(post, range(4000)))
+    app.close()
+    assert app.stats == {"received": 4000, "rejected": 2000, "dropped": 0, "handled": 2000, "handler_errors": 0}
+
+    dedup = WebhookDeduplicator()
+    check = Invoice.de_json({"uuid": invoice.uuid, "status": "check", "is_final": False})
+    assert [dedup.accept(invoice), dedup.accept(invoice), dedup.accept(check)] == [True, False, False]
+
+def test_async_webhook_app():
+    client = pyCryptomusAPI("merchant", payment_api_key = "payment_key", payout_api_key = "payout_key")
+    bodies = [_signed_webhook(client, {"type": "payment", "uuid": "u-{}".format(i), "status": "paid", "is_final": True})
+              for i in range(4)]
+    bad_sign = json.dumps({"type": "payment", "uuid": "u-9", "status": "paid", "sign": "0" * 32}).encode()
+
+    async def run():
+        release = asyncio.Event()
+        handled = []
+
+        async def handler(webhook):
+            await release.wait()
+            handled.append(webhook.uuid)
+
+        app = AsyncWebhookApp(client, handler, workers = 1, queue_size = 2, max_body_size = 200)
+
+        async def post(body, chunk_size = None, method = "POST"):
+            chunk_size = chunk_size or max(len(body), 1)
+            messages = [{"type": "http.request", "body": body[i:i + chunk_size], "more_body": i + chunk_size < len(body)}
+                        for i in range(0, len(body), chunk_size)] or [{"type": "http.request", "body": b""}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            await app({"type": "http", "method": method}, receive, send)
+            assert sent[1]["type"] == "http.response.body"
+            return sent[0]["status"]
+
+        lifespan_in = asyncio.Queue()
+        lifespan_out = asyncio.Queue()
+        lifespan = asyncio.ensure_future(app({"type": "lifespan"}, lifespan_in.get, lifespan_out.put))
+        await lifespan_in.put({"type": "lifespan.startup"})
+        assert (await lifespan_out.get())["type"] == "lifespan.startup.complete" and len(app._tasks) == 1
+
+        assert await post(bodies[0]) == 200
+        # Worker takes the first webhook and waits in handler, next two fill the queue
+        await asyncio.sleep(0)
+        assert await post(bodies[1], chunk_size = 7) == 200 and await post(bodies[2]) == 200
+        assert await post(bodies[3]) == 503
+        assert await post(bad_sign) == 400 and await post(b"") == 400 and await post(b"{}", method = "GET") == 405
+        assert max(map(len, bodies)) < 200 and await post(b"x" * 201, chunk_size = 80) == 413
+        assert handled == []
+
+        # Shutdown waits for queued webhooks
+        release.set()
+        await lifespan_in.put({"type": "lifespan.shutdown"})
+        assert (await lifespan_out.get())["type"] == "lifespan.shutdown.complete"
+        await lifespan
+        assert handled == ["u-0", "u-1", "u-2"] and app._tasks == []
+        assert app.stats == {"received": 5, "rejected": 1, "dropped": 1, "handled": 3, "handler_errors": 0}
+
+    asyncio.run(run())
+
+def test_webhook_deduplicator(tmp_path):
+    def webhook(uuid_, status, updated_at = None):
+        return Invoice.de_json({"uuid": uuid_, "status": status, "is_final": status in ("paid", "cancel"),
+                                "updated_at": updated_at and "2024-01-01T00:00:{:02d}+00:00".format(updated_at)})
+
+    dedup = WebhookDeduplicator()
+    assert dedup.accept(webhook("u-1", "check", 1)) and dedup.accept(webhook("u-1", "paid", 5))
+    assert not dedup.accept(webhook("u-1", "paid", 5))
+    # Older updated_at is stale even with new status, newer one is accepted even after final status
+    assert not dedup.accept(webhook("u-1", "process", 3))
+    assert dedup.accept(webhook("u-1", "refund_paid", 9))
+    # Without timestamps nothing comes after final status
+    assert dedup.accept(webhook("u-2", "check")) and dedup.accept(webhook("u-2", "cancel"))
+    assert not dedup.accept(webhook("u-2", "process")) and dedup.accept(webhook("u-2", "paid"))
+    assert dedup.stats == {"accepted": 6, "duplicates": 1, "stale": 2}
+
+    # Least recently used objects are forgotten beyond max_size
+    dedup = WebhookDeduplicator(max_size = 2)
+    for uuid_ in ("u-1", "u-2", "u-3"):
+        assert dedup.accept(webhook(uuid_, "paid"))
+    assert dedup.accept(webhook("u-1", "paid")) and not dedup.accept(webhook("u-3", "paid"))
+    assert not dedup.accept(webhook("u-3", "check"))
+    assert list(dedup._seen) == [("u-1", "paid"), ("u-3", "paid")]
+
+    # SQLite state survives restart and the memory window
+    db_path = str(tmp_path / "dedup.db")
+    dedup = WebhookDeduplicator(max_size = 2, db_path = db_path)
+    for uuid_ in ("u-1", "u-2", "u-3"):
+        assert dedup.accept(webhook(uuid_, "paid", 5))
+    assert not dedup.accept(webhook("u-1", "paid", 5)) and not dedup.accept(webhook("u-1", "check", 1))
+    dedup.close()
+    dedup = WebhookDeduplicator(max_size = 2, db_path = db_path)
+    assert not dedup.accept(webhook("u-2", "paid", 5)) and not dedup.accept(webhook("u-3", "process", 4))
+    assert dedup.accept(webhook("u-3", "refund_process", 6)) and dedup.accept(webhook("u-4", "check", 1))
+    assert dedup.stats == {"accepted": 2, "duplicates": 1, "stale": 1}
+    dedup.close()
+    dedup = WebhookDeduplicator(db_path = db_path)
+    assert dedup._state("u-3") == ("refund_process", False, datetime(2024, 1, 1, 0, 0, 6, tzinfo = timezone.utc).timestamp())
+    dedup.close()
+
+def test_replay(tmp_path):
+    client = pyCryptomusAPI("merchant", payment_api_key = "payment_key", payout_api_key = "payout_key")
+
+    def webhook(uuid_, status, updated_at, **fields):
+        return _signed_webhook(client, dict(type = "payment", uuid = uuid_, status = status, is_final = status == "paid",
+                                            updated_at = "2024-01-01T00:00:{:02d}+00:00".format(updated_at), **fields))
+
+    lines = {
+        "valid": [webhook("u-1", "check", 1), webhook("u-1", "paid", 3), webhook("u-2", "check", 1),
+                  _signed_webhook(client, {"type": "payout", "uuid": "p-1", "status": "paid", "is_final": True})],
+        "duplicate": [webhook("u-1", "check", 1), webhook("u-2", "check", 1, amount = "1")],
+        "stale": [webhook("u-1", "process", 2), webhook("u-2", "cancel", 0)],
+    }
+    bad_sign = webhook("u-3", "paid", 1).replace(b'"u-3"', b'"u-4"')
+    source = [lines["valid"][0], lines["duplicate"][0], bad_sign, lines["valid"][1], lines["stale"][0],
+              lines["valid"][2], b"", b"not json", lines["duplicate"][1], lines["valid"][3], lines["stale"][1]]
+    path = tmp_path / "webhooks.jsonl"
+    path.write_bytes(b"\n".join(source) + b"\n")
+
+    def outputs(out_dir):
+        return {name: [line for line in (out_dir / (name + ".jsonl")).read_bytes().split(b"\n") if line]
+                for name in ("valid", "invalid", "duplicate", "stale")}
+
+    for workers in (0, 2):
+        out_dir = tmp_path / "out-{}".format(workers)
+        with open(path, "rb") as f:
+            counts = replay(f, str(out_dir), "merchant", "payment_key", "payout_key", workers = workers, chunk_size = 2)
+        assert counts == {"valid": 4, "invalid": 2, "duplicate": 2, "stale": 2}
+        result = outputs(out_dir)
+        for name in ("valid", "duplicate", "stale"):
+            assert result[name] == lines[name]
+        invalid = [json.loads(line) for line in result["invalid"]]
+        assert [(i["line"], i["error"]) for i in invalid] == [(3, "Webhook sign is invalid"), (8, invalid[1]["error"])]
+        assert invalid[0]["body"].encode() == bad_sign and invalid[1]["error"].startswith("Webhook decode failed")
+
+    # CLI keeps deduplication state between runs in --dedup-db
+    args = [str(path), "--out-dir", str(tmp_path / "cli"), "--payment-api-key", "payment_key",
+            "--payout-api-key", "payout_key", "--workers", "0", "--dedup-db", str(tmp_path / "dedup.db")]
+    assert replay_main(args) == 0 and outputs(tmp_path / "cli")["valid"] == lines["valid"]
+    assert replay_main(args) == 0
+    result = outputs(tmp_path / "cli")
+    assert result["valid"] == [] and sorted(result["duplicate"]) == sorted(lines["valid"] + lines["duplicate"])
+    assert result["stale"] == lines["stale"]
+
 test_api_functions()
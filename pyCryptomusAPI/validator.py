@@ -0,0 +1,189 @@
+import threading
+import time
+
+from .cache import CACHE_MISS, CACHE_FRESH, CACHE_STALE
+
+# Validated kind: client method with its services
+VALIDATED_KINDS = {"payment": "payment_services", "payout": "payout_services"}
+
+
+class ServiceValidator:
+    """
+    Local check of create_invoice and create_payout against service limits (thread-safe)
+
+    Services of payment_services() and payout_services() are indexed by (currency, network). Request is rejected
+    before it's signed and sent if the service is not available or amount is out of its limits. If network is not
+    passed, request is rejected only if no network of the currency accepts it (with the limit of available network
+    closest to amount as reason). Currencies and networks which are not
+    in services (e.g. fiat invoice currency) are passed to the server unchecked.
+    Services are loaded by client on first check (other calls wait for them) and refreshed in background
+    when older than ttl (old ones are used meanwhile). Validator can be shared between clients with the same keys.
+    """
+
+    def __init__(self, ttl = 300, retry_interval = 30):
+        """
+        :param ttl: (Float, Optional, default=300) Time (in seconds) after which services are refreshed
+        :param retry_interval: (Float, Optional, default=30) Time (in seconds) before next load after failed one. Requests are not checked meanwhile
+        """
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.checked = 0
+        self.rejected = 0
+        self.unchecked = 0
+        self.rejected_by_reason = {}
+        self.refreshes = 0
+        self.refresh_errors = 0
+        # kind: ({(currency, network): Service}, {currency: [Service]}, expiration time)
+        self._services = {}
+        self._refreshing = set()
+        self._condition = threading.Condition()
+
+    def state(self, kind):
+        """
+        :param kind: (String) "payment" or "payout"
+        :return: CACHE_MISS if services are not loaded, CACHE_STALE if they should be refreshed, else CACHE_FRESH
+        """
+        entry = self._services.get(kind)
+        if entry is None:
+            return CACHE_MISS
+        return CACHE_FRESH if time.monotonic() < entry[2] else CACHE_STALE
+
+    def begin_refresh(self, kind):
+        """
+        :return: (Bool) True if caller should load services of the kind, False if they are already being loaded
+        """
+        with self._condition:
+            if kind in self._refreshing:
+                return False
+            self._refreshing.add(kind)
+            return True
+
+    def end_refresh(self, kind, services = None, failed = False):
+        """
+        :param kind: (String) "payment" or "payout"
+        :param services: (List of Service) Loaded services
+        :param failed: (Bool) Load failed: old services are kept (or nothing is checked) until retry_interval passes
+        """
+        with self._condition:
+            self._refreshing.discard(kind)
+            if failed:
+                self.refresh_errors += 1
+                by_pair, by_currency, _ = self._services.get(kind) or ({}, {}, None)
+                self._services[kind] = (by_pair, by_currency, time.monotonic() + self.retry_interval)
+                self._condition.notify_all()
+                return
+            self.refreshes += 1
+            by_pair = {}
+            by_currency = {}
+            for service in services:
+                by_pair[(service.currency, service.network)] = service
+                by_currency.setdefault(service.currency, []).append(service)
+            self._services[kind] = (by_pair, by_currency, time.monotonic() + self.ttl)
+            self._condition.notify_all()
+
+    def wait(self, kind, timeout = None):
+        """
+        Wait for services being loaded by another thread
+
+        :return: (Bool) False if services are still not loaded
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: kind in self._services or kind not in self._refreshing, timeout)
+
+    def service(self, kind, currency, network):
+        """
+        :return: (Service) Service of the currency and network, None if it's unknown
+        """
+        entry = self._services.get(kind)
+        return entry[0].get((currency, network)) if entry else None
+
+    def check(self, kind, amount, currency, network = None):
+        """
+        :param kind: (String) "payment" or "payout"
+        :param amount: (String or Float) Amount in currency
+        :param currency: (String) Currency code
+        :param network: (String, Optional) Network code
+        :return: (String) Reason of rejection, None if request can be sent
+        """
+        entry = self._services.get(kind)
+        if entry is None:
+            return self._count(None, False)
+        by_pair, by_currency, _ = entry
+        if network:
+            service = by_pair.get((currency, network))
+            services = [service] if service else None
+        else:
+            services = by_currency.get(currency)
+        if not services:
+            return self._count(None, False)
+        try:
+            value = float(amount)
+        except (TypeError, ValueError):
+            value = None
+        reason = None
+        distance = None
+        for service in services:
+            service_reason = _service_reason(service, value)
+            if service_reason is None:
+                return self._count(None, True)
+            # Limit of available network tells more than "not available": report the one closest to amount
+            service_distance = _limit_distance(service, value)
+            if reason is None or (service_distance is not None and (distance is None or service_distance < distance)):
+                reason = service_reason
+                distance = service_distance
+        if network:
+            message = "{} {} on {} network: {}".format(amount, currency, network, reason)
+        else:
+            message = "{} {} on any network: {}".format(amount, currency, reason)
+        return self._count(reason, True, message)
+
+    def _count(self, reason, checked, message = None):
+        with self._condition:
+            if not checked:
+                self.unchecked += 1
+                return None
+            self.checked += 1
+            if reason is None:
+                return None
+            self.rejected += 1
+            self.rejected_by_reason[reason] = self.rejected_by_reason.get(reason, 0) + 1
+            return message
+
+    @property
+    def stats(self):
+        """
+        Validator counters: checked requests, locally rejected ones (also by reason), requests passed unchecked
+        (services not loaded or currency not in them), services loads and failed loads
+        """
+        return {"checked": self.checked, "rejected": self.rejected, "unchecked": self.unchecked,
+                "rejected_by_reason": dict(self.rejected_by_reason), "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors}
+
+
+def _service_reason(service, amount):
+    """
+    :return: (String) Why service can't accept amount, None if it can
+    """
+    if service.is_available is False:
+        return "not available"
+    limit = service.limit
+    if amount is not None and limit is not None:
+        if limit.min_amount is not None and amount < limit.min_amount:
+            return "below min amount"
+        if limit.max_amount is not None and amount > limit.max_amount:
+            return "above max amount"
+    return None
+
+
+def _limit_distance(service, amount):
+    """
+    :return: (Float) How far amount is out of service limits, None if service is not available or amount is within them
+    """
+    if service.is_available is False or amount is None or service.limit is None:
+        return None
+    limit = service.limit
+    if limit.min_amount is not None and amount < limit.min_amount:
+        return limit.min_amount - amount
+    if limit.max_amount is not None and amount > limit.max_amount:
+        return amount - limit.max_amount
+    return None
@@ -0,0 +1,336 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+from .cryto_types import Invoice
+from .rate_limiter import TokenBucket
+
+
+class _WatchedInvoice:
+    __slots__ = ("uuid", "invoice", "interval", "expires", "next_poll", "generation")
+
+    def __init__(self, uuid, invoice):
+        self.uuid = uuid
+        self.invoice = invoice
+        self.interval = None
+        self.expires = None
+        self.next_poll = None
+        self.generation = 0
+
+
+def _invoice_state(invoice):
+    return (invoice.status, invoice.payment_status, invoice.is_final, invoice.payment_amount, invoice.txid)
+
+
+class _InvoiceWatcherBase:
+    def __init__(self, client, on_change, min_interval, max_interval, backoff, rate, expiry_grace):
+        self.client = client
+        self.on_change = on_change
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.expiry_grace = expiry_grace
+        self.bucket = TokenBucket(rate)
+        self.polls = 0
+        self.changes = 0
+        self.errors = 0
+        self.callback_errors = 0
+        self.finished = 0
+        self._entries = {}
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _add(self, invoice):
+        if isinstance(invoice, Invoice):
+            if invoice.is_final:
+                return False
+            entry = _WatchedInvoice(invoice.uuid, invoice)
+        else:
+            entry = _WatchedInvoice(invoice, None)
+        now = time.monotonic()
+        entry.interval = self.min_interval
+        self._entries[entry.uuid] = entry
+        self._set_expiry(entry, now)
+        # Known invoice waits for its interval, unknown one is polled at once
+        self._push(entry, now + self.min_interval if entry.invoice else now)
+        return True
+
+    def _remove(self, uuid):
+        return self._entries.pop(uuid, None) is not None
+
+    def _push(self, entry, next_poll):
+        entry.generation += 1
+        entry.next_poll = next_poll
+        # Equal poll times: invoice expiring first goes first
+        heapq.heappush(self._heap, (
+            next_poll, entry.expires if entry.expires is not None else float("inf"),
+            next(self._counter), entry.generation, entry))
+
+    def _set_expiry(self, entry, now):
+        expired_at = entry.invoice.expired_at if entry.invoice else None
+        if expired_at:
+            try:
+                entry.expires = now + (float(expired_at) - time.time())
+            except (TypeError, ValueError):
+                entry.expires = None
+
+    def _pop_due(self):
+        """
+        :return: (entry, wait) Due entry, or None and seconds until the next one (None if nothing is watched)
+        """
+        now = time.monotonic()
+        while self._heap:
+            next_poll, _, _, generation, entry = self._heap[0]
+            if self._entries.get(entry.uuid) is not entry or generation != entry.generation:
+                # Removed or rescheduled
+                heapq.heappop(self._heap)
+                continue
+            if next_poll > now:
+                return None, next_poll - now
+            heapq.heappop(self._heap)
+            return entry, 0
+        return None, None
+
+    def _polled(self, entry, invoice):
+        """
+        Updates entry with polled invoice and schedules next poll
+
+        :return: (Bool) True if invoice has changed
+        """
+        self.polls += 1
+        now = time.monotonic()
+        previous = entry.invoice
+        changed = previous is None or _invoice_state(previous) != _invoice_state(invoice)
+        entry.invoice = invoice
+        self._set_expiry(entry, now)
+        if changed:
+            self.changes += 1
+        if invoice.is_final:
+            self.finished += 1
+            self._remove(entry.uuid)
+            return changed
+        self._reschedule(entry, now, changed)
+        return changed
+
+    def _failed(self, entry, error):
+        self.errors += 1
+        if self.client.print_errors:
+            print("Invoice {} poll failed: {}".format(entry.uuid, error))
+        if self._entries.get(entry.uuid) is entry:
+            self._reschedule(entry, time.monotonic(), False)
+
+    def _callback_failed(self, invoice, error):
+        self.callback_errors += 1
+        if self.client.print_errors:
+            print("Invoice {} on_change exception: {!r}".format(invoice.uuid, error))
+
+    def _reschedule(self, entry, now, changed):
+        # Changed invoices are polled often, quiet ones less and less often
+        entry.interval = self.min_interval if changed else min(entry.interval * self.backoff, self.max_interval)
+        next_poll = now + entry.interval
+        if entry.expires is not None and now < entry.expires:
+            # Check status right after expiration
+            next_poll = min(next_poll, entry.expires + self.expiry_grace)
+        self._push(entry, next_poll)
+
+    @property
+    def stats(self):
+        """
+        Watcher counters: watched invoices, polls, changes, failed polls, on_change exceptions and invoices which
+        reached final status
+        """
+        return {"watching": len(self._entries), "polls": self.polls, "changes": self.changes, "errors": self.errors,
+                "callback_errors": self.callback_errors, "finished": self.finished}
+
+
+class InvoiceWatcher(_InvoiceWatcherBase):
+    """
+    Tracks many invoices by polling payment_information from one thread
+
+    Invoices are kept in a priority queue by next poll time. Poll interval starts at min_interval, grows by backoff
+    while invoice doesn't change (up to max_interval) and is reset when it changes. Invoice is also polled right after
+    its expired_at. Total poll rate is limited by rate. Invoice is dropped when it gets final status.
+    on_change(invoice, previous) is called from the watcher thread when status, payment status, paid amount or txid changes
+    (previous is None on the first poll of invoice added by uuid). Exceptions of on_change are counted (and printed
+    with print_errors) and don't stop the watcher.
+    """
+
+    def __init__(self, client, on_change, min_interval = 5, max_interval = 300, backoff = 1.5, rate = 2,
+                 expiry_grace = 5):
+        """
+        :param client: (pyCryptomusAPI) Client with PAYMENT API key
+        :param on_change: (Callable) Function called with (invoice, previous invoice) on change
+        :param min_interval: (Float, Optional, default=5) Min poll interval of one invoice (in seconds)
+        :param max_interval: (Float, Optional, default=300) Max poll interval of one invoice (in seconds)
+        :param backoff: (Float, Optional, default=1.5) Interval multiplier after poll without changes
+        :param rate: (Float, Optional, default=2) Max number of polls per second, for all invoices
+        :param expiry_grace: (Float, Optional, default=5) Delay of poll after invoice expiration (in seconds)
+        """
+        super().__init__(client, on_change, min_interval, max_interval, backoff, rate, expiry_grace)
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def add(self, invoice):
+        """
+        Start watching invoice
+
+        :param invoice: (Invoice or String) Invoice (e.g. returned by create_invoice) or its uuid
+        :return: (Bool) False if invoice is already final
+        """
+        with self._condition:
+            added = self._add(invoice)
+            self._condition.notify()
+        return added
+
+    def remove(self, uuid):
+        """
+        Stop watching invoice
+
+        :return: (Bool) False if invoice was not watched
+        """
+        with self._condition:
+            return self._remove(uuid)
+
+    def run(self, until_done = False):
+        """
+        Poll invoices in the current thread until stop() is called
+
+        :param until_done: (Bool, Optional, default=False) Return when all invoices are final
+        """
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopped:
+                        return
+                    entry, wait = self._pop_due()
+                    if entry:
+                        break
+                    if wait is None and until_done:
+                        return
+                    self._condition.wait(wait)
+            self.bucket.acquire()
+            try:
+                invoice = self.client.payment_information(invoice_uuid = entry.uuid)
+            except Exception as e:
+                with self._condition:
+                    self._failed(entry, e)
+                continue
+            with self._condition:
+                if self._entries.get(entry.uuid) is not entry:
+                    # Removed while polled
+                    continue
+                previous = entry.invoice
+                changed = self._polled(entry, invoice)
+            if changed:
+                try:
+                    self.on_change(invoice, previous)
+                except Exception as e:
+                    # Other invoices are still polled
+                    with self._condition:
+                        self._callback_failed(invoice, e)
+
+    def start(self):
+        """
+        Run watcher in a background thread
+        """
+        self._stopped = False
+        self._thread = threading.Thread(target = self.run, daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+
+class AsyncInvoiceWatcher(_InvoiceWatcherBase):
+    """
+    Tracks many invoices by polling payment_information from one task
+
+    Same as InvoiceWatcher, but runs in the event loop with AsyncCryptomusAPI.
+    on_change can be a coroutine function.
+    """
+
+    def __init__(self, client, on_change, min_interval = 5, max_interval = 300, backoff = 1.5, rate = 2,
+                 expiry_grace = 5):
+        """
+        :param client: (AsyncCryptomusAPI) Client with PAYMENT API key
+        :param on_change: (Callable or Coroutine function) Function called with (invoice, previous invoice) on change
+        Other parameters are the same as InvoiceWatcher ones
+        """
+        super().__init__(client, on_change, min_interval, max_interval, backoff, rate, expiry_grace)
+        self._wakeup = None
+        self._stopped = False
+
+    def add(self, invoice):
+        """
+        Start watching invoice
+
+        :param invoice: (Invoice or String) Invoice (e.g. returned by create_invoice) or its uuid
+        :return: (Bool) False if invoice is already final
+        """
+        added = self._add(invoice)
+        if self._wakeup:
+            self._wakeup.set()
+        return added
+
+    def remove(self, uuid):
+        """
+        Stop watching invoice
+
+        :return: (Bool) False if invoice was not watched
+        """
+        return self._remove(uuid)
+
+    async def run(self, until_done = False):
+        """
+        Poll invoices until stop() is called
+
+        :param until_done: (Bool, Optional, default=False) Return when all invoices are final
+        """
+        self._wakeup = asyncio.Event()
+        self._stopped = False
+        while not self._stopped:
+            entry, wait = self._pop_due()
+            if not entry:
+                if wait is None and until_done:
+                    return
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            delay = self.bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                invoice = await self.client.payment_information(invoice_uuid = entry.uuid)
+            except Exception as e:
+                self._failed(entry, e)
+                continue
+            if self._entries.get(entry.uuid) is not entry:
+                continue
+            previous = entry.invoice
+            if self._polled(entry, invoice):
+                try:
+                    result = self.on_change(invoice, previous)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    # Other invoices are still polled
+                    self._callback_failed(invoice, e)
+
+    def stop(self):
+        self._stopped = True
+        if self._wakeup:
+            self._wakeup.set()
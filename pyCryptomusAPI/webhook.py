@@ -0,0 +1,317 @@
+import asyncio
+import hmac
+import inspect
+import json
+import queue
+import threading
+
+from .api import pyCryptomusAPIException
+from .cryto_types import Invoice, Payout
+
+
+def webhook_sign_payload(data):
+    """
+    Encodes webhook data (without sign) the way Cryptomus does before signing it:
+    PHP json_encode with JSON_UNESCAPED_UNICODE, i.e. no spaces, raw unicode and escaped slashes.
+
+    :param data: (Dict) Webhook data without sign
+    :return: (Bytes) Payload to sign
+    """
+    return json.dumps(data, ensure_ascii = False, separators = (",", ":")).replace("/", "\\/").encode("utf-8")
+
+
+class WebhookVerifier:
+    """
+    Verifies webhook sign and parses webhook into Invoice (payment and wallet webhooks) or Payout (payout webhooks)
+    """
+
+    def __init__(self, client):
+        """
+        :param client: (pyCryptomusAPI or AsyncCryptomusAPI) Client with PAYMENT API key (payment webhooks) and/or PAYOUT API key (payout webhooks)
+        """
+        self.client = client
+
+    def verify(self, data):
+        """
+        Check webhook sign
+
+        :param data: (Dict) Decoded webhook body
+        :return: (Bool) True if sign is valid
+        """
+        sign = data.get("sign")
+        if not isinstance(sign, str):
+            return False
+        payload = {key: value for key, value in data.items() if key != "sign"}
+        signer = self.client.signer(2 if data.get("type") == "payout" else 1)
+        return hmac.compare_digest(signer.sign(webhook_sign_payload(payload)), sign)
+
+    def parse(self, body):
+        """
+        Verify and parse webhook
+
+        :param body: (Bytes, String or Dict) Webhook request body
+        :return: (Invoice or Payout) Webhook data, "type" and other webhook-only fields are available as attributes too
+        """
+        if isinstance(body, dict):
+            data = body
+        else:
+            try:
+                data = self.client.json_codec.loads(body)
+            except ValueError as e:
+                raise pyCryptomusAPIException(-7, "Webhook decode failed: {}".format(e))
+            if not isinstance(data, dict):
+                raise pyCryptomusAPIException(-7, "Webhook decode failed: not an object")
+        if not self.verify(data):
+            raise pyCryptomusAPIException(-7, "Webhook sign is invalid")
+        data = {key: value for key, value in data.items() if key != "sign"}
+        model = Payout if data.get("type") == "payout" else Invoice
+        return self.client._parser(model)(data)
+
+
+class _WebhookAppBase:
+    def __init__(self, client, handler, workers, queue_size, max_body_size):
+        self.verifier = WebhookVerifier(client)
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_body_size = max_body_size
+        self.received = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.handled = 0
+        self.handler_errors = 0
+        # Counters are updated from server and handler threads
+        self._counters_lock = threading.Lock()
+
+    def _parse(self, body):
+        """
+        :return: (status, webhook or None)
+        """
+        with self._counters_lock:
+            self.received += 1
+        try:
+            return 200, self.verifier.parse(body)
+        except pyCryptomusAPIException as e:
+            with self._counters_lock:
+                self.rejected += 1
+            # -7: invalid webhook, other codes: client is not configured for the webhook type
+            return (400 if e.code == -7 else 500), None
+
+    def _handled(self):
+        with self._counters_lock:
+            self.handled += 1
+
+    def _dropped(self):
+        with self._counters_lock:
+            self.dropped += 1
+
+    def _handle_error(self, e):
+        with self._counters_lock:
+            self.handler_errors += 1
+        if self.verifier.client.print_errors:
+            print("Webhook handler exception: {!r}".format(e))
+
+    @property
+    def stats(self):
+        """
+        Webhook counters: received, rejected (invalid), dropped (queue full), handled and failed by handler
+        """
+        with self._counters_lock:
+            return {"received": self.received, "rejected": self.rejected, "dropped": self.dropped,
+                    "handled": self.handled, "handler_errors": self.handler_errors}
+
+
+class WebhookApp(_WebhookAppBase):
+    """
+    WSGI application receiving Cryptomus webhooks
+
+    Verified webhooks are put to a bounded queue and passed to handler by worker threads, so response is sent
+    without waiting for handler. If queue is full, 503 is returned and Cryptomus sends the webhook again later.
+    Invalid webhooks get 400.
+    """
+
+    def __init__(self, client, handler, workers = 4, queue_size = 10000, max_body_size = 65536):
+        """
+        :param client: (pyCryptomusAPI) Client with API keys used to verify webhooks
+        :param handler: (Callable) Function called with Invoice or Payout for every verified webhook
+        :param workers: (Int, Optional, default=4) Number of handler threads
+        :param queue_size: (Int, Optional, default=10000) Max number of webhooks waiting for handler
+        :param max_body_size: (Int, Optional, default=65536) Max request body size in bytes
+        """
+        super().__init__(client, handler, workers, queue_size, max_body_size)
+        self.queue = queue.Queue(queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start handler threads (done automatically on first webhook)
+        """
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target = self._worker, daemon = True)
+                thread.start()
+                self._threads.append(thread)
+
+    def close(self):
+        """
+        Handle queued webhooks and stop handler threads
+        """
+        with self._lock:
+            for _ in self._threads:
+                self.queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def _worker(self):
+        while True:
+            webhook = self.queue.get()
+            if webhook is None:
+                return
+            try:
+                self.handler(webhook)
+                self._handled()
+            except Exception as e:
+                self._handle_error(e)
+
+    def __call__(self, environ, start_response):
+        if environ["REQUEST_METHOD"] != "POST":
+            return _wsgi_response(start_response, 405)
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        if length <= 0:
+            return _wsgi_response(start_response, 400)
+        if length > self.max_body_size:
+            return _wsgi_response(start_response, 413)
+        status, webhook = self._parse(environ["wsgi.input"].read(length))
+        if webhook is not None:
+            if not self._threads:
+                self.start()
+            try:
+                self.queue.put_nowait(webhook)
+            except queue.Full:
+                self._dropped()
+                status = 503
+        return _wsgi_response(start_response, status)
+
+
+_STATUS_LINES = {200: "200 OK", 400: "400 Bad Request", 405: "405 Method Not Allowed",
+                 413: "413 Payload Too Large", 500: "500 Internal Server Error", 503: "503 Service Unavailable"}
+_BODIES = {status: line[4:].encode("ascii") for status, line in _STATUS_LINES.items()}
+
+
+def _wsgi_response(start_response, status):
+    body = _BODIES[status]
+    start_response(_STATUS_LINES[status], [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+class AsyncWebhookApp(_WebhookAppBase):
+    """
+    ASGI application receiving Cryptomus webhooks
+
+    Same as WebhookApp, but handler is called by worker tasks of the event loop.
+    Handler can be a coroutine function or a plain function (it must not block then).
+    """
+
+    def __init__(self, client, handler, workers = 4, queue_size = 10000, max_body_size = 65536):
+        """
+        :param client: (pyCryptomusAPI or AsyncCryptomusAPI) Client with API keys used to verify webhooks
+        :param handler: (Callable or Coroutine function) Function called with Invoice or Payout for every verified webhook
+        :param workers: (Int, Optional, default=4) Number of handler tasks
+        :param queue_size: (Int, Optional, default=10000) Max number of webhooks waiting for handler
+        :param max_body_size: (Int, Optional, default=65536) Max request body size in bytes
+        """
+        super().__init__(client, handler, workers, queue_size, max_body_size)
+        self.queue = None
+        self._tasks = []
+
+    def start(self):
+        """
+        Start handler tasks in the running event loop (done automatically on lifespan startup or first webhook)
+        """
+        if self._tasks:
+            return
+        self.queue = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        """
+        Handle queued webhooks and stop handler tasks
+        """
+        if not self._tasks:
+            return
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions = True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            webhook = await self.queue.get()
+            try:
+                result = self.handler(webhook)
+                if inspect.isawaitable(result):
+                    await result
+                self._handled()
+            except Exception as e:
+                self._handle_error(e)
+            finally:
+                self.queue.task_done()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        if scope["method"] != "POST":
+            return await _asgi_response(send, 405)
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body_size:
+                return await _asgi_response(send, 413)
+            chunks.append(chunk)
+            more_body = message.get("more_body", False)
+        if not size:
+            return await _asgi_response(send, 400)
+        status, webhook = self._parse(b"".join(chunks))
+        if webhook is not None:
+            if not self._tasks:
+                self.start()
+            try:
+                self.queue.put_nowait(webhook)
+            except asyncio.QueueFull:
+                self._dropped()
+                status = 503
+        await _asgi_response(send, status)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+async def _asgi_response(send, status):
+    body = _BODIES[status]
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain"), (b"content-length", str(len(body)).encode("ascii"))]})
+    await send({"type": "http.response.body", "body": body})
@@ -20,6 +20,11 @@ setup(name='pyCryptomusAPI',
       url='https://github.com/Badiboy/pyCryptomusAPI',
       packages=['pyCryptomusAPI'],
       requires=['requests'],
+      extras_require={
+          'async': ['aiohttp'],
+          'fast': ['orjson'],
+          'numpy': ['numpy'],
+      },
       license='MIT license',
       keywords="Crypto Pay API Cryptomus",
       classifiers=[